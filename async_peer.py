@@ -0,0 +1,422 @@
+import asyncio
+from collections import deque
+from peer import Peer, MIN_PEERS_REQUIRED, PEX_INTERVAL, CHOKED_TIMEOUT
+from choker import CHOKE_INTERVAL
+from download_scheduler import DownloadScheduler
+from hashing import hash_pool
+from peer_protocol import (
+    read_message_async, decode_request, decode_piece, decode_have, decode_handshake, decode_proof, encode_message,
+    encode_handshake, encode_request, encode_cancel, encode_have, encode_bitfield, encode_pex, HANDSHAKE, REQUEST,
+    PIECE, HAVE, CANCEL, REJECT, GET_BITFIELD, PEX, PROOF, CHOKE, UNCHOKE, KEEPALIVE
+)
+
+LISTEN_BACKLOG = 1024  # pending connections the listening socket accepts under a burst of new peers
+CONNECT_TIMEOUT = 10  # seconds to wait when opening a connection to another peer
+
+
+class AsyncPeer(Peer):
+    """
+    A Peer that serves uploads and runs downloads on a single asyncio event loop
+    instead of a thread per connection. Chunk bookkeeping, tracker registration and
+    the answer to a request are shared with Peer.
+    """
+
+    def __init__(self, peer_ip, file_to_share=None, metadata_file=None, trackers=None, dht_nodes=None):
+        super().__init__(peer_ip, file_to_share, metadata_file, trackers, dht_nodes)
+        self.stream_writers = {}  # Writers of the connections we opened, keyed by "ip:port"
+        self.requests_released = None  # asyncio.Condition, notified when requests go back to the pool
+        self.verifications = set()  # Tasks verifying received chunks on the hash pool
+        self.exchange_task = None  # Task sending peer exchange messages, referenced so it is not collected
+        self.choke_task = None  # Task recalculating the upload slots
+        self.heartbeat_task = None  # Task keeping our registration with the tracker alive
+
+    def start(self):
+        """
+        Starts the peer's operations on an event loop, see run().
+        """
+        asyncio.run(self.run())
+
+    async def run(self):
+        """
+        -> Listening for incoming requests
+        -> Registering with the tracker and joining the DHT
+        -> Waiting for sufficient peers to connect
+        -> Downloading chunks
+        Keeps serving uploads once the download is complete.
+        """
+        loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_connection, '0.0.0.0', 0, backlog=LISTEN_BACKLOG)
+        self.peer_port = server.sockets[0].getsockname()[1]  # Store the assigned port
+        print(f"Listening for chunk requests on port {self.peer_port}...")
+        self.choke_task = asyncio.create_task(self.choke_peers_periodically_async())
+
+        if self.metadata_file:
+            self.load_metadata(self.metadata_file)
+        if self.file_to_share:
+            print(f"Sharing file: {self.file_to_share}")
+            await loop.run_in_executor(None, self.prepare_file_chunks)  # Reading the file must not block the loop
+        elif self.metadata:
+            # Nothing to share yet, download into the file named in the metadata
+            await loop.run_in_executor(None, self.open_storage, self.metadata["file_name"], self.metadata["total_size"])
+
+        if self.dht_nodes is not None:
+            await loop.run_in_executor(None, self.start_dht)  # The DHT node runs on a loop of its own
+        await self.refresh_peers_async()
+        await self.wait_for_peers_async()
+        self.exchange_task = asyncio.create_task(self.exchange_peers_periodically_async())
+        if self.trackers:
+            self.heartbeat_task = asyncio.create_task(self.send_heartbeats_periodically_async())
+
+        async with server:
+            await self.download_chunks_async()
+            await server.serve_forever()
+
+    async def wait_for_peers_async(self):
+        """
+        Waits until the minimum number of peers have connected before starting the downloads
+        """
+        print("Waiting for minimum peers to join...")
+        while len(self.tracker_peers) < MIN_PEERS_REQUIRED:
+            await asyncio.sleep(self.min_announce_interval)  # waiting as long as the tracker asks before checking again
+            await self.refresh_peers_async()
+        print("Minimum peer threshold has been reached, starting download process")
+
+    async def refresh_peers_async(self):
+        """
+        Refreshes the known peers like refresh_peers. The tracker and DHT requests are blocking
+        and run on the executor, the answers are applied on the loop like everything else.
+        """
+        fetched = await asyncio.get_running_loop().run_in_executor(None, self.fetch_peers)
+        self.apply_peers(*fetched)
+
+    async def send_heartbeats_periodically_async(self):
+        """
+        Sends a heartbeat every announce interval, so the tracker does not evict us.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.announce_interval)
+            try:
+                self.apply_tracker_peers(await loop.run_in_executor(None, self.request_heartbeat))
+            except OSError as e:
+                print(f"Heartbeat to the tracker failed: {e}")
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves one connection from another peer.
+        A reader task queues incoming requests while this coroutine answers them in order,
+        so a CANCEL that arrives before a request is served removes it from the queue.
+        Choke decisions are queued in front of the requests, which are rejected while the
+        peer is choked.
+        """
+        peer_ip, peer_port = writer.get_extra_info('peername')[:2]
+        pending_requests = deque()
+        request_ready = asyncio.Event()
+        state = {'remote_addr': None, 'upload_addr': None, 'open': True}
+
+        def send_control_message(message_id, payload=b""):
+            pending_requests.appendleft(encode_message(message_id, payload))  # Ahead of the queued requests
+            request_ready.set()
+
+        async def read_requests():
+            try:
+                while True:
+                    message_id, payload = await read_message_async(reader)
+                    if message_id == HANDSHAKE:
+                        state['remote_addr'] = decode_handshake(payload)
+                    elif message_id == REQUEST:
+                        pending_requests.append(decode_request(payload))
+                        request_ready.set()
+                    elif message_id == CANCEL:
+                        request = decode_request(payload)
+                        if request in pending_requests:
+                            pending_requests.remove(request)
+                    elif message_id == HAVE:
+                        self.record_peer_have(state['remote_addr'], decode_have(payload))
+                    elif message_id == PEX:
+                        # Applied by the loop itself, between the steps of the download workers
+                        asyncio.get_running_loop().call_soon(self.apply_pex, state['remote_addr'], payload)
+                    elif message_id == GET_BITFIELD:
+                        pending_requests.append(GET_BITFIELD)  # Written between pieces, not in the middle of one
+                        request_ready.set()
+                    elif message_id is not KEEPALIVE:
+                        print(f"Ignoring unexpected message {message_id} from {state['remote_addr']}")
+                    if state['upload_addr'] is None:
+                        state['upload_addr'] = state['remote_addr'] or f"{peer_ip}:{peer_port}"
+                        self.add_upload_connection(state['upload_addr'], send_control_message)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass  # The remote peer closed the connection
+            except Exception as e:
+                print(f"Error reading from {peer_ip}: {e}")
+            finally:
+                state['open'] = False
+                request_ready.set()
+
+        reader_task = asyncio.create_task(read_requests())
+        try:
+            while state['open'] or pending_requests:
+                if not pending_requests:
+                    request_ready.clear()
+                    await request_ready.wait()
+                    continue
+                request = pending_requests.popleft()
+                if request == GET_BITFIELD:
+                    writer.write(encode_bitfield(self.received_chunks))
+                    await writer.drain()
+                    continue
+                if isinstance(request, bytes):  # A control message, CHOKE, UNCHOKE or PEX
+                    writer.write(request)
+                    continue
+                chunk_number, begin, length = request
+                frame, count = self.prepare_chunk_response(state['upload_addr'], chunk_number, begin, length)
+                delay = self.upload_limiter.reserve(state['upload_addr'], count) if count else 0
+                if delay:
+                    await asyncio.sleep(delay)
+                writer.write(frame)
+                if count:
+                    await self.send_piece_async(writer, chunk_number, begin, count)
+                await writer.drain()  # Back-pressure: wait while the socket buffer is full
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"Error handling chunk request: {e}")
+        finally:
+            reader_task.cancel()
+            if state['upload_addr'] is not None:
+                self.remove_upload_connection(state['upload_addr'])
+            writer.close()
+
+    async def send_piece_async(self, writer, chunk_number, begin, count):
+        """
+        Sends chunk data from the file on disk with the event loop's native sendfile.
+        When that is not available (non-regular file, TLS or a loop without sendfile support)
+        the data is written from a memoryview of the mapping instead of a bytes copy.
+        """
+        if self.storage.can_sendfile:
+            await writer.drain()  # sendfile requires the transport's write buffer to be empty
+            try:
+                # A chunk spanning a file boundary is sent from each of the files in turn
+                for file, offset, segment_count in self.storage.file_segments(chunk_number, begin, count):
+                    await asyncio.get_running_loop().sendfile(
+                        writer.transport, file, offset, segment_count, fallback=False
+                    )
+                return
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                pass
+        writer.write(self.storage.read_piece(chunk_number, begin, count))
+
+    async def open_peer_connection(self, peer_addr):
+        """
+        Opens a connection to a peer and sends our handshake.
+        RETURNS:
+        The (reader, writer) pair of the connection.
+        """
+        peer_ip, peer_port = peer_addr.split(":")
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, int(peer_port)), CONNECT_TIMEOUT)
+        writer.write(encode_handshake(f"{self.peer_ip}:{self.peer_port}"))
+        self.stream_writers[peer_addr] = writer
+        return reader, writer
+
+    def broadcast_have(self, chunk_number):
+        """
+        Tells every peer we are connected to that we now have a chunk.
+        The frames are buffered by the transports, so this never blocks the loop.
+        """
+        frame = encode_have(chunk_number)
+        for writer in list(self.stream_writers.values()):
+            if not writer.is_closing():
+                writer.write(frame)
+
+    def exchange_peers(self):
+        """
+        Sends every peer we are connected to what changed in our view of the swarm, over
+        the connections we opened and the ones other peers opened to us.
+        The frames are buffered by the transports, so this never blocks the loop.
+        """
+        for peer_addr, writer in list(self.stream_writers.items()):
+            message = self.build_pex_message(peer_addr)
+            if message is not None and not writer.is_closing():
+                writer.write(encode_pex(message))
+        self.exchange_peers_with_uploaders()
+
+    def connected_peers(self):
+        return set(self.stream_writers)
+
+    async def choke_peers_periodically_async(self):
+        while True:
+            await asyncio.sleep(CHOKE_INTERVAL)
+            self.choke_peers()
+
+    async def exchange_peers_periodically_async(self):
+        while True:
+            await asyncio.sleep(PEX_INTERVAL)
+            self.exchange_peers()
+
+    async def download_chunks_async(self):
+        """
+        Downloads missing chunks from all known peers at the same time, with one pipelined
+        connection per peer. The DownloadScheduler decides what each peer is asked for.
+        """
+        self.scheduler = DownloadScheduler(self.piece_manager, self.storage.piece_size,
+                                           piece_length=self.storage.piece_length)
+        self.requests_released = asyncio.Condition()
+        while not self.piece_manager.is_complete():
+            self.scheduler.reset_failures()
+            workers = [asyncio.create_task(self.download_from_peer(peer_addr))
+                       for peer_addr in list(self.tracker_peers) if not self.scheduler.is_banned(peer_addr)]
+            await asyncio.gather(*workers)
+            await asyncio.gather(*self.verifications)  # Every received chunk is stored or back in the pool
+            self.display_download_rates()
+
+            if self.piece_manager.is_complete() or not workers:
+                break
+            # The known peers cannot provide the rest, look for new ones
+            print(f"{self.piece_manager.missing_wanted} chunks still missing, refreshing peers")
+            await asyncio.sleep(self.min_announce_interval)
+            await self.refresh_peers_async()
+        self.save_resume_data()
+        if len(self.received_chunks) == self.total_chunks:
+            print("Download complete! You are now a seeder")
+        elif self.piece_manager.is_complete():
+            print("Download of the wanted chunks complete")
+
+    async def download_from_peer(self, peer_addr):
+        """
+        Keeps the peer's request window full and handles the answers until the peer
+        has nothing left that we need.
+        PARAMETERS:
+        peer_addr: The address of the peer to download from.
+        """
+        writer = None
+        receiving = None  # Task reading the next message, kept across timeouts while choked
+        proofs = {}  # (chunk number, begin) -> Merkle proof of a block whose PIECE comes next
+        try:
+            reader, writer = await self.open_peer_connection(peer_addr)
+            while not self.piece_manager.is_complete():
+                await self.expire_requests_async()
+                peer_chunks = self.tracker_peers.get(peer_addr, ())
+                for chunk_number, begin, length in self.scheduler.next_requests(peer_addr, peer_chunks):
+                    writer.write(encode_request(chunk_number, begin, length))
+                choked_for = self.scheduler.choked_for(peer_addr)
+                if not self.scheduler.outstanding(peer_addr):
+                    if not self.scheduler.has_wanted_pieces(peer_addr, peer_chunks):
+                        break  # This peer has nothing left that we need
+                    if choked_for is not None and choked_for > CHOKED_TIMEOUT:
+                        break  # It keeps its upload slots for others
+                    if choked_for is None:
+                        # Everything it has is being fetched elsewhere, wait in case one of those fails
+                        async with self.requests_released:
+                            try:
+                                await asyncio.wait_for(self.requests_released.wait(), 1)
+                            except asyncio.TimeoutError:
+                                pass
+                        continue
+                await writer.drain()
+
+                # The read is not cancelled when it times out while choked: cancelling it could
+                # leave part of a frame consumed. It carries on in the next iteration instead.
+                if receiving is None:
+                    receiving = asyncio.ensure_future(read_message_async(reader))
+                done, _ = await asyncio.wait({receiving}, timeout=self.scheduler.request_timeout)
+                if not done:
+                    if choked_for is not None:
+                        continue  # Nothing comes while we are choked, keep waiting for the unchoke
+                    raise asyncio.TimeoutError(f"No answer within {self.scheduler.request_timeout} seconds")
+                message_id, payload = receiving.result()
+                receiving = None
+                if message_id == PIECE:
+                    chunk_number, begin, data = decode_piece(payload)
+                    # Not reading while over the limit makes TCP slow the sender down
+                    delay = self.download_limiter.reserve(peer_addr, len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                    if not self.verify_blocks(chunk_number, begin, data, proofs):
+                        banned = self.reject_block(peer_addr, chunk_number, begin, len(data))
+                        await self.notify_requests_released()
+                        if banned:
+                            break  # Its other answers would be rejected too, stop waiting for them
+                        continue
+                    piece_data, duplicates = self.scheduler.on_block_received(peer_addr, chunk_number, begin, data)
+                    self.cancel_requests(duplicates)  # Endgame copies of the block still on their way
+                    if piece_data is not None:
+                        verification = asyncio.create_task(self.verify_and_store(chunk_number, piece_data))
+                        self.verifications.add(verification)
+                        verification.add_done_callback(self.verifications.discard)
+                elif message_id == REJECT:
+                    chunk_number, begin, length = decode_request(payload)
+                    if peer_addr not in self.scheduler.choked:  # When choked, requests are released already
+                        print(f"Chunk {chunk_number} not found on peer {peer_addr}")
+                        self.scheduler.on_request_failed(peer_addr, (chunk_number, begin, length))
+                        await self.notify_requests_released()
+                elif message_id == PROOF:
+                    chunk_number, begin, hashes = decode_proof(payload)
+                    proofs[(chunk_number, begin)] = hashes
+                elif message_id == HAVE:
+                    self.record_peer_have(peer_addr, decode_have(payload))
+                elif message_id == PEX:
+                    asyncio.get_running_loop().call_soon(self.apply_pex, peer_addr, payload)
+                elif message_id == CHOKE:
+                    print(f"Choked by {peer_addr}")
+                    self.scheduler.on_choked(peer_addr)  # Its outstanding requests go to the other peers
+                    await self.notify_requests_released()
+                elif message_id == UNCHOKE:
+                    self.scheduler.on_unchoked(peer_addr)
+        except Exception as e:
+            print(f"Error downloading from {peer_addr}: {e!r}")
+        finally:
+            if receiving is not None:
+                receiving.cancel()  # The connection is closed below, a half-read frame no longer matters
+            self.scheduler.release_peer(peer_addr)  # Let other peers pick up what this one did not deliver
+            await self.notify_requests_released()
+            self.stream_writers.pop(peer_addr, None)
+            self.pex_sent.pop(peer_addr, None)
+            self.download_limiter.remove_peer(peer_addr)  # Its token bucket is created again if we come back to it
+            if writer:
+                writer.close()
+
+    async def verify_and_store(self, chunk_number, chunk_data):
+        """
+        Hashes a received chunk on the hash pool, so the event loop keeps serving
+        connections meanwhile, then stores it or hands it back to the scheduler.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            valid = await loop.run_in_executor(hash_pool(), self.verify_received_chunk, chunk_number, chunk_data)
+        except Exception as e:
+            self.handle_verification_error(chunk_number, e)
+        else:
+            self.handle_verified_chunk(chunk_number, chunk_data, valid)
+        await self.notify_requests_released()
+
+    async def expire_requests_async(self):
+        """
+        Releases timed-out requests so other peers retry them, and cancels them on the slow peer.
+        """
+        expired = self.scheduler.expire_requests()
+        for peer_addr, (chunk_number, begin, length) in expired:
+            print(f"Request for chunk {chunk_number} at {begin} to {peer_addr} timed out")
+        self.cancel_requests(expired)
+        if expired:
+            await self.notify_requests_released()
+
+    def cancel_requests(self, requests):
+        """
+        Withdraws block requests on the connections they were sent on.
+        PARAMETERS:
+        requests: A list of (peer address, (piece, begin, length)).
+        """
+        for peer_addr, (chunk_number, begin, length) in requests:
+            writer = self.stream_writers.get(peer_addr)
+            if writer and not writer.is_closing():
+                writer.write(encode_cancel(chunk_number, begin, length))
+
+    async def notify_requests_released(self):
+        async with self.requests_released:
+            self.requests_released.notify_all()
+
+
+if __name__ == "__main__":
+    peer_ip = "127.0.0.1"  # Replace with the actual peer IP
+    file_path = "dark_knight.txt"  # Replace with the actual file path
+    peer = AsyncPeer(peer_ip, file_path)
+    peer.start()
@@ -0,0 +1,150 @@
+import base64
+
+
+def popcount(value):
+    """
+    Counts the set bits of a non-negative int.
+    """
+    if hasattr(value, "bit_count"):  # Python 3.10+
+        return value.bit_count()
+    return bin(value).count("1")
+
+
+class Bitfield:
+    """
+    A compact set of piece numbers 1..size, one bit per piece, backed by a bytearray.
+    The layout is the BitTorrent one: piece 1 is the most significant bit of the first byte,
+    so to_bytes() is directly usable as a wire encoding.
+
+    It behaves like a set of ints for the operations the peer, tracker and piece manager
+    need (in, add, discard, len, iteration, -, &, |). Set operations between bitfields
+    convert the bytes to Python ints so the work happens in C, a byte at a time.
+    """
+
+    def __init__(self, size, data=None):
+        """
+        PARAMETERS:
+        size: Number of pieces.
+        data: Optional bytes in wire encoding to start from.
+        """
+        self.size = size
+        byte_count = (size + 7) // 8
+        if data is None:
+            self.bits = bytearray(byte_count)
+        else:
+            if len(data) != byte_count:
+                raise ValueError(f"Expected {byte_count} bytes for {size} pieces, got {len(data)}")
+            self.bits = bytearray(data)
+            self._clear_spare_bits()
+        self.count = popcount(int.from_bytes(self.bits, "big"))  # Kept up to date so len() is O(1)
+
+    @classmethod
+    def full(cls, size):
+        """
+        RETURNS:
+        A bitfield with every piece set.
+        """
+        return cls(size, b"\xff" * ((size + 7) // 8))
+
+    @classmethod
+    def from_pieces(cls, size, pieces):
+        bitfield = cls(size)
+        for piece in pieces:
+            bitfield.add(piece)
+        return bitfield
+
+    @classmethod
+    def from_bytes(cls, data, size=None):
+        """
+        Decodes the wire encoding. Without a size, every bit of data counts as a piece.
+        """
+        return cls(len(data) * 8 if size is None else size, data)
+
+    @classmethod
+    def from_base64(cls, text, size=None):
+        return cls.from_bytes(base64.b64decode(text), size)
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def to_base64(self):
+        """
+        RETURNS:
+        The wire encoding as ASCII text, for the line based tracker protocol.
+        """
+        return base64.b64encode(self.bits).decode()
+
+    def add(self, piece):
+        index, mask = self._locate(piece)
+        if not self.bits[index] & mask:
+            self.bits[index] |= mask
+            self.count += 1
+
+    def discard(self, piece):
+        index, mask = self._locate(piece)
+        if self.bits[index] & mask:
+            self.bits[index] &= ~mask & 0xff
+            self.count -= 1
+
+    def is_complete(self):
+        return self.count == self.size
+
+    def __contains__(self, piece):
+        if not 1 <= piece <= self.size:
+            return False
+        index, mask = self._locate(piece)
+        return bool(self.bits[index] & mask)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Whole zero bytes are skipped, so sparse bitfields iterate quickly
+        for index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield index * 8 + bit + 1
+
+    def __sub__(self, other):
+        """
+        Pieces in this bitfield that are not in the other one (AND NOT),
+        e.g. `theirs - mine` is what a peer has that we lack.
+        """
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def __and__(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.size == other.size and self.bits == other.bits
+
+    def __repr__(self):
+        return f"Bitfield({self.count}/{self.size})"
+
+    def copy(self):
+        return Bitfield(self.size, self.bits)
+
+    def _combine(self, other, operation):
+        if not isinstance(other, Bitfield):
+            other = Bitfield.from_pieces(self.size, other)
+        if other.size != self.size:
+            raise ValueError(f"Bitfield sizes differ: {self.size} and {other.size}")
+        mask = (1 << (len(self.bits) * 8)) - 1
+        value = operation(int.from_bytes(self.bits, "big"), int.from_bytes(other.bits, "big")) & mask
+        return Bitfield(self.size, value.to_bytes(len(self.bits), "big"))
+
+    def _locate(self, piece):
+        if not 1 <= piece <= self.size:
+            raise IndexError(f"Piece {piece} is outside 1..{self.size}")
+        offset = piece - 1
+        return offset // 8, 0x80 >> (offset % 8)
+
+    def _clear_spare_bits(self):
+        # Bits after the last piece must stay zero so counts and comparisons are exact
+        spare = len(self.bits) * 8 - self.size
+        if spare:
+            self.bits[-1] &= (0xff << spare) & 0xff
@@ -0,0 +1,115 @@
+import random
+from time import monotonic
+from rate_meter import RateMeter
+
+UPLOAD_SLOTS = 4  # peers we upload to at the same time, one of them the optimistic unchoke
+CHOKE_INTERVAL = 10  # seconds between two choking decisions
+OPTIMISTIC_INTERVAL = 30  # seconds before the optimistic unchoke moves to another peer
+
+
+class PeerRates:
+    """
+    The transfer rates between us and one peer, over RATE_WINDOW seconds.
+    """
+
+    def __init__(self, clock):
+        self.download = RateMeter(clock=clock)  # verified data the peer sent us
+        self.upload = RateMeter(clock=clock)  # data we sent the peer
+
+
+class Choker:
+    """
+    Decides which of the peers downloading from us get their requests served.
+
+    Every CHOKE_INTERVAL the upload slots go to the peers that gave us the most data
+    recently (tit-for-tat), or while we are seeding to the peers that take our data the
+    fastest. One slot is an optimistic unchoke given to a random other peer and rotated
+    every OPTIMISTIC_INTERVAL, so new peers get a chance to prove themselves and we find
+    better partners. Everything else is choked. The choker does no I/O itself, the
+    engines tell the peers about the decisions.
+    """
+
+    def __init__(self, upload_slots=UPLOAD_SLOTS, optimistic_interval=OPTIMISTIC_INTERVAL, clock=monotonic):
+        """
+        PARAMETERS:
+        upload_slots: Number of peers unchoked at the same time, including the optimistic unchoke.
+        optimistic_interval: Seconds an optimistic unchoke lasts.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        """
+        self.upload_slots = upload_slots
+        self.optimistic_interval = optimistic_interval
+        self.clock = clock
+        self.rates = {}  # "ip:port" -> PeerRates, also kept for peers that are not connected to us
+        self.interested = set()  # peers connected to us to download
+        self.unchoked = set()
+        self.optimistic_peer = None
+        self.optimistic_since = None  # time the current optimistic unchoke started
+
+    def peer_rates(self, peer_addr):
+        rates = self.rates.get(peer_addr)
+        if rates is None:
+            rates = self.rates[peer_addr] = PeerRates(self.clock)
+        return rates
+
+    def record_download(self, peer_addr, byte_count):
+        self.peer_rates(peer_addr).download.record(byte_count)
+
+    def record_upload(self, peer_addr, byte_count):
+        self.peer_rates(peer_addr).upload.record(byte_count)
+
+    def add_peer(self, peer_addr):
+        """
+        Registers a peer that connected to download from us. It is unchoked right away
+        while an upload slot is free, otherwise it waits for the next recalculation.
+        RETURNS:
+        True if the peer is unchoked.
+        """
+        self.interested.add(peer_addr)
+        if len(self.unchoked) < self.upload_slots:
+            self.unchoked.add(peer_addr)
+        return peer_addr in self.unchoked
+
+    def remove_peer(self, peer_addr):
+        """
+        Forgets a peer whose connection closed, which frees its upload slot.
+        """
+        self.interested.discard(peer_addr)
+        self.unchoked.discard(peer_addr)
+        if self.optimistic_peer == peer_addr:
+            self.optimistic_peer = None
+
+    def is_unchoked(self, peer_addr):
+        return peer_addr in self.unchoked
+
+    def recalculate(self, seeding=False):
+        """
+        Gives the upload slots to the best peers and rotates the optimistic unchoke when due.
+        PARAMETERS:
+        seeding: True once we have every chunk, peers are then ranked by how fast they download from us.
+        RETURNS:
+        A tuple of (unchoked, choked): the peers that are now unchoked and the ones that are
+        now choked, which must be told.
+        """
+        now = self.clock()
+        if seeding:
+            def rate(peer_addr):
+                return self.peer_rates(peer_addr).upload.rate()
+        else:
+            def rate(peer_addr):
+                return self.peer_rates(peer_addr).download.rate()
+        ranked = sorted(self.interested, key=rate, reverse=True)
+        regular = ranked[:self.upload_slots - 1]
+
+        optimistic_expired = self.optimistic_since is None or now - self.optimistic_since >= self.optimistic_interval
+        if self.optimistic_peer not in self.interested or self.optimistic_peer in regular or optimistic_expired:
+            others = [peer_addr for peer_addr in ranked if peer_addr not in regular]
+            self.optimistic_peer = random.choice(others) if others else None
+            self.optimistic_since = now
+
+        selected = set(regular)
+        if self.optimistic_peer is not None:
+            selected.add(self.optimistic_peer)
+        unchoked = sorted(selected - self.unchoked)
+        choked = sorted(self.unchoked - selected)
+        self.unchoked = selected
+        return unchoked, choked
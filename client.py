@@ -1,79 +1,92 @@
 from peer import Peer
 from torrent_metadata import TorrentMetadata
-from piece_manager import PieceManager
-from hashing import verify_chunk
-import os
+from hashing import verify_chunks
+from peer_protocol import PIPELINE_DEPTH
+from download_scheduler import MAX_BAD_PIECES
+from time import sleep
+import threading
 
 class TorrentClient:
-    def __init__(self, peer_ip, file_path, tracker_url):
+    def __init__(self, peer_ip, metadata_file, output_file=None):
+        """
+        PARAMETERS:
+        peer_ip: The IP address of this client.
+        metadata_file: Path to the metadata (.torrent) file of the download.
+        output_file: Where to store the download, "downloaded_<file name>" by default.
+        """
         self.peer_ip = peer_ip
-        self.file_path = file_path
-        self.tracker_url = tracker_url
-        self.metadata = TorrentMetadata(file_path, tracker_url)
-        self.piece_manager = PieceManager(self.metadata.total_chunks)
-        self.peers = []
+        self.metadata_file = metadata_file
+        self.metadata = TorrentMetadata.load_metadata(metadata_file)
+        self.output_file = output_file or f"downloaded_{self.metadata['file_name']}"
+        self.peer = Peer(peer_ip)  # Talks to the tracker and the other peers, and stores the chunks
+        self.bad_pieces = {}  # peer address -> number of pieces from it that failed verification
 
     def start(self):
         """
-        Starts the client by registering the peer, downloading pieces, and reassembling the file.
+        Starts the client by registering the peer and downloading pieces straight into the output file.
         """
-        # Load metadata and prepare peer
-        self.metadata.load_metadata()
-        peer = Peer(self.peer_ip, self.file_path)
-        self.peers.append(peer)
+        # Load metadata and prepare peer. Pieces already in the output file from an earlier run
+        # are restored from the resume file, only pieces that may have changed are re-hashed.
+        self.peer.load_metadata(self.metadata_file)
+        self.peer.open_storage(self.output_file, self.metadata["total_size"])
+        threading.Thread(target=self.peer.listen_for_requests, daemon=True).start()
+        while self.peer.peer_port is None:
+            sleep(0.1)
+        self.peer.register_with_tracker()
 
         # Start downloading and track progress
-        peer.start()
-        while not self.piece_manager.is_complete():
-            self.download_missing_pieces()
-        self.reassemble_file()
+        while not self.peer.piece_manager.is_complete():
+            if not self.download_missing_pieces():
+                sleep(5)  # Nobody could provide a piece, ask the tracker for new peers
+                self.peer.register_with_tracker()
+        self.peer.save_resume_data()
+        print(f"Download complete. Saved as {self.output_file}")
 
     def download_missing_pieces(self):
         """
-        Requests missing pieces based on rarest-first prioritization.
+        Requests missing pieces from every known peer based on rarest-first prioritization,
+        and verifies each received piece against its hash before it is written.
+        RETURNS:
+        True if at least one piece was downloaded and verified.
         """
-        for peer in self.peers:
-            rarest_piece = self.piece_manager.get_rarest_piece()
-            if rarest_piece:
-                # Request chunk data and expected hash
-                chunk_data, expected_hash = peer.request_chunk_from_peer(rarest_piece)
+        piece_manager = self.peer.piece_manager
+        progress = False
+        for peer_addr, peer_chunks in list(self.peer.tracker_peers.items()):
+            if self.bad_pieces.get(peer_addr, 0) >= MAX_BAD_PIECES:
+                continue  # This peer keeps sending corrupt data
+            wanted = []
+            while len(wanted) < PIPELINE_DEPTH:
+                rarest_piece = piece_manager.get_rarest_piece_from(peer_chunks, exclude=wanted)
+                if rarest_piece is None:
+                    break
+                wanted.append(rarest_piece)
+            if not wanted:
+                continue
 
-                if chunk_data and verify_chunk(chunk_data, expected_hash):
-                    # If verification succeeds, mark the piece as complete
-                    self.piece_manager.mark_piece_complete(rarest_piece)
-                    self.save_chunk_to_disk(chunk_data, rarest_piece)
-                    print(f"Downloaded and verified piece {rarest_piece} successfully")
+            received = [(chunk_number, chunk_data) for chunk_number, chunk_data
+                        in self.peer.request_chunks_from_peer(peer_addr, wanted).items() if chunk_data is not None]
+            if self.peer.merkle_tree is not None:
+                # Every block was proven against the Merkle root as it arrived
+                results = [self.peer.verify_received_chunk(chunk_number, chunk_data)
+                           for chunk_number, chunk_data in received]
+            else:
+                # Hash the whole batch in parallel on the hash pool
+                results = verify_chunks((chunk_data, self.peer.piece_hashes[chunk_number - 1])
+                                        for chunk_number, chunk_data in received)
+            for (chunk_number, chunk_data), valid in zip(received, results):
+                if valid:
+                    self.peer.store_received_chunk(chunk_number, chunk_data, peer_addr)
+                    print(f"Downloaded and verified piece {chunk_number} successfully")
+                    progress = True
                 else:
-                    print(f"Failed to verify piece {rarest_piece}")
-
-    def save_chunk_to_disk(self, chunk_data, chunk_number):
-        """
-        Saves a verified chunk to disk.
-        """
-        chunk_dir = "chunks"
-        if not os.path.exists(chunk_dir):
-            os.makedirs(chunk_dir)
-
-        chunk_path = os.path.join(chunk_dir, f"chunk_{chunk_number}.chunk")
-        with open(chunk_path, 'wb') as chunk_file:
-            chunk_file.write(chunk_data)
-
-    def reassemble_file(self):
-        """
-        Reassembles downloaded pieces into the original file once all pieces are complete.
-        """
-        output_file = f"reassembled_{os.path.basename(self.file_path)}"
-        with open(output_file, 'wb') as final_file:
-            for i in range(1, self.metadata.total_chunks + 1):
-                chunk_path = os.path.join("chunks", f"chunk_{i}.chunk")
-                with open(chunk_path, 'rb') as chunk_file:
-                    final_file.write(chunk_file.read())
-        print(f"File reassembly complete. Saved as {output_file}")
+                    # The piece stays missing and is requested again, from the next peer that has it
+                    print(f"Failed to verify piece {chunk_number} from {peer_addr}")
+                    self.bad_pieces[peer_addr] = self.bad_pieces.get(peer_addr, 0) + 1
+        return progress
 
 if __name__ == "__main__":
     peer_ip = "127.0.0.1"  # Replace with actual IP
-    file_path = "dark_knight.txt"  # Replace with the actual file
-    tracker_url = "http://127.0.0.1:9090/announce"  # Replace with tracker URL
+    metadata_file = "dark_knight.torrent"  # Replace with the metadata file of the download
 
-    client = TorrentClient(peer_ip, file_path, tracker_url)
+    client = TorrentClient(peer_ip, metadata_file)
     client.start()
@@ -0,0 +1,382 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from time import monotonic
+from expiry_queue import ExpiryQueue
+
+# A Kademlia style distributed hash table over UDP, so peers can find each other without a tracker.
+# Node ids and info hashes are 160 bit values written as 40 hex digits, and the distance
+# between two ids is their XOR. Every message is a small JSON object in one datagram:
+#   query:    {"t": transaction id, "y": "q", "q": method, "a": {arguments, "id": sender id}}
+#   response: {"t": transaction id, "y": "r", "r": {results, "id": responder id}}
+#   error:    {"t": transaction id, "y": "e", "e": message}
+# Methods are ping, find_node(target), get_peers(info_hash) and announce_peer(info_hash, port, token).
+ID_BITS = 160
+K = 8  # nodes per bucket, and nodes a lookup converges on
+ALPHA = 3  # queries a lookup keeps in flight at the same time
+RPC_TIMEOUT = 2  # seconds to wait for the answer to a query
+PEER_TTL = 30 * 60  # seconds an announced peer is kept without announcing again
+MAX_PEERS_PER_REPLY = 50  # peers returned by one get_peers answer, keeps datagrams small
+LOOKUP_CACHE_TTL = 5 * 60  # seconds the closest nodes found for a target are reused to start the next lookup
+MAX_TRANSACTION_ID_LENGTH = 32  # characters of a transaction id we accept, ours are 8
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+
+class DHTError(Exception):
+    """
+    Raised when a node answers a query with an error, or sends something that is not a valid message.
+    """
+
+
+def random_node_id():
+    return os.urandom(ID_BITS // 8).hex()
+
+
+def is_node_id(value):
+    """
+    RETURNS:
+    True if value is an id written as ID_BITS // 4 hex digits.
+    """
+    return isinstance(value, str) and len(value) == ID_BITS // 4 and HEX_DIGITS.issuperset(value)
+
+
+def distance(first_id, second_id):
+    """
+    RETURNS:
+    The XOR distance between two ids, as an int.
+    """
+    return int(first_id, 16) ^ int(second_id, 16)
+
+
+class RoutingTable:
+    """
+    The nodes a DHT node knows, in buckets by distance: bucket i holds nodes whose distance
+    to our id has its highest set bit at position i, so we know many nodes close to us and
+    a few far away. Each bucket keeps at most k nodes, least recently seen first. Nodes that
+    do not fit wait in a replacement cache of the same size and take the place of nodes
+    that stop answering.
+    """
+
+    def __init__(self, own_id, k=K):
+        self.own_id = own_id
+        self.k = k
+        self.buckets = {}  # bucket index -> OrderedDict of node id -> (ip, port)
+        self.replacements = {}  # bucket index -> OrderedDict of node id -> (ip, port)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def bucket_index(self, node_id):
+        return distance(self.own_id, node_id).bit_length() - 1
+
+    def add(self, node_id, addr):
+        """
+        Records that a node was seen, e.g. because it sent us a message.
+        """
+        if node_id == self.own_id:
+            return
+        index = self.bucket_index(node_id)
+        bucket = self.buckets.setdefault(index, OrderedDict())
+        if node_id in bucket or len(bucket) < self.k:
+            bucket[node_id] = tuple(addr)
+            bucket.move_to_end(node_id)  # Most recently seen last
+            return
+        replacements = self.replacements.setdefault(index, OrderedDict())
+        replacements[node_id] = tuple(addr)
+        replacements.move_to_end(node_id)
+        if len(replacements) > self.k:
+            replacements.popitem(last=False)
+
+    def remove(self, node_id):
+        """
+        Drops a node that stopped answering, promoting the most recently seen replacement.
+        """
+        index = self.bucket_index(node_id)
+        bucket = self.buckets.get(index)
+        if bucket is None or node_id not in bucket:
+            return
+        del bucket[node_id]
+        replacements = self.replacements.get(index)
+        if replacements:
+            replacement_id, addr = replacements.popitem(last=True)
+            bucket[replacement_id] = addr
+
+    def closest(self, target, count=K):
+        """
+        RETURNS:
+        Up to count (node id, (ip, port)) pairs, closest to the target first.
+        """
+        nodes = [item for bucket in self.buckets.values() for item in bucket.items()]
+        nodes.sort(key=lambda item: distance(item[0], target))
+        return nodes[:count]
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    """
+    One node of the DHT. It answers the queries of other nodes, stores the peers announced
+    for the info hashes close to its id, and runs iterative lookups: the closest known
+    nodes are asked, ALPHA at a time, for nodes even closer to the target, until the K
+    closest nodes found have all answered.
+    """
+
+    def __init__(self, node_id=None, clock=monotonic):
+        """
+        PARAMETERS:
+        node_id: Our id as 40 hex digits, random by default.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        """
+        self.node_id = node_id or random_node_id()
+        self.clock = clock
+        self.routing = RoutingTable(self.node_id)
+        self.transport = None
+        self.address = None  # (ip, port) we listen on
+        self.pending = {}  # transaction id -> Future of the answer
+        self.peers = {}  # info hash -> set of "ip:port" announced for it
+        self.peer_expiry = ExpiryQueue()  # (info hash, "ip:port") -> time the announce runs out
+        self.secret = os.urandom(16)  # Tokens prove a node asked get_peers from its own address before announcing
+        self.lookup_cache = {}  # target -> (time, [(node id, (ip, port))]) of the closest nodes last found
+
+    async def listen(self, host="0.0.0.0", port=0):
+        """
+        Opens the UDP socket.
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        self.address = self.transport.get_extra_info('sockname')[:2]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        for future in self.pending.values():
+            future.cancel()
+
+    # Incoming messages
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data)
+            kind = message["y"]
+            transaction_id = message["t"]
+        except (ValueError, KeyError, TypeError):
+            return  # Not one of our messages
+        if not isinstance(transaction_id, str) or len(transaction_id) > MAX_TRANSACTION_ID_LENGTH:
+            return  # Could not be answered or matched to a query
+        if kind == "q":
+            self.handle_query(message, addr)
+            return
+        future = self.pending.pop(transaction_id, None)
+        if future is None or future.done():
+            return  # Late answer to a query that already timed out
+        if kind == "r" and isinstance(message.get("r"), dict) and is_node_id(message["r"].get("id")):
+            self.routing.add(message["r"]["id"], addr)
+            future.set_result(message["r"])
+        else:
+            future.set_exception(DHTError(message.get("e", "Malformed response")))
+
+    def handle_query(self, message, addr):
+        handlers = {
+            "ping": self.on_ping,
+            "find_node": self.on_find_node,
+            "get_peers": self.on_get_peers,
+            "announce_peer": self.on_announce_peer,
+        }
+        try:
+            arguments = message["a"]
+            if not is_node_id(arguments["id"]):
+                raise DHTError("Bad node id")
+            self.routing.add(arguments["id"], addr)
+            result = handlers[message["q"]](arguments, addr)
+        except (KeyError, TypeError, ValueError, DHTError) as e:
+            self.send(addr, {"t": message.get("t"), "y": "e", "e": f"Invalid query: {e!r}"})
+            return
+        result["id"] = self.node_id
+        self.send(addr, {"t": message["t"], "y": "r", "r": result})
+
+    def on_ping(self, arguments, addr):
+        return {}
+
+    def on_find_node(self, arguments, addr):
+        return {"nodes": self.encode_nodes(self.routing.closest(arguments["target"]))}
+
+    def on_get_peers(self, arguments, addr):
+        info_hash = arguments["info_hash"]
+        self.expire_peers()
+        peers = list(self.peers.get(info_hash, ()))[:MAX_PEERS_PER_REPLY]
+        return {"token": self.token(addr[0]), "peers": peers,
+                "nodes": self.encode_nodes(self.routing.closest(info_hash))}
+
+    def on_announce_peer(self, arguments, addr):
+        if arguments["token"] != self.token(addr[0]):
+            raise DHTError("Bad token")
+        info_hash = arguments["info_hash"]
+        distance(info_hash, self.node_id)  # Rejects anything that is not a hex id
+        peer_addr = f"{addr[0]}:{int(arguments['port'])}"
+        self.peers.setdefault(info_hash, set()).add(peer_addr)
+        self.peer_expiry.touch((info_hash, peer_addr), self.clock() + PEER_TTL)
+        return {}
+
+    def expire_peers(self):
+        for info_hash, peer_addr in self.peer_expiry.pop_expired(self.clock()):
+            peers = self.peers.get(info_hash)
+            if peers is not None:
+                peers.discard(peer_addr)
+                if not peers:
+                    del self.peers[info_hash]
+
+    def token(self, ip):
+        return hashlib.sha1(self.secret + ip.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def encode_nodes(nodes):
+        return [[node_id, addr[0], addr[1]] for node_id, addr in nodes]
+
+    # Outgoing queries
+
+    def send(self, addr, message):
+        self.transport.sendto(json.dumps(message).encode(), addr)
+
+    async def query(self, addr, method, arguments):
+        """
+        Sends a query and waits for the answer.
+        RETURNS:
+        The result dictionary of the response.
+        """
+        transaction_id = os.urandom(4).hex()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        self.send(tuple(addr), {"t": transaction_id, "y": "q", "q": method, "a": dict(arguments, id=self.node_id)})
+        try:
+            return await asyncio.wait_for(future, RPC_TIMEOUT)
+        finally:
+            self.pending.pop(transaction_id, None)
+
+    async def query_node(self, node_id, addr, method, arguments):
+        """
+        Queries a known node. Nodes that do not answer are dropped from the routing table.
+        RETURNS:
+        The result dictionary, or None if the node did not answer properly.
+        """
+        try:
+            return await self.query(addr, method, arguments)
+        except (asyncio.TimeoutError, DHTError, OSError):
+            self.routing.remove(node_id)
+            return None
+
+    async def lookup(self, target, method="find_node"):
+        """
+        Iterative lookup of the nodes closest to a target.
+        PARAMETERS:
+        target: The id or info hash to look up.
+        method: "find_node", or "get_peers" to also collect peers and announce tokens.
+        RETURNS:
+        A tuple of (nodes, peers): up to K (node id, (ip, port), token) tuples of the closest
+        nodes that answered, closest first, and the set of peers they returned.
+        """
+        argument = "target" if method == "find_node" else "info_hash"
+        shortlist = dict(self.routing.closest(target))  # node id -> (ip, port) of every candidate
+        cached = self.lookup_cache.get(target)
+        if cached and self.clock() - cached[0] < LOOKUP_CACHE_TTL:
+            shortlist.update(cached[1])  # Start from where the last lookup of this target ended
+        shortlist.pop(self.node_id, None)
+        queried = set()
+        answered = {}  # node id -> token it handed out
+        peers = set()
+
+        while True:
+            closest = sorted(shortlist, key=lambda node_id: distance(node_id, target))[:K]
+            to_query = [node_id for node_id in closest if node_id not in queried][:ALPHA]
+            if not to_query:
+                break  # The K closest candidates have all been asked
+            queried.update(to_query)
+            results = await asyncio.gather(*(
+                self.query_node(node_id, shortlist[node_id], method, {argument: target}) for node_id in to_query
+            ))
+            for node_id, result in zip(to_query, results):
+                if result is None:
+                    shortlist.pop(node_id, None)
+                    continue
+                answered[node_id] = result.get("token")
+                for node in result.get("nodes", []):
+                    if isinstance(node, list) and len(node) == 3 and is_node_id(node[0]) and node[0] != self.node_id:
+                        shortlist.setdefault(node[0], (node[1], node[2]))
+                peers.update(result.get("peers", []))
+
+        nodes = sorted(answered, key=lambda node_id: distance(node_id, target))[:K]
+        self.lookup_cache[target] = (self.clock(), [(node_id, shortlist[node_id]) for node_id in nodes])
+        return [(node_id, shortlist[node_id], answered[node_id]) for node_id in nodes], peers
+
+    async def bootstrap(self, addresses):
+        """
+        Joins the DHT through known nodes, then looks up our own id to fill the routing table.
+        PARAMETERS:
+        addresses: List of (ip, port) of nodes already in the DHT.
+        """
+        async def ping(addr):
+            try:
+                await self.query(addr, "ping", {})
+            except (asyncio.TimeoutError, DHTError, OSError):
+                print(f"DHT bootstrap node {addr[0]}:{addr[1]} did not answer")
+        await asyncio.gather(*(ping(addr) for addr in addresses))
+        await self.lookup(self.node_id)
+
+    async def find_node(self, target):
+        nodes, _ = await self.lookup(target)
+        return [(node_id, addr) for node_id, addr, _ in nodes]
+
+    async def get_peers(self, info_hash):
+        """
+        RETURNS:
+        The set of "ip:port" announced for an info hash.
+        """
+        _, peers = await self.lookup(info_hash, "get_peers")
+        return peers
+
+    async def announce_peer(self, info_hash, port):
+        """
+        Announces that we accept connections for a torrent on a TCP port, to the K nodes
+        closest to its info hash.
+        RETURNS:
+        The set of peers already announced for the info hash, as get_peers.
+        """
+        nodes, peers = await self.lookup(info_hash, "get_peers")
+        await asyncio.gather(*(
+            self.query_node(node_id, addr, "announce_peer", {"info_hash": info_hash, "port": port, "token": token})
+            for node_id, addr, token in nodes if token
+        ))
+        return peers
+
+
+class ThreadedDHT:
+    """
+    Runs a DHTNode on its own event loop in a background thread, with blocking methods
+    for the threaded Peer.
+    """
+
+    def __init__(self, host="0.0.0.0", port=0):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.node = DHTNode()
+        self.call(self.node.listen(host, port))
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @property
+    def address(self):
+        return self.node.address
+
+    def bootstrap(self, addresses):
+        self.call(self.node.bootstrap(addresses))
+
+    def get_peers(self, info_hash):
+        return self.call(self.node.get_peers(info_hash))
+
+    def announce_peer(self, info_hash, port):
+        return self.call(self.node.announce_peer(info_hash, port))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.node.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
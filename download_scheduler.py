@@ -0,0 +1,450 @@
+import math
+import bisect
+from collections import defaultdict
+from time import monotonic
+from rate_meter import RateMeter
+from file_chunker import CHUNK_SIZE
+from peer_protocol import BLOCK_SIZE
+
+MAX_IN_FLIGHT = 256  # block requests outstanding across all peers at the same time
+REQUEST_TIMEOUT = 10  # seconds before an unanswered request is handed to another peer
+MIN_WINDOW = 4  # block requests outstanding per peer before its rate is known
+MAX_WINDOW = 128  # upper bound on the block requests outstanding to one peer
+TARGET_LATENCY = 2  # seconds of data we want queued at each peer
+MAX_BAD_PIECES = 3  # pieces failing verification before a peer is no longer downloaded from
+ENDGAME_COPIES = 3  # peers a block is requested from at the same time in endgame mode
+
+
+class PeerDownloadState:
+    """
+    What the scheduler knows about one peer we download from.
+    """
+
+    def __init__(self, clock):
+        self.rate_meter = RateMeter(clock=clock)
+        self.window = MIN_WINDOW  # How many block requests may be outstanding to this peer
+        self.in_flight = {}  # (piece, begin) -> time the request was sent
+
+
+class PartialPiece:
+    """
+    A piece whose blocks are being downloaded, possibly from several peers at once.
+    The blocks are assembled in memory until the piece can be verified as a whole.
+    """
+
+    def __init__(self, length, block_size):
+        self.length = length
+        self.block_size = block_size
+        self.data = bytearray(length)
+        self.unrequested = list(range(0, length, block_size))  # Offsets of the blocks nobody was asked for, sorted
+        self.received = set()  # Offsets of the blocks that arrived
+        self.block_count = len(self.unrequested)
+        self.contributors = defaultdict(int)  # peer address -> bytes of this piece it sent
+        self.owner = None  # The only peer its blocks may be requested from, for pieces that must come from one peer
+
+    def block_length(self, begin):
+        return min(self.block_size, self.length - begin)
+
+    def is_block(self, begin, length):
+        return begin % self.block_size == 0 and 0 <= begin < self.length and length == self.block_length(begin)
+
+    def put_back(self, begin):
+        """
+        Makes a block available for requesting again, unless it already arrived.
+        """
+        if begin not in self.received:
+            index = bisect.bisect_left(self.unrequested, begin)
+            if index == len(self.unrequested) or self.unrequested[index] != begin:
+                self.unrequested.insert(index, begin)
+
+    def store(self, begin, data, peer_addr):
+        self.data[begin:begin + len(data)] = data
+        self.received.add(begin)
+        self.contributors[peer_addr] += len(data)
+        index = bisect.bisect_left(self.unrequested, begin)
+        if index < len(self.unrequested) and self.unrequested[index] == begin:
+            del self.unrequested[index]  # It came from a request that was released meanwhile
+
+    def is_complete(self):
+        return len(self.received) == self.block_count
+
+
+class DownloadScheduler:
+    """
+    Decides which blocks to request from which peer so that many requests are in flight
+    across the whole swarm. It does no I/O itself: the peer engines ask it what to request
+    and report back what arrived, failed or timed out.
+
+    Pieces are requested in blocks of BLOCK_SIZE bytes, so the blocks of one piece can come
+    from several peers in parallel. Pieces that were started are finished first, new pieces
+    are picked rarest first, after the priority window of a streaming reader if there is one. Each peer gets a request window sized from its measured
+    throughput: fast peers get more outstanding requests, peers that time out get fewer.
+
+    Once every missing piece has been started, the download is in endgame mode: idle peers
+    also request blocks that are in flight elsewhere, up to ENDGAME_COPIES peers per block,
+    and the engines cancel the other copies when the first one arrives. The last blocks then
+    no longer wait for the slowest peer.
+
+    A piece that fails verification with blocks from several peers blames nobody, it is
+    downloaded again from a single peer, which tells whether that peer is the culprit.
+    """
+
+    def __init__(self, piece_manager, piece_size=CHUNK_SIZE, max_in_flight=MAX_IN_FLIGHT,
+                 request_timeout=REQUEST_TIMEOUT, clock=monotonic, block_size=BLOCK_SIZE, piece_length=None):
+        """
+        PARAMETERS:
+        piece_manager: The PieceManager that picks the rarest missing pieces.
+        piece_size: Size of a piece in bytes.
+        max_in_flight: Global limit of outstanding block requests across all peers.
+        request_timeout: Seconds after which an unanswered request is retried elsewhere.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        block_size: Size of a block request in bytes.
+        piece_length: Function returning the length of a piece, e.g. for a shorter last piece.
+                      Every piece is piece_size bytes by default.
+        """
+        self.piece_manager = piece_manager
+        self.piece_size = piece_size
+        self.block_size = min(block_size, piece_size)
+        self.piece_length = piece_length or (lambda piece: piece_size)
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.clock = clock
+        self.peers = {}  # peer address -> PeerDownloadState
+        self.partial = {}  # piece number -> PartialPiece of the pieces being downloaded
+        self.in_flight = {}  # (piece, begin) -> set of the peers the block was requested from
+        self.verifying = {}  # piece number -> {peer address: bytes} of the peers whose data is being hashed
+        self.failed = defaultdict(set)  # peer address -> pieces that should not be requested from it again
+        self.bad_pieces = defaultdict(int)  # peer address -> number of pieces from it that failed verification
+        self.single_source = set()  # pieces that failed with blocks from several peers, retried from one peer
+        self.choked = {}  # peer address -> time it choked us, nothing is requested from it until it unchokes
+        self.rate_meter = RateMeter(clock=clock)  # Aggregate download rate
+
+    def add_peer(self, peer_addr):
+        if peer_addr not in self.peers:
+            self.peers[peer_addr] = PeerDownloadState(self.clock)
+
+    def release_peer(self, peer_addr):
+        """
+        Releases the outstanding requests of a peer whose connection ended, so that the
+        other peers can pick them up. Its rate history is kept for reporting.
+        RETURNS:
+        The (piece, begin, length) blocks that were outstanding to this peer.
+        """
+        state = self.peers.get(peer_addr)
+        if state is None:
+            return []
+        released = [self.block_request(piece, begin) for piece, begin in state.in_flight]
+        for piece, begin in list(state.in_flight):
+            self.release_block(peer_addr, piece, begin)
+        for piece, partial in list(self.partial.items()):
+            if partial.owner == peer_addr:
+                self.abandon_piece(piece)
+        return released
+
+    def abandon_piece(self, piece):
+        """
+        Throws away the blocks of a single-source piece whose peer gave up on it, so that
+        another peer can download it from the start.
+        """
+        del self.partial[piece]
+        for (block_piece, begin), peers in list(self.in_flight.items()):
+            if block_piece == piece:
+                for peer_addr in peers:
+                    self.peers[peer_addr].in_flight.pop((piece, begin), None)
+                del self.in_flight[(piece, begin)]
+
+    def next_requests(self, peer_addr, peer_chunks):
+        """
+        Picks the blocks to request from a peer right now without exceeding the peer's
+        window or the global in-flight limit: blocks of pieces already started first, then
+        the blocks of the rarest missing pieces, then in endgame mode blocks in flight elsewhere.
+        PARAMETERS:
+        peer_addr: The address of the peer.
+        peer_chunks: The chunk numbers that the peer has.
+        RETURNS:
+        A list of (piece, begin, length) blocks, already recorded as in flight.
+        """
+        self.add_peer(peer_addr)
+        state = self.peers[peer_addr]
+        if self.is_banned(peer_addr) or peer_addr in self.choked:
+            return []
+        failed = self.failed.get(peer_addr, ())
+        requests = []
+        now = self.clock()
+
+        def has_room():
+            return len(state.in_flight) < state.window and len(self.in_flight) < self.max_in_flight
+
+        def request(piece, begin):
+            state.in_flight[(piece, begin)] = now
+            self.in_flight.setdefault((piece, begin), set()).add(peer_addr)
+            requests.append(self.block_request(piece, begin))
+
+        started = self.partial.items()
+        window = self.piece_manager.priority_window
+        if window:
+            # The blocks a streaming reader waits for go out before those of other started pieces
+            started = sorted(started, key=lambda item: item[0] not in window)
+        for piece, partial in started:
+            if not has_room():
+                break
+            if partial.unrequested and partial.owner in (None, peer_addr) and piece not in failed \
+                    and piece in peer_chunks:
+                while partial.unrequested and has_room():
+                    request(piece, partial.unrequested.pop(0))
+
+        if has_room():
+            excluded = set(self.partial)
+            excluded.update(self.verifying)
+            excluded.update(failed)
+            while has_room():
+                piece = self.piece_manager.get_rarest_piece_from(peer_chunks, exclude=excluded)
+                if piece is None:
+                    break
+                excluded.add(piece)
+                partial = self.partial[piece] = PartialPiece(self.piece_length(piece), self.block_size)
+                if piece in self.single_source:
+                    partial.owner = peer_addr
+                while partial.unrequested and has_room():
+                    request(piece, partial.unrequested.pop(0))
+
+        if has_room() and self.in_endgame():
+            for (piece, begin), peers in list(self.in_flight.items()):
+                if not has_room():
+                    break
+                if peer_addr not in peers and len(peers) < ENDGAME_COPIES and piece not in failed \
+                        and piece in peer_chunks and self.partial[piece].owner is None:
+                    request(piece, begin)
+        return requests
+
+    def in_endgame(self):
+        """
+        Checks whether every wanted missing piece has been started and no block is left unrequested.
+        """
+        if self.piece_manager.missing_wanted > len(self.partial) + len(self.verifying):
+            return False
+        return not any(partial.unrequested for partial in self.partial.values())
+
+    def block_request(self, piece, begin):
+        partial = self.partial.get(piece)
+        length = partial.block_length(begin) if partial else min(self.block_size, self.piece_length(piece) - begin)
+        return piece, begin, length
+
+    def release_block(self, peer_addr, piece, begin):
+        """
+        Forgets the request of a block to a peer. If no other peer was asked for it, the
+        block can be requested again.
+        """
+        state = self.peers.get(peer_addr)
+        if state is not None:
+            state.in_flight.pop((piece, begin), None)
+        peers = self.in_flight.get((piece, begin))
+        if peers is not None:
+            peers.discard(peer_addr)
+            if not peers:
+                del self.in_flight[(piece, begin)]
+                partial = self.partial.get(piece)
+                if partial is not None:
+                    partial.put_back(begin)
+
+    def on_block_received(self, peer_addr, piece, begin, data):
+        """
+        Records a block that arrived and grows the peer's window from its measured rate.
+        A piece whose blocks have all arrived is handed out for verification, the engine
+        reports the outcome with on_piece_verified or on_piece_corrupt, and the piece is not
+        requested again meanwhile.
+        PARAMETERS:
+        peer_addr: The peer the block came from.
+        piece: The piece number.
+        begin: Offset of the block inside the piece.
+        data: The block data.
+        RETURNS:
+        A tuple of (piece_data, duplicates). piece_data is the assembled piece if this block
+        completed it, None otherwise. duplicates lists (peer address, (piece, begin, length))
+        requests of the same block to other peers, which should be cancelled.
+        """
+        self.rate_meter.record(len(data))
+        state = self.peers.get(peer_addr)
+        if state is not None:
+            state.rate_meter.record(len(data))
+            # Enough requests to cover TARGET_LATENCY seconds of transfer at the peer's current rate
+            wanted = math.ceil(state.rate_meter.rate() * TARGET_LATENCY / self.block_size)
+            state.window = max(MIN_WINDOW, min(MAX_WINDOW, wanted))
+
+        partial = self.partial.get(piece)
+        if partial is None or begin in partial.received or not partial.is_block(begin, len(data)):
+            self.release_block(peer_addr, piece, begin)
+            return None, []  # A late duplicate, or not a block we asked for
+        other_peers = self.in_flight.get((piece, begin), set()) - {peer_addr}
+        for other_peer in other_peers:
+            self.peers[other_peer].in_flight.pop((piece, begin), None)
+        self.in_flight.pop((piece, begin), None)
+        if state is not None:
+            state.in_flight.pop((piece, begin), None)
+        partial.store(begin, data, peer_addr)
+        duplicates = [(other_peer, (piece, begin, len(data))) for other_peer in sorted(other_peers)]
+
+        if not partial.is_complete():
+            return None, duplicates
+        del self.partial[piece]
+        self.verifying[piece] = dict(partial.contributors)
+        return bytes(partial.data), duplicates
+
+    def on_piece_verified(self, piece):
+        """
+        Records that the data of an assembled piece matched its hash.
+        RETURNS:
+        A dictionary mapping each peer that sent blocks of the piece to the bytes it sent.
+        """
+        self.single_source.discard(piece)
+        return self.verifying.pop(piece, {})
+
+    def on_verification_error(self, piece):
+        """
+        Records that an assembled piece could not be verified at all, e.g. because reading
+        local data failed. Nobody is blamed, the piece simply goes back to the pool.
+        """
+        self.verifying.pop(piece, None)
+
+    def on_piece_corrupt(self, piece):
+        """
+        Records that an assembled piece failed verification. It goes back to the pool.
+        If all of it came from one peer, that peer is to blame: the piece is not requested
+        from it again, and a peer that keeps sending bad pieces is banned. If several peers
+        sent blocks, the culprit is unknown, so the piece is downloaded again from a single
+        peer, which settles it without banning the honest peers.
+        RETURNS:
+        The peers that are now banned.
+        """
+        contributors = self.verifying.pop(piece, {})
+        if len(contributors) != 1:
+            self.single_source.add(piece)
+            return []
+        (peer_addr,) = contributors
+        self.failed[peer_addr].add(piece)
+        self.bad_pieces[peer_addr] += 1
+        return [peer_addr] if self.bad_pieces[peer_addr] == MAX_BAD_PIECES else []
+
+    def on_block_corrupt(self, peer_addr, block):
+        """
+        Records that a block failed its Merkle proof. The culprit is known for sure, so only
+        this block goes back to the pool and the piece is not requested from the peer again.
+        PARAMETERS:
+        block: The (piece, begin, length) request.
+        RETURNS:
+        The peers that are now banned.
+        """
+        self.on_request_failed(peer_addr, block)
+        self.bad_pieces[peer_addr] += 1
+        return [peer_addr] if self.bad_pieces[peer_addr] == MAX_BAD_PIECES else []
+
+    def is_banned(self, peer_addr):
+        """
+        Checks whether a peer sent too many pieces that failed verification to be used again.
+        """
+        return self.bad_pieces.get(peer_addr, 0) >= MAX_BAD_PIECES
+
+    def on_choked(self, peer_addr):
+        """
+        Records that a peer choked us. It rejects what we asked for, so the outstanding
+        requests go back to the pool without counting as failures.
+        RETURNS:
+        The blocks that were outstanding to this peer.
+        """
+        self.choked.setdefault(peer_addr, self.clock())
+        return self.release_peer(peer_addr)
+
+    def on_unchoked(self, peer_addr):
+        self.choked.pop(peer_addr, None)
+
+    def choked_for(self, peer_addr):
+        """
+        RETURNS:
+        Seconds since the peer choked us, None if it is not choking us.
+        """
+        choked_at = self.choked.get(peer_addr)
+        return None if choked_at is None else self.clock() - choked_at
+
+    def on_request_failed(self, peer_addr, block):
+        """
+        Records that a peer could not deliver a block. The block goes back to the pool
+        and its piece will not be requested from the same peer again.
+        PARAMETERS:
+        block: The (piece, begin, length) request.
+        """
+        piece, begin, _ = block
+        self.failed[peer_addr].add(piece)
+        self.release_block(peer_addr, piece, begin)
+        partial = self.partial.get(piece)
+        if partial is not None and partial.owner == peer_addr:
+            self.abandon_piece(piece)
+
+    def expire_requests(self):
+        """
+        Releases every request that has been outstanding for longer than the timeout,
+        so that other peers can retry it, and halves the window of the slow peers.
+        RETURNS:
+        A list of (peer address, (piece, begin, length)) requests that timed out.
+        """
+        deadline = self.clock() - self.request_timeout
+        expired = []
+        for peer_addr, state in self.peers.items():
+            timed_out = [block for block, sent_at in state.in_flight.items() if sent_at < deadline]
+            if timed_out:
+                state.window = max(MIN_WINDOW, state.window // 2)
+            for piece, begin in timed_out:
+                block = self.block_request(piece, begin)
+                self.on_request_failed(peer_addr, block)
+                expired.append((peer_addr, block))
+        return expired
+
+    def next_expiry(self):
+        """
+        RETURNS:
+        Seconds until the oldest outstanding request of any peer times out, None if nothing is in flight.
+        """
+        # Requests are added to a peer's in_flight in the order they are sent, its first one is its oldest
+        oldest = [next(iter(state.in_flight.values())) for state in self.peers.values() if state.in_flight]
+        if not oldest:
+            return None
+        return max(0.0, min(oldest) + self.request_timeout - self.clock())
+
+    def has_wanted_pieces(self, peer_addr, peer_chunks):
+        """
+        Checks whether a peer has missing pieces it could still deliver, including the ones
+        currently requested from other peers or being verified, which may come back if those fail.
+        """
+        if self.is_banned(peer_addr):
+            return False
+        excluded = self.failed.get(peer_addr, ())
+        return self.piece_manager.get_rarest_piece_from(peer_chunks, exclude=excluded) is not None
+
+    def reset_failures(self):
+        """
+        Allows pieces to be requested again from peers that failed them before,
+        e.g. when a new round of downloads starts after refreshing the peer list.
+        Banned peers stay banned.
+        """
+        self.failed.clear()
+
+    def outstanding(self, peer_addr):
+        """
+        RETURNS:
+        The (piece, begin) blocks currently requested from a peer.
+        """
+        state = self.peers.get(peer_addr)
+        return list(state.in_flight) if state else []
+
+    def download_rate(self):
+        """
+        RETURNS:
+        The aggregate download rate across all peers in bytes per second.
+        """
+        return self.rate_meter.rate()
+
+    def peer_rates(self):
+        """
+        RETURNS:
+        A dictionary mapping each peer address to its download rate in bytes per second.
+        """
+        return {peer_addr: state.rate_meter.rate() for peer_addr, state in self.peers.items()}
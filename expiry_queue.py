@@ -0,0 +1,57 @@
+import heapq
+
+
+class ExpiryQueue:
+    """
+    Deadlines for a set of keys, e.g. the time-to-live of every peer known to the tracker.
+
+    Deadlines are kept in a heap, so finding what expired costs O(log n) per expired key
+    instead of a scan over every key. Refreshing a key pushes a new entry and leaves the
+    old one in the heap: it is recognised as stale and skipped when it reaches the top.
+    """
+
+    def __init__(self):
+        self.heap = []  # (deadline, key) entries, some of them stale
+        self.deadlines = {}  # key -> its current deadline
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def touch(self, key, deadline):
+        """
+        Sets or moves the deadline of a key.
+        """
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+    def discard(self, key):
+        """
+        Forgets a key, its heap entry becomes stale.
+        """
+        self.deadlines.pop(key, None)
+
+    def pop_expired(self, now):
+        """
+        Removes every key whose deadline is at or before now.
+        RETURNS:
+        The expired keys, earliest deadline first.
+        """
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+    def next_deadline(self):
+        """
+        RETURNS:
+        The earliest current deadline, None if there are no keys.
+        """
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)  # Stale entry of a key that was refreshed or discarded
+        return self.heap[0][0] if self.heap else None
@@ -0,0 +1,166 @@
+import os
+import json
+import threading
+from time import monotonic
+from bitfield import Bitfield
+from hashing import recheck_file, file_paths
+
+RESUME_SUFFIX = ".resume"  # the resume file lives next to the data file
+JOURNAL_SUFFIX = ".journal"  # pieces written since the last save, appended to the resume file's path
+RESUME_SAVE_INTERVAL = 5  # seconds between two saves while a download is running
+
+
+class FastResume:
+    """
+    Persists which pieces of a data file have been verified, so a restarted peer does not
+    have to download or re-hash them again.
+
+    The resume file records the verified bitfield together with the size and modification
+    time of the data file when it was saved. Every piece is also appended to a journal
+    before it is written, and the journal is emptied by the next save, so it lists the
+    pieces written since. On restart:
+    -> unchanged size and mtime: the bitfield is trusted as is, nothing is hashed.
+    -> newer mtime with pieces in the journal: the peer was killed while downloading. Only
+       the journal's pieces are re-hashed, the bitfield is trusted for the others.
+    -> anything else (no resume file, other size or piece layout, newer mtime with an
+       empty journal): every piece is re-hashed. The file changed while no peer wrote it,
+       e.g. someone edited or partially copied it, which can corrupt exactly the pieces
+       the resume file lists as verified.
+    """
+
+    def __init__(self, data_path, piece_size, piece_count, resume_path=None, files=None):
+        """
+        PARAMETERS:
+        data_path: Path of the data file the pieces are stored in, or of the directory of a multi-file torrent.
+        piece_size: Size of a piece in bytes.
+        piece_count: Number of pieces in the file.
+        resume_path: Where to keep the resume file, next to the data file by default.
+        files: (relative path, size) of the files inside the directory, None for a single file.
+        """
+        self.data_path = data_path
+        self.piece_size = piece_size
+        self.piece_count = piece_count
+        self.files = files
+        self.resume_path = resume_path or data_path + RESUME_SUFFIX
+        self.journal_path = self.resume_path + JOURNAL_SUFFIX
+        self.last_save = None  # monotonic time of the last save
+        self.written = set()  # Pieces in the journal, written since the last save
+        self.journal_lock = threading.Lock()  # Pieces are written by several download workers
+
+    def record_write(self, piece):
+        """
+        Appends a piece to the journal. Must be called before the piece is written, so a
+        peer killed in the middle of the write still knows to re-hash it.
+        PARAMETERS:
+        piece: The piece number about to be written.
+        """
+        with self.journal_lock:
+            if piece not in self.written:
+                self.written.add(piece)
+                with open(self.journal_path, 'a') as journal:
+                    journal.write(f"{piece}\n")
+
+    def save(self, verified):
+        """
+        Writes the resume file. The data file must be flushed first so that its mtime
+        covers every piece in the bitfield.
+        PARAMETERS:
+        verified: Bitfield of the pieces that are complete and verified.
+        """
+        file_size, mtime_ns = self.data_stat()
+        state = {
+            "file_size": file_size,
+            "mtime_ns": mtime_ns,
+            "piece_size": self.piece_size,
+            "piece_count": self.piece_count,
+            "verified": verified.to_base64(),
+        }
+        # Write to a temporary file and rename it, so a crash never leaves a half-written resume file
+        temporary_path = self.resume_path + ".tmp"
+        with open(temporary_path, 'w') as resume_file:
+            json.dump(state, resume_file)
+        with self.journal_lock:
+            os.replace(temporary_path, self.resume_path)
+            # Pieces still being written or verified stay in the journal
+            self.written = {piece for piece in self.written if piece not in verified}
+            with open(self.journal_path, 'w') as journal:
+                journal.writelines(f"{piece}\n" for piece in sorted(self.written))
+        self.last_save = monotonic()
+
+    def save_if_due(self, verified, flush):
+        """
+        Saves the resume file if the last save is older than RESUME_SAVE_INTERVAL.
+        PARAMETERS:
+        verified: Bitfield of the pieces that are complete and verified.
+        flush: Function that flushes the data file to disk before saving.
+        """
+        if self.last_save is None or monotonic() - self.last_save >= RESUME_SAVE_INTERVAL:
+            flush()
+            self.save(verified)
+
+    def load(self):
+        """
+        Reads the resume file and decides which pieces need to be re-hashed.
+        RETURNS:
+        A tuple of (trusted, to_recheck): the Bitfield of pieces that are known to be valid
+        and the list of pieces whose data may have changed since the last save.
+        """
+        everything = list(range(1, self.piece_count + 1))
+        try:
+            with open(self.resume_path, 'r') as resume_file:
+                state = json.load(resume_file)
+            file_size, mtime_ns = self.data_stat()
+            if (state["piece_size"], state["piece_count"], state["file_size"]) != \
+                    (self.piece_size, self.piece_count, file_size):
+                return Bitfield(self.piece_count), everything
+            trusted = Bitfield.from_base64(state["verified"], self.piece_count)
+        except (OSError, ValueError, KeyError):
+            # No resume file, or one we cannot read: fall back to a full recheck
+            return Bitfield(self.piece_count), everything
+
+        if mtime_ns == state["mtime_ns"]:
+            return trusted, []
+        written = self.read_journal()
+        if not written:
+            return Bitfield(self.piece_count), everything
+        for piece in written:
+            trusted.discard(piece)
+        return trusted, sorted(written)
+
+    def read_journal(self):
+        """
+        RETURNS:
+        The set of pieces written since the last save, empty without a readable journal.
+        """
+        try:
+            with open(self.journal_path, 'r') as journal:
+                pieces = {int(line) for line in journal if line.strip()}
+        except (OSError, ValueError):
+            return set()
+        return {piece for piece in pieces if 1 <= piece <= self.piece_count}
+
+    def restore(self, expected_hashes=None):
+        """
+        Loads the resume file and re-hashes, in parallel, the pieces it cannot vouch for:
+        the ones written since the last save, or every piece if the file changed otherwise.
+        PARAMETERS:
+        expected_hashes: Expected hex hashes of all pieces. Without them, pieces that would
+        need a recheck are simply treated as missing.
+        RETURNS:
+        The Bitfield of verified pieces.
+        """
+        verified, to_recheck = self.load()
+        if to_recheck and expected_hashes:
+            print(f"Re-hashing {len(to_recheck)} pieces of {self.data_path}")
+            verified = verified | recheck_file(self.data_path, self.piece_size, expected_hashes, to_recheck,
+                                               self.files)
+        return verified
+
+    def data_stat(self):
+        """
+        RETURNS:
+        A tuple of (size, modification time in ns) of the data. For a multi-file torrent,
+        the total size of its files and the time the last of them was modified.
+        """
+        stats = [os.stat(path) for path in file_paths(self.data_path, self.files)]
+        return sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0)
@@ -1,31 +1,66 @@
 import os
-import hashlib
+from hashing import hash_chunks, HASH_WORKERS
+from piece_layout import PieceLayout, MIN_PIECE_SIZE, list_files
 
-CHUNK_SIZE = 64 * 1024 ## just keeping the chunk size at 64 KB
+CHUNK_SIZE = MIN_PIECE_SIZE ## the chunk size of files up to MAX_PIECE_COUNT chunks, bigger files get bigger chunks
+HASH_BATCH_SIZE = 4 * HASH_WORKERS ## number of chunks read ahead and hashed in parallel
 
-def divide_file_to_chunks(path, chunk_size=CHUNK_SIZE):
+def divide_file_to_chunks(path, chunk_size=None):
     """
     This function aims at dividing a file into smaller chunks
     then calculates a SHA1 hash for each chunk for integrity,
     yields the chunk data along with the hash and the sequential
-    chunk number.
+    chunk number. A directory is divided like a multi-file torrent:
+    its files in sorted order, with chunks running across file boundaries.
     PARAMETERS:
-    path: Path of the file that we want to divide and share 
-    chunk_size= Size of each chunk (I have fixed it to 64 can be dynamic)
+    path: Path of the file (or directory) that we want to divide and share 
+    chunk_size= Size of each chunk, chosen from the file size by the PieceLayout if None
     yield: it creates a tuple having the chunk data, SHA1 hash, 
     and chunk number for ease of understanding
     """
     if not os.path.exists(path):
         raise FileNotFoundError (f"File {path} does not exist") # Covering the edge case of no file found
     
+    if os.path.isdir(path):
+        files = list_files(path)
+        paths = [os.path.join(path, *relative_path.split("/")) for relative_path, _ in files]
+        total_size = sum(size for _, size in files)
+    else:
+        paths = [path]
+        total_size = os.path.getsize(path)
+    chunk_size = PieceLayout(total_size, chunk_size).piece_size # same chunks as the metadata and the storage
     chunk_number = 1 # initializing the chunks from 1
     
-    with open(path, 'rb') as file:
-        while chunk := file.read(chunk_size): ## reading the file as chunks of the specified size
-            chunk_hash = hashlib.sha1(chunk).hexdigest() # computing sha1 hash for the current chunk
+    chunks = read_chunks(paths, chunk_size)
+    while True:
+        ## reading a batch of chunks so they can be hashed on all cores at once,
+        ## the batch keeps memory bounded to a few chunks per core
+        batch = [chunk for _, chunk in zip(range(HASH_BATCH_SIZE), chunks)]
+        if not batch:
+            break
+        for chunk, chunk_hash in zip(batch, hash_chunks(batch)): # sha1 hashes in chunk order
             yield chunk, chunk_hash, chunk_number # returns the chunk data, chunk hash value and chunk no.
             chunk_number += 1 # increasing the chunk sequence iteratively
 
+def read_chunks(paths, chunk_size):
+    """
+    Reads files one after the other as a single stream of chunks.
+    PARAMETERS:
+    paths: Paths of the files, in order
+    chunk_size: Size of each chunk, only the last chunk can be shorter
+    yield: the data of each chunk, a chunk can hold the end of one file and the start of the next
+    """
+    chunk = bytearray()
+    for path in paths:
+        with open(path, 'rb') as file:
+            while data := file.read(chunk_size - len(chunk)):
+                chunk += data
+                if len(chunk) == chunk_size:
+                    yield bytes(chunk)
+                    chunk.clear()
+    if chunk: ## the end of the last file
+        yield bytes(chunk)
+
 def write_chunk_to_file(chunk_data, chunk_number, output_dir = "chunks"):
     """
     This function is aimed at saving a chunk to a file in my specified directory
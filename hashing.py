@@ -1,4 +1,9 @@
+import os
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bitfield import Bitfield
+from piece_layout import PieceLayout
 
 def calculate_sha1(data):
     """
@@ -20,3 +25,133 @@ def verify_chunk(chunk_data, expected_hash):
     :return: True if the chunk matches the expected hash, False otherwise.
     """
     return calculate_sha1(chunk_data) == expected_hash
+
+# hashlib releases the GIL while hashing buffers larger than 2 KB, so a thread pool
+# hashes pieces on every core without the cost of a process pool (pickling the data).
+HASH_WORKERS = os.cpu_count() or 1
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def hash_pool():
+    """
+    Returns the shared thread pool used for hashing, creating it on first use.
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hashing")
+        return _hash_pool
+
+
+def file_paths(path, files=None):
+    """
+    :param path: Path of the file, or of the directory of a multi-file torrent.
+    :param files: (relative path, size) of the files inside the directory, None for a single file.
+    :return: The paths of the files, in torrent order.
+    """
+    if files is None:
+        return [path]
+    return [os.path.join(path, *relative_path.split("/")) for relative_path, _ in files]
+
+
+def read_piece(fds, layout, piece_number):
+    """
+    Reads one piece with explicit offsets, so threads can share the descriptors.
+
+    :param fds: Descriptors of the open files, in torrent order.
+    :param layout: The PieceLayout of the files.
+    :param piece_number: Number of the piece, starting at 1.
+    :return: The piece data, joined from every file it spans.
+    """
+    return b"".join(os.pread(fds[file_index], count, file_offset)
+                    for file_index, file_offset, count in layout.segments(piece_number))
+
+
+def hash_file_pieces(path, piece_size, piece_numbers=None, files=None):
+    """
+    Calculates the SHA1 hashes of the pieces of a file, or of the files of a multi-file
+    torrent laid out one after the other, in parallel.
+
+    :param path: Path of the file, or of the directory of a multi-file torrent.
+    :param piece_size: Size of every piece except possibly the last.
+    :param piece_numbers: Pieces to hash, starting at 1. All pieces if None.
+    :param files: (relative path, size) of the files inside the directory, None for a single file.
+    :return: List of hex hashes, in the order of piece_numbers.
+    """
+    paths = file_paths(path, files)
+    file_lengths = [os.path.getsize(file_path) for file_path in paths]
+    layout = PieceLayout(sum(file_lengths), piece_size, file_lengths)
+    if piece_numbers is None:
+        piece_numbers = range(1, layout.piece_count + 1)
+
+    if not hasattr(os, "pread"):
+        # No positional reads on this platform: every piece opens its files on its own
+        def hash_piece(piece_number):
+            data = b""
+            for file_index, file_offset, count in layout.segments(piece_number):
+                with open(paths[file_index], 'rb') as file:
+                    file.seek(file_offset)
+                    data += file.read(count)
+            return calculate_sha1(data)
+        return list(hash_pool().map(hash_piece, piece_numbers))
+
+    fds = [os.open(file_path, os.O_RDONLY) for file_path in paths]
+    try:
+        # Executor.map keeps the results in submission order
+        return list(hash_pool().map(
+            lambda piece_number: calculate_sha1(read_piece(fds, layout, piece_number)),
+            piece_numbers
+        ))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def hash_chunks(chunks):
+    """
+    Hashes a batch of in-memory chunks in parallel.
+
+    :param chunks: Iterable of chunk data.
+    :return: List of hex hashes in the same order.
+    """
+    return list(hash_pool().map(calculate_sha1, chunks))
+
+
+def verify_chunks(chunks_and_hashes):
+    """
+    Verifies a batch of downloaded chunks in parallel.
+
+    :param chunks_and_hashes: Iterable of (chunk data, expected hash) pairs.
+    :return: List of booleans in the same order, True where the chunk matches its hash.
+    """
+    return list(hash_pool().map(lambda pair: verify_chunk(*pair), chunks_and_hashes))
+
+
+def recheck_file(path, piece_size, expected_hashes, piece_numbers=None, files=None):
+    """
+    Re-hashes pieces of an existing file, e.g. at startup, to find which ones are already valid.
+
+    :param path: Path of the file, or of the directory of a multi-file torrent.
+    :param piece_size: Size of every piece except possibly the last.
+    :param expected_hashes: Expected hex hashes, expected_hashes[i] is the hash of piece i + 1.
+    :param piece_numbers: Pieces to check, all pieces if None.
+    :param files: (relative path, size) of the files inside the directory, None for a single file.
+    :return: Bitfield of the pieces whose data matches the expected hash.
+    """
+    verified = Bitfield(len(expected_hashes))
+    paths = file_paths(path, files)
+    if not all(os.path.exists(file_path) for file_path in paths):
+        return verified
+
+    total_size = sum(os.path.getsize(file_path) for file_path in paths)
+    if piece_numbers is None:
+        piece_numbers = range(1, len(expected_hashes) + 1)
+    # Pieces that lie beyond the end of the file cannot be valid
+    piece_numbers = [number for number in piece_numbers if (number - 1) * piece_size < total_size]
+    hashes = hash_file_pieces(path, piece_size, piece_numbers, files)
+    for piece_number, piece_hash in zip(piece_numbers, hashes):
+        if piece_hash == expected_hashes[piece_number - 1]:
+            verified.add(piece_number)
+    return verified
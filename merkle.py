@@ -0,0 +1,151 @@
+import os
+import hashlib
+from hashing import hash_pool, read_piece, file_paths
+from piece_layout import PieceLayout
+from peer_protocol import BLOCK_SIZE
+
+HASH_SIZE = 32  # bytes of a SHA-256 digest, the size of every node and proof hash
+PADDING_HASH = bytes(HASH_SIZE)  # leaf hash of the blocks that pad the tree to a power of two
+
+
+def leaf_hashes(data, block_size=BLOCK_SIZE):
+    """
+    RETURNS:
+    The SHA-256 digest of every block of data, the last block may be shorter.
+    """
+    return [hashlib.sha256(data[offset:offset + block_size]).digest() for offset in range(0, len(data), block_size)]
+
+
+def hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+class MerkleTree:
+    """
+    A binary hash tree over the BLOCK_SIZE blocks of a torrent's data. The leaves are the
+    SHA-256 hashes of the blocks, padded with PADDING_HASH up to a power of two, and every
+    node is the hash of its two children. The metadata only holds the root, so it stays a
+    few bytes whatever the size of the data.
+
+    A block is verified on its own with a proof: the hashes of the siblings along its path
+    to the root, which the uploading peer sends with the block. A bad block is therefore
+    detected as soon as it arrives, and only that block has to be fetched again.
+
+    A downloading peer does not know the tree in advance. Every verified proof fills in the
+    nodes along its path, and those are exactly the nodes needed to prove the same block
+    to other peers later. Nodes are stored in one list in heap order: the root at index 1,
+    the children of node i at 2i and 2i + 1, the leaves from `width` on.
+    """
+
+    def __init__(self, leaf_count, root=None):
+        """
+        PARAMETERS:
+        leaf_count: Number of blocks in the data.
+        root: The expected root hash, from the metadata. None when the tree is built from the data.
+        """
+        self.leaf_count = leaf_count
+        self.width = 1  # Number of leaves including the padding, a power of two
+        while self.width < leaf_count:
+            self.width *= 2
+        self.depth = self.width.bit_length() - 1  # Hashes in a proof
+        self.nodes = [None] * (2 * self.width)
+        for index in range(self.width + leaf_count, 2 * self.width):
+            self.nodes[index] = PADDING_HASH
+        for index in range(self.width - 1, 0, -1):  # Subtrees made of padding only are known upfront
+            left, right = self.nodes[2 * index], self.nodes[2 * index + 1]
+            if left is not None and right is not None:
+                self.nodes[index] = hash_pair(left, right)
+        if root is not None:
+            self.nodes[1] = root
+
+    @property
+    def root(self):
+        return self.nodes[1]
+
+    @classmethod
+    def from_leaves(cls, leaves):
+        """
+        Builds the complete tree from the hashes of all blocks.
+        """
+        tree = cls(len(leaves))
+        tree.nodes[tree.width:tree.width + len(leaves)] = leaves
+        for index in range(tree.width - 1, 0, -1):
+            tree.nodes[index] = hash_pair(tree.nodes[2 * index], tree.nodes[2 * index + 1])
+        return tree
+
+    @classmethod
+    def from_file(cls, path, piece_size, files=None):
+        """
+        Builds the complete tree of a file, or of the files of a multi-file torrent, hashing
+        the pieces in parallel on the hash pool.
+        PARAMETERS:
+        path: Path of the file, or of the directory of a multi-file torrent.
+        piece_size: Size of every piece except possibly the last, a multiple of BLOCK_SIZE.
+        files: (relative path, size) of the files inside the directory, None for a single file.
+        """
+        paths = file_paths(path, files)
+        file_lengths = [os.path.getsize(file_path) for file_path in paths]
+        layout = PieceLayout(sum(file_lengths), piece_size, file_lengths)
+        fds = [os.open(file_path, os.O_RDONLY) for file_path in paths]
+        try:
+            # Executor.map keeps the pieces in order, so the leaves come out in block order
+            pieces = hash_pool().map(lambda piece_number: leaf_hashes(read_piece(fds, layout, piece_number)),
+                                     range(1, layout.piece_count + 1))
+            return cls.from_leaves([leaf for piece_leaves in pieces for leaf in piece_leaves])
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def proof(self, leaf_index):
+        """
+        RETURNS:
+        The sibling hashes from the leaf up to the root, None if some of them are not known.
+        """
+        proof = []
+        index = self.width + leaf_index
+        while index > 1:
+            sibling = self.nodes[index ^ 1]
+            if sibling is None:
+                return None
+            proof.append(sibling)
+            index //= 2
+        return proof
+
+    def add_proof(self, leaf_index, leaf, proof):
+        """
+        Checks a block hash against the root with its proof, and keeps the nodes on its
+        path if it matches.
+        PARAMETERS:
+        leaf_index: Number of the block, from 0.
+        leaf: SHA-256 hash of the block data.
+        proof: The sibling hashes from the leaf up to the root.
+        RETURNS:
+        True if the block is part of the data.
+        """
+        if not 0 <= leaf_index < self.leaf_count or proof is None or len(proof) != self.depth:
+            return False
+        index = self.width + leaf_index
+        path = [(index, leaf)]
+        node = leaf
+        for sibling in proof:
+            node = hash_pair(node, sibling) if index % 2 == 0 else hash_pair(sibling, node)
+            index //= 2
+            path.append((index, node))
+        if node != self.root:
+            return False
+        for (index, node), sibling in zip(path, proof):
+            self.nodes[index] = node
+            self.nodes[index ^ 1] = sibling
+        return True
+
+    def set_leaves(self, first_leaf, leaves):
+        """
+        Records the hashes of blocks already known to be valid, e.g. restored from a resume file.
+        """
+        self.nodes[self.width + first_leaf:self.width + first_leaf + len(leaves)] = leaves
+
+    def has_leaves(self, first_leaf, leaves):
+        """
+        Checks that blocks hash to leaves that were verified before.
+        """
+        return self.nodes[self.width + first_leaf:self.width + first_leaf + len(leaves)] == leaves
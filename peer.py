@@ -1,104 +1,775 @@
+import io
+import os
 import socket
+import select
 import threading
 import random
-from file_chunker import divide_file_to_chunks, CHUNK_SIZE
+from collections import deque
+from file_chunker import CHUNK_SIZE
 from torrent_metadata import TorrentMetadata
-from time import sleep
-from piece_manager import PieceManager
+from time import sleep, monotonic
+from piece_manager import PieceManager, NORMAL
+from bitfield import Bitfield
+from piece_storage import PieceStorage
+from piece_layout import list_files
+from merkle import MerkleTree, leaf_hashes
+from fast_resume import FastResume
+from hashing import hash_pool, verify_chunk
+from download_scheduler import DownloadScheduler
+from tracker_cluster import rank_endpoints
+from dht import ThreadedDHT
+from choker import Choker, CHOKE_INTERVAL
+from rate_limiter import RateLimiter
+from stream_reader import StreamReader, READAHEAD_PIECES
+from peer_protocol import (
+    PeerConnection, ProtocolError, read_message, send_message, send_frame, read_frame, decode_request, decode_piece,
+    decode_have, decode_handshake, encode_piece_header, encode_reject, encode_bitfield, encode_get_bitfield, encode_pex,
+    encode_proof, decode_proof, HANDSHAKE, REQUEST, PIECE, HAVE, CANCEL, REJECT, BITFIELD, GET_BITFIELD, PEX, PROOF,
+    CHOKE, UNCHOKE, KEEPALIVE, PIPELINE_DEPTH, BLOCK_SIZE
+)
 
 TRACKER_HOST = '127.0.0.1'  # the host IP for the tracker server
 TRACKER_PORT = 9090  # the port on which the tracker server is listening
+TRACKER_TIMEOUT = 10  # seconds to wait for a tracker before failing over to the next one
 MIN_PEERS_REQUIRED = 5  # minimum number of peers required to start downloading chunks
+DEFAULT_ANNOUNCE_INTERVAL = 30  # seconds between heartbeats until the tracker tells us its interval
+DEFAULT_MIN_ANNOUNCE_INTERVAL = 5  # seconds between peer list requests while we still need peers
+DEFAULT_INFO_HASH = "0" * 40  # swarm of peers that share a file without a metadata file
+CHOKED_TIMEOUT = 60  # seconds a download worker waits for a peer that choked us to unchoke, before moving on
+MIN_POLL_TIMEOUT = 0.05  # seconds a download worker waits for data at least, so an expiry that is due does not spin
+PEX_INTERVAL = 30  # seconds between peer exchange messages on a connection
+MAX_PEX_PEERS = 50  # peers added or removed by one peer exchange message, the rest follow with the next one
 
 class Peer:
-    def __init__(self, peer_ip, file_to_share=None):
+    def __init__(self, peer_ip, file_to_share=None, metadata_file=None, trackers=None, dht_nodes=None):
         """
         Initializes the peer with the IP and the file to share
         PARAMETERS:
         peer_ip: the IP address of the peer
         file_to_share: Path to the file that this peer is sharing
+        metadata_file: Path to the metadata (.torrent) file with the expected chunk hashes
+        trackers: List of (host, port) tracker endpoints to fail over between, TRACKER_HOST:TRACKER_PORT by default.
+                  An empty list runs without a tracker.
+        dht_nodes: List of (host, port) of DHT nodes to join the DHT through, an empty list to start a new DHT.
+                   None disables the DHT.
         """
         self.peer_ip = peer_ip
         self.file_to_share = file_to_share
-        self.peer_chunks = {}  # Store local chunks of the file in memory
-        self.received_chunks = set()  # Track downloaded chunks
-        self.tracker_peers = {}  # Store other peers and the chunks they have
+        self.metadata_file = metadata_file
+        self.metadata = None  # Metadata dictionary loaded from metadata_file
+        self.info_hash = DEFAULT_INFO_HASH  # Identifies our torrent's swarm on the tracker
+        self.storage = None  # PieceStorage mapping the file on disk, chunks are not kept in memory
+        self.resume = None  # FastResume that persists which chunks of the file are verified
+        self.piece_hashes = None  # Expected SHA1 hash of every chunk, when known
+        self.merkle_tree = None  # MerkleTree of the blocks, for metadata that only has a Merkle root
+        self.received_chunks = Bitfield(0)  # Chunks this peer has, shared or downloaded
+        self.tracker_peers = {}  # Store other peers and the Bitfield of chunks they have
+        self.untracked_peers = set()  # Peers learned from the DHT or peer exchange, the tracker's lists do not remove them
+        self.pex_sent = {}  # "ip:port" of a connected peer -> {"ip:port": chunk count} we last gossiped to it
+        self.pex_received = {}  # "ip:port" of a connected peer -> time we last applied its peer exchange message
+        self.tracker_version = 0  # Swarm version of the last peer list applied, the tracker sends changes since then
+        self.trackers = list(trackers) if trackers is not None else [(TRACKER_HOST, TRACKER_PORT)]
+        self.tracker_index = 0  # Position of the tracker we talk to, in the order of tracker_endpoints()
+        self.tracker_socket = None  # Persistent connection to the tracker, opened on first use
+        self.tracker_lock = threading.RLock()  # Keeps the requests of different threads on the tracker connection apart
+        self.announce_interval = DEFAULT_ANNOUNCE_INTERVAL  # Seconds between heartbeats, set by the tracker
+        self.min_announce_interval = DEFAULT_MIN_ANNOUNCE_INTERVAL  # Seconds between peer list requests, set by the tracker
+        self.dht_nodes = dht_nodes
+        self.dht = None  # ThreadedDHT, started with the peer when dht_nodes is given
         self.total_chunks = 0  # Total number of chunks in the file
         self.peer_port = None  # The port number on which the peer listens for requests
-        self.uploaded_chunks = {}  # Track how many chunks each peer has uploaded
-        self.top_peers = []  # List of the top 4 peers sorted by upload contribution
-        self.optimistic_peer = None  # Randomly select a peer for optimistic unchoking
+        self.choker = Choker()  # Decides which of the peers downloading from us are served
+        self.choker_lock = threading.Lock()  # Guards the choker and upload_connections
+        self.upload_connections = {}  # "ip:port" of a peer downloading from us -> function sending it CHOKE, UNCHOKE or PEX
+        self.upload_limiter = RateLimiter()  # Global and per-peer upload limits, none until set_rate_limits
+        self.download_limiter = RateLimiter()  # Global and per-peer download limits
         self.piece_manager = None  # PieceManager instance
+        self.peer_connections = {}  # Long-lived outgoing connections, keyed by "ip:port"
+        self.connections_lock = threading.Lock()  # Guards peer_connections
+        self.scheduler = None  # DownloadScheduler, created when the download starts
+        self.scheduler_condition = threading.Condition()  # Guards the scheduler, notified when requests are released
+        self.chunk_stored = threading.Condition()  # Notified whenever a downloaded chunk is written, for stream readers
+        self.file_priorities = {}  # relative path -> priority of the files set with set_file_priority
+        self.range_priorities = {}  # chunk number -> priority set with set_range_priority, until a file priority replaces it
 
     def start(self):
         """
         Starts the peer's operations:
         -> Listening for incoming requests
-        -> Registering with the tracker
+        -> Registering with the tracker and joining the DHT
         -> Waiting for sufficient peers to connect
         -> Downloading chunks
         """
         # Start listening thread
         listening_thread = threading.Thread(target=self.listen_for_requests)
         listening_thread.start()
+        threading.Thread(target=self.choke_peers_periodically, daemon=True).start()
 
         while self.peer_port is None:
             sleep(0.1)
 
+        if self.metadata_file:
+            self.load_metadata(self.metadata_file)
         if self.file_to_share:
             print(f"Sharing file: {self.file_to_share}")
             self.prepare_file_chunks()  # Prepare chunks for sharing if there is a file
+        elif self.metadata:
+            # Nothing to share yet, download into the file named in the metadata
+            self.open_storage(self.metadata["file_name"], self.metadata["total_size"])
 
-        # Register with the tracker
-        self.register_with_tracker()
+        if self.dht_nodes is not None:
+            self.start_dht()
+        # Register with the tracker and look the swarm up in the DHT
+        self.refresh_peers()
         # Wait for the minimum number of peers
         self.wait_for_peers()
-        # Periodically refresh top peers
-        threading.Thread(target=self.refresh_top_peers_periodically).start()
+        # Periodically gossip peers to the peers we are connected to, and keep our tracker entry alive
+        threading.Thread(target=self.exchange_peers_periodically, daemon=True).start()
+        if self.trackers:
+            threading.Thread(target=self.send_heartbeats_periodically, daemon=True).start()
         # Start downloading missing chunks
         self.download_chunks()
 
     def prepare_file_chunks(self):
         """
         Prepares chunks for sharing by only selecting a subset of chunks for this peer.
+        The file is mapped from disk instead of being read into memory.
         """
-        chunks = list(divide_file_to_chunks(self.file_to_share))
-        self.total_chunks = len(chunks)  # Set total_chunks before initializing PieceManager
-        self.piece_manager = PieceManager(self.total_chunks)  # Initialize PieceManager
-        
-        num_chunks_to_have = random.randint(1, self.total_chunks // 2)
-        random_chunk_indices = random.sample(range(self.total_chunks), num_chunks_to_have)
+        if os.path.isdir(self.file_to_share):
+            files = list_files(self.file_to_share)
+            self.open_storage(self.file_to_share, sum(size for _, size in files), files, read_only=True)
+        else:
+            self.open_storage(self.file_to_share, os.path.getsize(self.file_to_share), read_only=True)
+        if len(self.received_chunks):
+            print(f"Resumed with {len(self.received_chunks)} chunks")
+            return
 
-        for index in random_chunk_indices:
-            chunk, chunk_hash, chunk_number = chunks[index]
-            self.peer_chunks[chunk_number] = chunk  # Store chunk
+        num_chunks_to_have = random.randint(1, max(1, self.total_chunks // 2))
+        random_chunk_numbers = random.sample(range(1, self.total_chunks + 1), num_chunks_to_have)
+
+        for chunk_number in random_chunk_numbers:
+            self.received_chunks.add(chunk_number)
+            self.piece_manager.mark_piece_complete(chunk_number)  # We do not need to download what we share
             print(f"Prepared chunk {chunk_number} for sharing")
+        self.resume.save(self.received_chunks)
+
+    def load_metadata(self, metadata_file):
+        """
+        Loads the metadata file, so that every downloaded chunk is checked against its hash.
+        PARAMETERS:
+        metadata_file: Path to the metadata (.torrent) file.
+        """
+        metadata = TorrentMetadata.load_metadata(metadata_file)
+        self.metadata = metadata
+        self.piece_hashes = metadata.get("piece_hashes")  # Merkle metadata has a root instead
+        self.info_hash = TorrentMetadata.info_hash(metadata)
+
+    def open_storage(self, path, total_size, files=None, read_only=False):
+        """
+        Opens the file that chunks are served from and downloaded into, preallocating it
+        if it does not exist yet. If the file already existed, the chunks recorded in its
+        resume file are restored without downloading them again. Once every chunk is
+        verified the file is reopened read-only, it is only served from then on.
+        PARAMETERS:
+        path: Path of the file, or of the directory of a multi-file torrent.
+        total_size: Size of the complete file, or of all files together, in bytes.
+        files: (relative path, size) of the files inside the directory. Taken from the
+               metadata if None, a single file if the metadata does not list files either.
+        read_only: Never write the file, e.g. the original a seeder shares.
+        """
+        existed = os.path.exists(path)
+        # The metadata fixes the chunk size, without it every peer derives the same one from the file size
+        chunk_size = self.metadata["chunk_size"] if self.metadata else None
+        if files is None and self.metadata:
+            files = TorrentMetadata.file_list(self.metadata)
+        self.storage = PieceStorage(path, total_size, chunk_size, files, read_only)
+        self.init_piece_state(self.storage.piece_count)
+        self.resume = FastResume(path, self.storage.piece_size, self.storage.piece_count, files=files)
+        verified = self.resume.restore(self.piece_hashes) if existed else Bitfield(self.total_chunks)
+        if self.metadata and "merkle_root" in self.metadata:
+            verified = self.init_merkle_tree(path, files, verified, existed)
+        if not read_only and self.total_chunks and len(verified) == self.total_chunks:
+            self.storage.close()
+            self.storage = PieceStorage(path, total_size, chunk_size, files, read_only=True)
+        for chunk_number in verified:
+            self.received_chunks.add(chunk_number)
+            self.piece_manager.mark_piece_complete(chunk_number)
+
+    def set_file_priority(self, relative_path, priority):
+        """
+        Changes the priority of the chunks of one file of a multi-file torrent, e.g. SKIP
+        to leave it out of the download. A chunk shared with a neighbouring file gets the
+        highest priority of the files covering it, where a priority set for the chunk with
+        set_range_priority stands for the neighbour, so skipping a file never skips data
+        that is wanted.
+        PARAMETERS:
+        relative_path: The file, as listed in the metadata.
+        priority: SKIP, LOW, NORMAL or HIGH from piece_manager.
+        """
+        layout = self.storage.layout
+        file_index = layout.file_index(relative_path)
+        chunks = layout.pieces_in_range(layout.file_offsets[file_index], layout.file_lengths[file_index])
+        with self.scheduler_condition:
+            self.file_priorities[relative_path] = priority
+            for chunk_number in chunks:
+                covering_files = [index for index, _, _ in layout.segments(chunk_number)]
+                if len(covering_files) == 1:
+                    self.range_priorities.pop(chunk_number, None)  # The latest priority of the file wins
+                    chunk_priority = priority
+                elif chunk_number in self.range_priorities:
+                    # Shared with a neighbour and set by range since, that range speaks for the neighbour
+                    chunk_priority = max(priority, self.range_priorities[chunk_number])
+                else:
+                    chunk_priority = max(self.file_priorities.get(layout.file_paths[index], NORMAL) for index in covering_files)
+                self.piece_manager.set_priority([chunk_number], chunk_priority)
+            self.scheduler_condition.notify_all()  # Idle workers may have new chunks to request, or none left
+
+    def set_range_priority(self, offset, length, priority):
+        """
+        Changes the priority of the chunks holding a byte range of the data, e.g. HIGH for
+        the part of a file that is needed first, or SKIP for one that is not needed.
+        PARAMETERS:
+        offset: Offset of the range in the data, all files laid out in torrent order.
+        length: Length of the range in bytes.
+        priority: SKIP, LOW, NORMAL or HIGH from piece_manager.
+        """
+        chunks = self.storage.layout.pieces_in_range(offset, length)
+        with self.scheduler_condition:
+            self.piece_manager.set_priority(chunks, priority)
+            self.range_priorities.update(dict.fromkeys(chunks, priority))
+            self.scheduler_condition.notify_all()
+
+    def open_reader(self, relative_path=None, readahead=READAHEAD_PIECES, timeout=None):
+        """
+        Opens the data for reading in order while it is still downloading, see StreamReader.
+        PARAMETERS:
+        relative_path: The file to read in a multi-file torrent, all data laid out in torrent order if None.
+        readahead: Number of chunks from the reading position on that are downloaded first.
+        timeout: Seconds a read waits for a missing chunk before raising TimeoutError, forever if None.
+        RETURNS:
+        A buffered binary file object.
+        """
+        return io.BufferedReader(StreamReader(self, relative_path, readahead, timeout))
+
+    def init_merkle_tree(self, path, files, verified, existed):
+        """
+        Sets up the Merkle tree of a torrent whose metadata only has the root. A file that is
+        either complete or unknown to the resume file is hashed as a whole, and if it matches
+        the root, every chunk is valid and every block can be proven to other peers. Otherwise
+        the tree starts with the blocks of the chunks the resume file trusts, and fills in as
+        blocks arrive with their proofs.
+        PARAMETERS:
+        path: Path of the file, or of the directory of a multi-file torrent.
+        files: (relative path, size) of the files inside the directory, None for a single file.
+        verified: Bitfield of the chunks the resume file trusts.
+        existed: Whether the data was on disk before, a new file has nothing worth hashing.
+        RETURNS:
+        The Bitfield of the valid chunks.
+        """
+        if self.storage.piece_size % BLOCK_SIZE:
+            raise ValueError(f"Merkle metadata needs a chunk size that is a multiple of {BLOCK_SIZE}")
+        root = bytes.fromhex(self.metadata["merkle_root"])
+        if existed and len(verified) in (0, self.total_chunks):
+            self.storage.flush()
+            tree = MerkleTree.from_file(path, self.storage.piece_size, files)
+            if tree.root == root:
+                self.merkle_tree = tree
+                return Bitfield.full(self.total_chunks)
+        self.merkle_tree = MerkleTree(-(-self.storage.total_size // BLOCK_SIZE), root)
+        for chunk_number in verified:
+            self.merkle_tree.set_leaves(self.first_leaf(chunk_number), leaf_hashes(self.storage.read_piece(chunk_number)))
+        return verified
+
+    def first_leaf(self, chunk_number):
+        """
+        RETURNS:
+        The index of the Merkle leaf of the first block of a chunk.
+        """
+        return self.storage.piece_offset(chunk_number) // BLOCK_SIZE
+
+    def verify_blocks(self, chunk_number, begin, data, proofs):
+        """
+        Checks received blocks against the Merkle root with the proofs sent ahead of them,
+        so a bad block is caught on arrival. Without a Merkle tree, chunks are only checked
+        as a whole once complete.
+        PARAMETERS:
+        chunk_number: The chunk the data belongs to.
+        begin: Offset of the data inside the chunk.
+        data: One or more blocks of data.
+        proofs: Dictionary of (chunk number, begin) -> proof hashes received on the connection,
+                the proofs of these blocks are taken out of it.
+        RETURNS:
+        True if every block is valid.
+        """
+        if self.merkle_tree is None:
+            return True
+        if begin % BLOCK_SIZE:
+            return False
+        first_leaf = self.first_leaf(chunk_number) + begin // BLOCK_SIZE
+        valid = True
+        for index, leaf in enumerate(leaf_hashes(data)):
+            # The tree is shared by all download threads, concurrent proofs write identical nodes
+            proof = proofs.pop((chunk_number, begin + index * BLOCK_SIZE), None)
+            valid = self.merkle_tree.add_proof(first_leaf + index, leaf, proof) and valid
+        return valid
+
+    def block_proofs(self, chunk_number, begin, count):
+        """
+        RETURNS:
+        The PROOF messages for the blocks of an answer, ready to be sent ahead of the
+        PIECE message. b"" without a Merkle tree, None if a proof is not known.
+        """
+        if self.merkle_tree is None:
+            return b""
+        if begin % BLOCK_SIZE:
+            return None
+        frames = []
+        for offset in range(begin, begin + count, BLOCK_SIZE):
+            proof = self.merkle_tree.proof(self.first_leaf(chunk_number) + offset // BLOCK_SIZE)
+            if proof is None:
+                return None
+            frames.append(encode_proof(chunk_number, offset, proof))
+        return b"".join(frames)
+
+    def init_piece_state(self, total_chunks):
+        """
+        Sets up the per-piece bookkeeping once the number of chunks is known.
+        PARAMETERS:
+        total_chunks: Total number of chunks in the file.
+        """
+        self.total_chunks = total_chunks  # Set total_chunks before initializing PieceManager
+        self.piece_manager = PieceManager(total_chunks)  # Initialize PieceManager
+        self.received_chunks = Bitfield(total_chunks)
+
+    def set_rate_limits(self, upload=None, download=None, peer_upload=None, peer_download=None):
+        """
+        Sets the bandwidth limits, also while transfers are running. None removes a limit.
+        PARAMETERS:
+        upload: Total upload rate in bytes per second.
+        download: Total download rate in bytes per second.
+        peer_upload: Upload rate to each peer in bytes per second.
+        peer_download: Download rate from each peer in bytes per second.
+        """
+        self.upload_limiter.set_rate(upload)
+        self.download_limiter.set_rate(download)
+        self.upload_limiter.set_peer_rate(peer_upload)
+        self.download_limiter.set_peer_rate(peer_download)
+
+    def refresh_peers(self):
+        """
+        Refreshes the known peers from the trackers and the DHT, whichever are enabled.
+        With the DHT enabled, unreachable trackers are not an error.
+        """
+        self.apply_peers(*self.fetch_peers())
+
+    def fetch_peers(self):
+        """
+        Asks the trackers and the DHT, whichever are enabled, for the peers of the torrent.
+        Only does the network I/O and changes none of the swarm state, see apply_peers.
+        RETURNS:
+        A tuple of (tracker peers, DHT peers): the parsed peer list of the tracker as returned
+        by request_tracker_peers, None without one, and the new peers of the DHT as returned
+        by find_dht_peers.
+        """
+        tracker_peers = None
+        if self.trackers:
+            try:
+                tracker_peers = self.request_tracker_peers()
+            except OSError as e:
+                if self.dht is None:
+                    raise
+                print(f"Trackers unreachable ({e}), relying on the DHT")
+        dht_peers = {}
+        if self.dht is not None:
+            known_peers = set(self.tracker_peers).union(tracker_peers[2] if tracker_peers else ())
+            dht_peers = self.find_dht_peers(known_peers)
+        return tracker_peers, dht_peers
+
+    def apply_peers(self, tracker_peers, dht_peers):
+        """
+        Applies what fetch_peers returned.
+        """
+        if tracker_peers is not None:
+            self.apply_tracker_peers(tracker_peers)
+        if self.dht is not None:
+            self.apply_dht_peers(dht_peers)
+
+    def start_dht(self):
+        """
+        Starts our DHT node and joins the DHT through the nodes in dht_nodes.
+        """
+        self.dht = ThreadedDHT()
+        print(f"DHT node listening on UDP port {self.dht.address[1]}")
+        self.dht.bootstrap(self.dht_nodes)
+
+    def find_dht_peers(self, known_peers):
+        """
+        Announces our listening port for the torrent in the DHT and collects the peers announced
+        there. The DHT only knows addresses, so each new peer is asked for its bitfield.
+        PARAMETERS:
+        known_peers: Addresses whose chunks we know already, they are not asked.
+        RETURNS:
+        A dictionary mapping "ip:port" of the new peers to the Bitfield of chunks they have.
+        """
+        own_addr = f"{self.peer_ip}:{self.peer_port}"
+        found_peers = self.dht.announce_peer(self.info_hash, self.peer_port)  # The lookup also collects peers
+        print(f"DHT returned {len(found_peers)} peers")
+        new_peers = {}
+        for peer_addr in found_peers:
+            if peer_addr == own_addr or peer_addr in known_peers:
+                continue
+            try:
+                new_peers[peer_addr] = self.fetch_peer_bitfield(peer_addr)
+            except (OSError, ProtocolError, ValueError) as e:
+                print(f"Could not get the bitfield of DHT peer {peer_addr}: {e}")
+        return new_peers
+
+    def apply_dht_peers(self, new_peers):
+        """
+        Adds the peers found in the DHT that are still unknown.
+        PARAMETERS:
+        new_peers: A dictionary mapping "ip:port" to the Bitfield of chunks that peer has.
+        """
+        with self.scheduler_condition:  # Download workers pick chunks meanwhile
+            for peer_addr, chunks in new_peers.items():
+                if peer_addr not in self.tracker_peers:
+                    self.set_peer_chunks(peer_addr, chunks)
+                    self.untracked_peers.add(peer_addr)
+            self.scheduler_condition.notify_all()
+        print(f"{len(self.tracker_peers)} peers known after the DHT lookup")
+
+    def fetch_peer_bitfield(self, peer_addr):
+        """
+        Asks a peer which chunks it has, over a short-lived connection.
+        RETURNS:
+        The Bitfield of the peer's chunks.
+        """
+        connection = PeerConnection(peer_addr, f"{self.peer_ip}:{self.peer_port}")
+        try:
+            connection.send(encode_get_bitfield())
+            message_id, payload = connection.receive()
+            if message_id != BITFIELD:
+                raise ProtocolError(f"Expected a bitfield, got message {message_id}")
+            return Bitfield.from_bytes(payload, self.total_chunks)
+        finally:
+            connection.close()
 
     def register_with_tracker(self):
         """
-        Registers the peer and its available chunks with the tracker.
+        Registers the peer and its available chunks with the tracker and applies the peer list it sends back.
         """
-        tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tracker_socket.connect((TRACKER_HOST, TRACKER_PORT))
-        available_chunks = " ".join(map(str, self.peer_chunks.keys()))
-        registration_msg = f"ADD_PEER {self.peer_ip}:{self.peer_port} {available_chunks}"
-        tracker_socket.send(registration_msg.encode())
+        self.apply_tracker_peers(self.request_tracker_peers())
 
-        response = tracker_socket.recv(1024).decode()
-        print(f"Tracker response: {response}")
+    def request_tracker_peers(self):
+        """
+        Registers the peer and its available chunks with the tracker and asks for the peers.
+        Only does the network I/O and changes none of the swarm state, see apply_tracker_peers.
+        RETURNS:
+        The peer list as (version, kind, announced_peers, removed_peers), kind being "FULL" or
+        "DELTA" and the peers as returned by parse_peer_lines. None if the tracker sent no list.
+        """
+        # The chunks we have are sent as a compact bitfield: piece count, then the bits in base64
+        bitfield = self.received_chunks
+        registration_msg = f"ADD_PEER {self.info_hash} {self.peer_ip}:{self.peer_port} {bitfield.size} {bitfield.to_base64()}"
+        with self.tracker_lock:  # Both requests must go over the same connection
+            for attempt in range(2):
+                response = self.tracker_request(registration_msg)
+                print(f"Tracker response: {response}")
+                self.apply_announce_intervals(response.split(" ")[1:])
+                peer_list = self.tracker_request(f"REQUEST_PEERS {self.tracker_version}").split("\n")
+                if peer_list[0] != "UNKNOWN_TORRENT":
+                    break
+                # We failed over to another tracker between the two requests, register there first
 
-        tracker_socket.send("REQUEST_PEERS".encode())
-        peer_list = tracker_socket.recv(1024).decode().split("\n")
-        tracker_socket.close()
+        if not peer_list[0].startswith("PEERS "):
+            print(f"Tracker did not send a peer list: {peer_list[0]}")
+            return None
+        # "PEERS <version> FULL|DELTA", then the new or changed peers and the peers that left
+        _, version, kind = peer_list[0].split(" ")
+        return (int(version), kind) + self.parse_peer_lines(peer_list[1:])
 
-        for peer_info in peer_list:
-            if peer_info:
+    def apply_tracker_peers(self, tracker_peers):
+        """
+        Applies the peer list returned by request_tracker_peers.
+        PARAMETERS:
+        tracker_peers: The parsed peer list, None if the tracker sent none.
+        """
+        if tracker_peers is None:
+            return
+        version, kind, announced_peers, removed_peers = tracker_peers
+        with self.scheduler_condition:  # Download workers pick chunks meanwhile
+            if kind == "FULL":
+                self.apply_peer_list(announced_peers)
+            else:
+                self.apply_peer_delta(announced_peers, removed_peers)
+            self.tracker_version = version
+            self.scheduler_condition.notify_all()
+        print(f"Tracker sent {len(announced_peers)} peers, {len(self.tracker_peers)} known")
+
+    def parse_peer_lines(self, lines):
+        """
+        Parses the peer lines of tracker responses and peer exchange messages:
+        "ip:port: <chunk count> <base64 bitfield>" for a new or changed peer, "REMOVED ip:port" for a peer that left.
+        Peers of a torrent with another number of chunks are skipped.
+        RETURNS:
+        A tuple of (announced_peers, removed_peers): a dictionary mapping "ip:port" to the Bitfield
+        of chunks that peer has, and a list of addresses.
+        """
+        announced_peers = {}
+        removed_peers = []
+        for peer_info in lines:
+            if peer_info.startswith("REMOVED "):
+                removed_peers.append(peer_info.split(" ")[1])
+            elif peer_info:
                 peer_addr, chunks = peer_info.split(": ")
-                chunk_list = list(map(int, chunks.split(",")))
-                self.tracker_peers[peer_addr] = chunk_list
-                # Update PieceManager based on the available chunks from other peers
-                self.piece_manager.update_available_pieces(chunk_list)
-        print(f"Known peers and their chunks: {self.tracker_peers}")
+                size, encoded = chunks.split(" ")
+                if int(size) == self.total_chunks:
+                    announced_peers[peer_addr] = Bitfield.from_base64(encoded, self.total_chunks)
+        return announced_peers, removed_peers
+
+    def tracker_endpoints(self):
+        """
+        RETURNS:
+        The tracker endpoints in the order the cluster places our swarm, so the trackers
+        that hold it are tried first.
+        """
+        return rank_endpoints(self.info_hash, self.trackers)
+
+    def tracker_request(self, message):
+        """
+        Sends one request over the persistent tracker connection and returns the answer.
+        The connection is opened on first use. If it was closed it is reopened, and if the
+        tracker cannot be reached the next one is tried.
+        PARAMETERS:
+        message: The request text.
+        RETURNS:
+        The response text.
+        """
+        with self.tracker_lock:
+            endpoints = self.tracker_endpoints()
+            for _ in range(len(endpoints) + 1):
+                fresh_connection = self.tracker_socket is None
+                endpoint = endpoints[self.tracker_index % len(endpoints)]
+                try:
+                    if fresh_connection:
+                        self.tracker_socket = socket.create_connection(endpoint, timeout=TRACKER_TIMEOUT)
+                    send_frame(self.tracker_socket, message.encode())
+                    return read_frame(self.tracker_socket).decode()
+                except OSError as e:
+                    self.close_tracker_connection()
+                    if fresh_connection:
+                        print(f"Tracker {endpoint[0]}:{endpoint[1]} is unreachable ({e}), failing over")
+                        self.tracker_index = (self.tracker_index + 1) % len(endpoints)
+                        self.tracker_version = 0  # Swarm versions are counted by each tracker on its own
+            raise ConnectionError("No tracker could be reached")
+
+    def close_tracker_connection(self):
+        with self.tracker_lock:
+            if self.tracker_socket is not None:
+                self.tracker_socket.close()
+                self.tracker_socket = None
+
+    def apply_announce_intervals(self, intervals):
+        """
+        Adopts the announce intervals the tracker sent with a response.
+        PARAMETERS:
+        intervals: The fields after the response keyword, "<interval> <min interval>".
+        """
+        if len(intervals) >= 2:
+            self.announce_interval, self.min_announce_interval = int(intervals[0]), int(intervals[1])
+
+    def send_heartbeat(self):
+        """
+        Tells the tracker we are still alive without sending our chunks again.
+        If the tracker evicted us in the meantime, registers again.
+        """
+        self.apply_tracker_peers(self.request_heartbeat())
+
+    def request_heartbeat(self):
+        """
+        Sends the heartbeat, and registers again if the tracker evicted us. Only does the
+        network I/O and changes none of the swarm state, see apply_tracker_peers.
+        RETURNS:
+        The parsed peer list of a new registration, None if we were still registered.
+        """
+        response = self.tracker_request(f"HEARTBEAT {self.info_hash} {self.peer_ip}:{self.peer_port}")
+        if response == "UNKNOWN_PEER":
+            return self.request_tracker_peers()
+        self.apply_announce_intervals(response.split(" ")[1:])
+        return None
+
+    def send_heartbeats_periodically(self):
+        """
+        Sends a heartbeat every announce interval, so the tracker does not evict us.
+        """
+        while True:
+            sleep(self.announce_interval)
+            try:
+                self.send_heartbeat()
+            except OSError as e:
+                print(f"Heartbeat to the tracker failed: {e}")
+
+    def apply_peer_list(self, announced_peers):
+        """
+        Replaces the known peers with the ones announced by the tracker. Only the difference
+        to what we knew before is applied to the PieceManager, so peers that left lower
+        the availability of their pieces and refreshes do not count a peer twice.
+        PARAMETERS:
+        announced_peers: Dictionary mapping "ip:port" to the Bitfield of chunks that peer has.
+        """
+        own_addr = f"{self.peer_ip}:{self.peer_port}"
+        for peer_addr in list(self.tracker_peers):
+            if peer_addr not in announced_peers and peer_addr not in self.untracked_peers:
+                self.set_peer_chunks(peer_addr, None)
+        for peer_addr, chunks in announced_peers.items():
+            if peer_addr != own_addr:
+                self.untracked_peers.discard(peer_addr)  # From now on the tracker tells us when it leaves
+                self.set_peer_chunks(peer_addr, chunks)
+
+    def apply_peer_delta(self, changed_peers, removed_peers):
+        """
+        Applies the changes the tracker reported since our last announce.
+        PARAMETERS:
+        changed_peers: Dictionary mapping "ip:port" to the Bitfield of peers that are new or changed.
+        removed_peers: Addresses of the peers that left the swarm.
+        """
+        own_addr = f"{self.peer_ip}:{self.peer_port}"
+        for peer_addr in removed_peers:
+            self.set_peer_chunks(peer_addr, None)
+        for peer_addr, chunks in changed_peers.items():
+            if peer_addr != own_addr:
+                self.untracked_peers.discard(peer_addr)
+                self.set_peer_chunks(peer_addr, chunks)
+
+    def set_peer_chunks(self, peer_addr, chunks):
+        """
+        Records the chunks of a peer and updates the piece availability accordingly.
+        PARAMETERS:
+        peer_addr: The "ip:port" of the peer.
+        chunks: The Bitfield of chunks the peer has, or None if the peer left.
+        """
+        old_chunks = self.tracker_peers.pop(peer_addr, None)
+        if chunks is not None:
+            self.tracker_peers[peer_addr] = chunks
+        if self.piece_manager:
+            # Update PieceManager based on the available chunks from other peers.
+            # The differences are bitfield AND NOT operations, done in C.
+            if old_chunks is not None:
+                self.piece_manager.remove_available_pieces(old_chunks if chunks is None else old_chunks - chunks)
+            if chunks is not None:
+                self.piece_manager.update_available_pieces(chunks if old_chunks is None else chunks - old_chunks)
+
+    def build_pex_message(self, peer_addr):
+        """
+        Works out what a connected peer has not heard from us yet: ourselves and the peers we
+        know that are new to it or have more chunks than we last told it, and the peers we
+        forgot since. Chunks are only ever added, so a changed chunk count means new chunks.
+        PARAMETERS:
+        peer_addr: The "ip:port" of the connected peer.
+        RETURNS:
+        The text of the PEX message, None if there is nothing new.
+        """
+        sent = self.pex_sent.setdefault(peer_addr, {})
+        known = dict(self.tracker_peers)
+        known[f"{self.peer_ip}:{self.peer_port}"] = self.received_chunks
+        known.pop(peer_addr, None)  # It knows itself best
+
+        lines = []
+        for forgotten_addr in [addr for addr in sent if addr not in known][:MAX_PEX_PEERS]:
+            del sent[forgotten_addr]
+            lines.append(f"REMOVED {forgotten_addr}")
+        for known_addr, chunks in known.items():
+            if len(lines) >= MAX_PEX_PEERS:
+                break
+            if sent.get(known_addr) != len(chunks):
+                sent[known_addr] = len(chunks)
+                lines.append(f"{known_addr}: {chunks.size} {chunks.to_base64()}")
+        return "\n".join(lines) if lines else None
+
+    def apply_pex(self, remote_addr, payload):
+        """
+        Applies the peers gossiped by a connected peer, without asking the tracker.
+        Gossip never overrides the tracker: known peers only gain chunks, and only peers
+        learned from gossip or the DHT are forgotten when the sender forgot them.
+        Messages that come faster than the exchange interval allows are ignored.
+        PARAMETERS:
+        remote_addr: The listening address of the sender, None if it did not handshake.
+        payload: The payload of the PEX message.
+        """
+        own_addr = f"{self.peer_ip}:{self.peer_port}"
+        announced_peers, removed_peers = self.parse_peer_lines(payload.decode().split("\n")[:MAX_PEX_PEERS])
+        # Upload handlers and download workers apply gossip while other workers pick chunks
+        with self.scheduler_condition:
+            now = monotonic()
+            last_received = self.pex_received.get(remote_addr)
+            if remote_addr is None or (last_received is not None and now - last_received < PEX_INTERVAL / 2):
+                return
+            self.pex_received[remote_addr] = now
+
+            for peer_addr in removed_peers:
+                if peer_addr in self.untracked_peers:
+                    self.untracked_peers.discard(peer_addr)
+                    self.set_peer_chunks(peer_addr, None)
+            for peer_addr, chunks in announced_peers.items():
+                if peer_addr == own_addr:
+                    continue
+                known_chunks = self.tracker_peers.get(peer_addr)
+                if known_chunks is None:
+                    self.untracked_peers.add(peer_addr)
+                    self.set_peer_chunks(peer_addr, chunks)
+                elif chunks - known_chunks:
+                    self.set_peer_chunks(peer_addr, known_chunks | chunks)
+            self.scheduler_condition.notify_all()  # Idle workers may find new chunks at the peers
+
+    def exchange_peers(self):
+        """
+        Sends every peer we are connected to what changed in our view of the swarm, over
+        the connections we opened and the ones other peers opened to us.
+        """
+        with self.connections_lock:
+            connections = list(self.peer_connections.items())
+        for peer_addr, connection in connections:
+            message = self.build_pex_message(peer_addr)
+            if message is None:
+                continue
+            try:
+                connection.send(encode_pex(message))
+            except OSError:
+                self.drop_peer_connection(peer_addr)
+        self.exchange_peers_with_uploaders()
+
+    def exchange_peers_with_uploaders(self):
+        """
+        Sends peer exchange messages over the connections other peers opened to us, so that
+        peers that only accept connections, like seeders, gossip too. Peers we also have a
+        connection to are skipped, they hear from us over that one. Shared by the threaded
+        and the asyncio engine.
+        """
+        connected = self.connected_peers()
+        with self.choker_lock:
+            accepted = [(peer_addr, send_control_message) for peer_addr, send_control_message
+                        in self.upload_connections.items() if peer_addr not in connected]
+        for peer_addr, send_control_message in accepted:
+            message = self.build_pex_message(peer_addr)
+            if message is None:
+                continue
+            try:
+                send_control_message(PEX, message.encode())
+            except OSError:
+                pass  # The connection is closing, its handler unregisters it
+
+    def connected_peers(self):
+        """
+        RETURNS:
+        The addresses of the peers we opened a connection to.
+        """
+        with self.connections_lock:
+            return set(self.peer_connections)
+
+    def exchange_peers_periodically(self):
+        while True:
+            sleep(PEX_INTERVAL)
+            self.exchange_peers()
 
     def wait_for_peers(self):
         """
@@ -106,41 +777,302 @@ class Peer:
         """
         print("Waiting for minimum peers to join...")
         while len(self.tracker_peers) < MIN_PEERS_REQUIRED:
-            sleep(5)  # waiting for 5 seconds before checking again
-            self.register_with_tracker()  # Refresh the list of peers from the tracker
+            sleep(self.min_announce_interval)  # waiting as long as the tracker asks before checking again
+            self.refresh_peers()  # Refresh the list of peers from the tracker and the DHT
         print("Minimum peer threshold has been reached, starting download process")
 
     def download_chunks(self):
         """
-        Downloads missing chunks from other peers
-        """
-        while len(self.received_chunks) < self.total_chunks:
-            # Get the rarest piece first
-            rarest_piece = self.piece_manager.get_rarest_piece()
-
-            if rarest_piece:
-                # Try to download the rarest piece from the peers
-                for peer_addr in self.tracker_peers:
-                    if rarest_piece in self.tracker_peers[peer_addr]:
-                        success, received_chunk = self.request_chunk_from_peer(peer_addr, rarest_piece)
-                        if success:
-                            self.received_chunks.add(rarest_piece)
-                            self.piece_manager.mark_piece_complete(rarest_piece)
-                            print(f"Downloaded chunk {rarest_piece} from {peer_addr}")
-                            self.display_progress()
-                            break
-
-            # Check if all chunks have been downloaded
-            if len(self.received_chunks) == self.total_chunks:
-                print("Download complete! You are now a seeder")
+        Downloads missing chunks from all known peers in parallel, with one worker thread
+        and one pipelined connection per peer. The DownloadScheduler decides what each
+        worker requests so that many requests are in flight across the swarm.
+        """
+        self.scheduler = DownloadScheduler(self.piece_manager, self.storage.piece_size,
+                                           piece_length=self.storage.piece_length)
+        while not self.piece_manager.is_complete():
+            self.scheduler.reset_failures()
+            workers = [threading.Thread(target=self.download_from_peer, args=(peer_addr,))
+                       for peer_addr in list(self.tracker_peers) if not self.scheduler.is_banned(peer_addr)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.display_download_rates()
+
+            # Check if all wanted chunks have been downloaded
+            if self.piece_manager.is_complete():
                 break
-            sleep(5)  # Wait before retrying
+            self.wait_for_verifications()
+            # The known peers cannot provide the rest, look for new ones
+            print(f"{self.piece_manager.missing_wanted} chunks still missing, refreshing peers")
+            sleep(self.min_announce_interval)
+            self.refresh_peers()
+        self.save_resume_data()
+        if len(self.received_chunks) == self.total_chunks:
+            print("Download complete! You are now a seeder")
+        else:
+            print("Download of the wanted chunks complete")
+
+    def download_from_peer(self, peer_addr):
+        """
+        Worker loop for one peer: keeps the peer's request window full and handles
+        the answers until the peer has nothing left that we need.
+        PARAMETERS:
+        peer_addr: The address of the peer to download from.
+        """
+        proofs = {}  # (chunk number, begin) -> Merkle proof of a block whose PIECE comes next
+        try:
+            connection = self.get_peer_connection(peer_addr)
+            last_message = monotonic()  # When the peer last sent us anything
+            while not self.piece_manager.is_complete():
+                with self.scheduler_condition:
+                    self.expire_requests()
+                    peer_chunks = self.tracker_peers.get(peer_addr, ())
+                    requests = self.scheduler.next_requests(peer_addr, peer_chunks)
+                    choked_for = self.scheduler.choked_for(peer_addr)
+                    next_expiry = self.scheduler.next_expiry()
+                    if not self.scheduler.outstanding(peer_addr):
+                        if not self.scheduler.has_wanted_pieces(peer_addr, peer_chunks):
+                            break  # This peer has nothing left that we need
+                        if choked_for is not None and choked_for > CHOKED_TIMEOUT:
+                            break  # It keeps its upload slots for others
+                        if choked_for is None:
+                            # Everything it has is being fetched elsewhere, wait in case one of those fails
+                            self.scheduler_condition.wait(timeout=1)
+                            continue
+
+                for chunk_number, begin, length in requests:
+                    connection.request(chunk_number, begin, length)
+
+                # Wake up when the next request of any peer times out, so it is expired on schedule
+                # instead of after the socket timeout
+                poll_timeout = self.scheduler.request_timeout if next_expiry is None else \
+                    min(max(next_expiry, MIN_POLL_TIMEOUT), self.scheduler.request_timeout)
+                if not connection.wait_readable(poll_timeout):
+                    if choked_for is None and monotonic() - last_message > self.scheduler.request_timeout:
+                        raise TimeoutError(f"No answer within {self.scheduler.request_timeout} seconds")
+                    continue  # Nothing comes while we are choked, keep waiting for the unchoke
+                message_id, payload = connection.receive()
+                last_message = monotonic()
+                if message_id == PIECE:
+                    chunk_number, begin, data = decode_piece(payload)
+                    # Not reading while over the limit makes TCP slow the sender down
+                    delay = self.download_limiter.reserve(peer_addr, len(data))
+                    if delay:
+                        sleep(delay)
+                    connection.outstanding.discard((chunk_number, begin, len(data)))
+                    if not self.verify_blocks(chunk_number, begin, data, proofs):
+                        with self.scheduler_condition:
+                            banned = self.reject_block(peer_addr, chunk_number, begin, len(data))
+                            self.scheduler_condition.notify_all()
+                        if banned:
+                            break  # Its other answers would be rejected too, stop waiting for them
+                        continue
+                    with self.scheduler_condition:
+                        piece_data, duplicates = self.scheduler.on_block_received(peer_addr, chunk_number, begin, data)
+                        self.cancel_requests(duplicates)  # Endgame copies of the block still on their way
+                    if piece_data is not None:
+                        # Hashing runs on the hash pool, this thread goes straight back to the socket
+                        hash_pool().submit(self.verify_received_chunk, chunk_number, piece_data).add_done_callback(
+                            lambda verification, chunk_number=chunk_number, piece_data=piece_data:
+                            self.finish_verification(chunk_number, piece_data, verification)
+                        )
+                    continue
+                elif message_id == REJECT:
+                    chunk_number, begin, length = decode_request(payload)
+                    with self.scheduler_condition:
+                        if peer_addr not in self.scheduler.choked:  # When choked, requests are released already
+                            print(f"Chunk {chunk_number} not found on peer {peer_addr}")
+                            self.scheduler.on_request_failed(peer_addr, (chunk_number, begin, length))
+                            self.scheduler_condition.notify_all()
+                elif message_id == PROOF:
+                    chunk_number, begin, hashes = decode_proof(payload)
+                    proofs[(chunk_number, begin)] = hashes
+                    continue
+                elif message_id == HAVE:
+                    self.record_peer_have(peer_addr, decode_have(payload))
+                    continue
+                elif message_id == PEX:
+                    self.apply_pex(peer_addr, payload)
+                    continue
+                elif message_id == CHOKE:
+                    print(f"Choked by {peer_addr}")
+                    with self.scheduler_condition:
+                        self.scheduler.on_choked(peer_addr)  # Its outstanding requests go to the other workers
+                        self.scheduler_condition.notify_all()
+                    connection.outstanding.clear()
+                    continue
+                elif message_id == UNCHOKE:
+                    with self.scheduler_condition:
+                        self.scheduler.on_unchoked(peer_addr)
+                    continue
+                else:
+                    continue
+                connection.outstanding.discard((chunk_number, begin, length))
+        except Exception as e:
+            print(f"Error downloading from {peer_addr}: {e}")
+            self.drop_peer_connection(peer_addr)
+        finally:
+            with self.scheduler_condition:
+                self.scheduler.release_peer(peer_addr)  # Hand its outstanding requests to the other workers
+                self.scheduler_condition.notify_all()
+            self.download_limiter.remove_peer(peer_addr)  # Its token bucket is created again if we come back to it
+
+    def reject_block(self, peer_addr, chunk_number, begin, length):
+        """
+        Hands a block that failed its Merkle proof back to the scheduler, so that only this
+        block is requested again, from another peer. Shared by the threaded and the asyncio engine.
+        RETURNS:
+        True if the peer is now banned.
+        """
+        print(f"Block {begin} of chunk {chunk_number} from {peer_addr} failed verification")
+        if self.scheduler.on_block_corrupt(peer_addr, (chunk_number, begin, length)):
+            print(f"Peer {peer_addr} sent too many corrupt chunks, no longer downloading from it")
+            return True
+        return False
+
+    def verify_received_chunk(self, chunk_number, chunk_data):
+        """
+        Checks a downloaded chunk before it is written. Runs on the hash pool.
+        PARAMETERS:
+        chunk_number: The number of the received chunk.
+        chunk_data: The chunk data.
+        RETURNS:
+        True if the data has the length of the chunk and, when the metadata is known, its hash.
+        """
+        if len(chunk_data) != self.storage.piece_length(chunk_number):
+            return False  # A short or overlong answer can never be the chunk
+        if self.merkle_tree is not None:
+            # Every block was proven on arrival, the chunk must consist of exactly those blocks
+            return self.merkle_tree.has_leaves(self.first_leaf(chunk_number), leaf_hashes(chunk_data))
+        if self.piece_hashes is None:
+            return True
+        return verify_chunk(chunk_data, self.piece_hashes[chunk_number - 1])
+
+    def finish_verification(self, chunk_number, chunk_data, verification):
+        """
+        Stores a verified chunk, or hands a corrupt one back to the scheduler, and wakes the
+        workers waiting for requests to be released. Called from the hash pool.
+        PARAMETERS:
+        verification: The finished Future of verify_received_chunk. The executor would
+                      swallow an exception raised here, so a failed verification is
+                      handled rather than re-raised.
+        """
+        with self.scheduler_condition:
+            error = verification.exception()
+            if error is not None:
+                self.handle_verification_error(chunk_number, error)
+            else:
+                self.handle_verified_chunk(chunk_number, chunk_data, verification.result())
+            self.scheduler_condition.notify_all()
+
+    def handle_verification_error(self, chunk_number, error):
+        """
+        Puts a chunk whose verification raised back into the pool without blaming the peers
+        that sent it. Shared by the threaded and the asyncio engine.
+        """
+        print(f"Could not verify chunk {chunk_number}: {error!r}")
+        self.scheduler.on_verification_error(chunk_number)
+
+    def handle_verified_chunk(self, chunk_number, chunk_data, valid):
+        """
+        Applies the outcome of a chunk verification. Shared by the threaded and the asyncio engine.
+        PARAMETERS:
+        chunk_number: The number of the received chunk.
+        chunk_data: The chunk data, assembled from blocks that may come from several peers.
+        valid: Whether the chunk passed verification.
+        """
+        if valid:
+            contributors = self.scheduler.on_piece_verified(chunk_number)
+            for peer_addr, byte_count in contributors.items():
+                self.choker.record_download(peer_addr, byte_count)  # Only good data earns an upload slot
+            if chunk_number not in self.received_chunks:
+                self.store_received_chunk(chunk_number, chunk_data, ", ".join(sorted(contributors)))
+            return
+        # The chunk was never marked complete, so the piece is still missing and another peer will be asked
+        peers = ", ".join(sorted(self.scheduler.verifying.get(chunk_number, ())))
+        print(f"Chunk {chunk_number} from {peers} failed verification")
+        for peer_addr in self.scheduler.on_piece_corrupt(chunk_number):
+            print(f"Peer {peer_addr} sent too many corrupt chunks, no longer downloading from it")
+
+    def wait_for_verifications(self):
+        """
+        Waits until every received chunk has been verified, so the pieces are either stored
+        or back in the pool before the next round of downloads starts.
+        """
+        with self.scheduler_condition:
+            while self.scheduler.verifying:
+                self.scheduler_condition.wait(timeout=1)
+
+    def expire_requests(self):
+        """
+        Releases timed-out requests so other peers retry them, and cancels them on the slow peer.
+        Must be called with scheduler_condition held.
+        """
+        expired = self.scheduler.expire_requests()
+        for peer_addr, (chunk_number, begin, length) in expired:
+            print(f"Request for chunk {chunk_number} at {begin} to {peer_addr} timed out")
+        self.cancel_requests(expired)
+        if expired:
+            self.scheduler_condition.notify_all()
+
+    def cancel_requests(self, requests):
+        """
+        Withdraws block requests on the connections they were sent on.
+        PARAMETERS:
+        requests: A list of (peer address, (piece, begin, length)).
+        """
+        for peer_addr, (chunk_number, begin, length) in requests:
+            connection = self.peer_connections.get(peer_addr)
+            if connection:
+                try:
+                    connection.cancel(chunk_number, begin, length)
+                except OSError:
+                    pass
+
+    def display_download_rates(self):
+        """
+        Displays the aggregate and per-peer download rates.
+        """
+        print(f"Download rate: {self.scheduler.download_rate() / 1024:.1f} KB/s")
+        for peer_addr, rate in self.scheduler.peer_rates().items():
+            print(f"  {peer_addr}: {rate / 1024:.1f} KB/s")
+
+    def store_received_chunk(self, chunk_number, chunk_data, peer_addr):
+        """
+        Writes a downloaded chunk at its offset in the file, marks it complete and
+        announces it to connected peers.
+        PARAMETERS:
+        chunk_number: The number of the received chunk.
+        chunk_data: The chunk data.
+        peer_addr: The peer the chunk came from.
+        """
+        if not self.storage.read_only:  # A read-only file is the original being shared, it already holds the data
+            self.resume.record_write(chunk_number)  # Journaled first, so a restart re-hashes it if we are killed
+            self.storage.write_piece(chunk_number, chunk_data)  # Written in place, no reassembly needed
+        self.received_chunks.add(chunk_number)
+        self.piece_manager.mark_piece_complete(chunk_number)
+        with self.chunk_stored:
+            self.chunk_stored.notify_all()
+        print(f"Downloaded chunk {chunk_number} from {peer_addr}")
+        self.display_progress()
+        if self.scheduler:
+            print(f"Download rate: {self.scheduler.download_rate() / 1024:.1f} KB/s")
+        self.broadcast_have(chunk_number)
+        self.resume.save_if_due(self.received_chunks, self.storage.flush)
+
+    def save_resume_data(self):
+        """
+        Flushes the file and records the verified chunks, e.g. when the download completes.
+        """
+        self.storage.flush()
+        self.resume.save(self.received_chunks)
 
     def display_progress(self):
         """ 
-        Displays the download progress as a percentage.
+        Displays the download progress as a percentage of the wanted chunks.
         """
-        progress = (len(self.received_chunks) / self.total_chunks) * 100
+        progress = self.piece_manager.progress() * 100
         print(f"File download progress: {progress:.2f}%")
 
     def listen_for_requests(self):
@@ -160,76 +1092,276 @@ class Peer:
 
     def handle_chunk_request(self, conn):
         """
-        Handles requests for chunks from other peers.
+        Serves one long-lived connection from another peer.
+        The connection carries length-prefixed messages until the remote side closes it.
+        Incoming requests are queued so that a CANCEL arriving before a request is served
+        can still withdraw it. The remote peer gets an upload slot from the choker, and its
+        requests are rejected while it is choked.
+        PARAMETERS:
+        conn: The accepted socket.
         """
+        remote_addr = None  # Listening address of the remote peer, known after its handshake
+        upload_addr = None  # Key of the connection in the choker, the remote_addr if it sent a handshake
+        pending_requests = deque()
+        send_lock = threading.Lock()  # Choke decisions are sent from the choking thread
+
+        def send_control_message(message_id, payload=b""):
+            with send_lock:
+                send_message(conn, message_id, payload)
+
         try:
-            chunk_number = int(conn.recv(1024).decode())  # Reading the requested chunk number
-            if chunk_number in self.peer_chunks:
-                conn.send(self.peer_chunks[chunk_number])  # Sending the requested chunk
-                # Update the upload contribution for the requesting peer
-                peer_ip = conn.getpeername()[0]
-                self.uploaded_chunks[peer_ip] = self.uploaded_chunks.get(peer_ip, 0) + 1
-                print(f"Uploaded chunk {chunk_number} to {peer_ip}")
-            else:
-                conn.send(b"CHUNK_NOT_FOUND")  # Inform if the chunk is not available
+            while True:
+                # Drain everything the remote side has sent before serving the next request
+                if not pending_requests or self.has_incoming_data(conn):
+                    message_id, payload = read_message(conn)
+                    if message_id == HANDSHAKE:
+                        remote_addr = decode_handshake(payload)
+                    elif message_id == REQUEST:
+                        pending_requests.append(decode_request(payload))
+                    elif message_id == CANCEL:
+                        request = decode_request(payload)
+                        if request in pending_requests:
+                            pending_requests.remove(request)
+                    elif message_id == HAVE:
+                        self.record_peer_have(remote_addr, decode_have(payload))
+                    elif message_id == GET_BITFIELD:
+                        with send_lock:
+                            conn.sendall(encode_bitfield(self.received_chunks))
+                    elif message_id == PEX:
+                        self.apply_pex(remote_addr, payload)
+                    elif message_id is not KEEPALIVE:
+                        print(f"Ignoring unexpected message {message_id} from {remote_addr}")
+                    if upload_addr is None:
+                        upload_addr = remote_addr or "{}:{}".format(*conn.getpeername()[:2])
+                        self.add_upload_connection(upload_addr, send_control_message)
+                    continue
+
+                chunk_number, begin, length = pending_requests.popleft()
+                with send_lock:
+                    self.send_chunk(conn, upload_addr, chunk_number, begin, length)
+        except ConnectionError:
+            pass  # The remote peer closed the connection
         except Exception as e:
             print(f"Error handling chunk request: {e}")
         finally:
+            if upload_addr is not None:
+                self.remove_upload_connection(upload_addr)
             conn.close()
 
-    def request_chunk_from_peer(self, peer_addr, chunk_number):
+    @staticmethod
+    def has_incoming_data(conn):
         """
-        Requests a specific chunk from another peer.
-        PARAMETERS:
-        peer_addr: The address of the peer to request from.
-        chunk_number: The number of the chunk to request.
+        Checks without blocking whether the socket has data waiting to be read.
         """
-        try:
-            peer_ip, peer_port = peer_addr.split(":")
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((peer_ip, int(peer_port)))
-            peer_socket.send(str(chunk_number).encode())  # Send the chunk request
-            
-            # Receive the chunk data
-            chunk_data = peer_socket.recv(CHUNK_SIZE)
-            peer_socket.close()
-
-            # Check if the chunk was not found
-            if chunk_data == b"CHUNK_NOT_FOUND":
-                print(f"Chunk {chunk_number} not found on peer {peer_addr}")
-                return False, f"Chunk {chunk_number} not found on peer {peer_addr}"
-            
-            # Return the successfully retrieved chunk data
-            return True, chunk_data
+        readable, _, _ = select.select([conn], [], [], 0)
+        return bool(readable)
 
-        except Exception as e:
-            print(f"Error requesting chunk {chunk_number} from {peer_addr}: {e}")
-            # Return False with the error message
-            return False, f"Error requesting chunk {chunk_number} from {peer_addr}: {e}"
+    def send_chunk(self, conn, peer_addr, chunk_number, begin, length):
+        """
+        Answers a single request with a PIECE message, or a REJECT if we do not have the data
+        or the peer is choked. The chunk data goes from the file on disk straight to the socket.
+        PARAMETERS:
+        conn: The socket of the requesting peer.
+        peer_addr: The address of the requesting peer in the choker.
+        chunk_number: The number of the requested chunk.
+        begin: Offset inside the chunk.
+        length: Maximum number of bytes requested.
+        """
+        frame, count = self.prepare_chunk_response(peer_addr, chunk_number, begin, length)
+        delay = self.upload_limiter.reserve(peer_addr, count) if count else 0
+        if delay:
+            sleep(delay)
+        conn.sendall(frame)
+        if count:
+            self.storage.send_piece(conn, chunk_number, begin, count)
 
-    def update_top_peers(self):
+    def prepare_chunk_response(self, peer_addr, chunk_number, begin, length):
         """
-        Updates the list of top 4 peers based on the number of chunks they've uploaded.
+        Decides how to answer a chunk request. Shared by the threaded and the asyncio engine.
+        PARAMETERS:
+        peer_addr: The address of the requesting peer in the choker.
+        chunk_number: The number of the requested chunk.
+        begin: Offset inside the chunk.
+        length: Maximum number of bytes requested.
+        RETURNS:
+        A tuple of (frame, count). Either frame is a complete REJECT message and count is 0,
+        or frame is the header of a PIECE message that count bytes of chunk data must follow,
+        preceded in Merkle torrents by the PROOF messages of its blocks.
         """
-        sorted_peers = sorted(self.uploaded_chunks.items(), key=lambda item: item[1], reverse=True)
-        self.top_peers = [peer[0] for peer in sorted_peers[:4]]  # Top 4 peers by upload contribution
-        
-        # Select a random peer outside the top 4 for optimistic unchoking
-        non_top_peers = [peer for peer in self.tracker_peers if peer not in self.top_peers]
-        self.optimistic_peer = random.choice(non_top_peers) if non_top_peers else None
+        if not self.choker.is_unchoked(peer_addr):
+            return encode_reject(chunk_number, begin, length), 0  # Choked peers are not served
+        if chunk_number not in self.received_chunks or begin >= self.storage.piece_length(chunk_number):
+            return encode_reject(chunk_number, begin, length), 0  # Inform if the chunk is not available
 
-        print(f"Top 4 peers: {self.top_peers}")
-        print(f"Optimistically unchoked peer: {self.optimistic_peer}")
+        _, count = self.storage.piece_range(chunk_number, begin, length)
+        proofs = self.block_proofs(chunk_number, begin, count)
+        if proofs is None:
+            return encode_reject(chunk_number, begin, length), 0  # The data cannot be proven to the peer
+        self.choker.record_upload(peer_addr, count)
+        print(f"Uploaded chunk {chunk_number} to {peer_addr}")
+        return proofs + encode_piece_header(chunk_number, begin, count), count
 
-    def refresh_top_peers_periodically(self, interval=30):
+    def add_upload_connection(self, peer_addr, send_control_message):
         """
-        Periodically refreshes the list of top peers every given interval.
+        Registers a connection of a peer downloading from us with the choker. If no upload
+        slot is free, the peer is told it is choked until the next recalculation.
         PARAMETERS:
-        interval: Time in seconds between each refresh.
+        peer_addr: The address of the peer.
+        send_control_message: Function sending a message id and an optional payload on the
+                              connection, used for CHOKE, UNCHOKE and PEX.
         """
+        with self.choker_lock:
+            self.upload_connections[peer_addr] = send_control_message
+            unchoked = self.choker.add_peer(peer_addr)
+        if not unchoked:
+            send_control_message(CHOKE)
+
+    def remove_upload_connection(self, peer_addr):
+        with self.choker_lock:
+            self.upload_connections.pop(peer_addr, None)
+            self.choker.remove_peer(peer_addr)
+        self.upload_limiter.remove_peer(peer_addr)
+        if peer_addr not in self.connected_peers():
+            self.pex_sent.pop(peer_addr, None)  # A new connection starts the exchange over
+
+    def choke_peers(self):
+        """
+        Lets the choker hand out the upload slots again, and tells the peers whose state changed.
+        """
+        with self.choker_lock:
+            seeding = self.total_chunks > 0 and len(self.received_chunks) == self.total_chunks
+            unchoked, choked = self.choker.recalculate(seeding)
+            notifications = [(self.upload_connections.get(peer_addr), UNCHOKE) for peer_addr in unchoked]
+            notifications += [(self.upload_connections.get(peer_addr), CHOKE) for peer_addr in choked]
+        for send_control_message, message_id in notifications:
+            if send_control_message is None:
+                continue
+            try:
+                send_control_message(message_id)
+            except OSError:
+                pass  # The connection is closing, its handler unregisters it
+        if unchoked or choked:
+            print(f"Unchoked {unchoked}, choked {choked}, optimistic unchoke {self.choker.optimistic_peer}")
+
+    def choke_peers_periodically(self):
         while True:
-            self.update_top_peers()  # Update the top peers
-            sleep(interval)
+            sleep(CHOKE_INTERVAL)
+            self.choke_peers()
+
+    def record_peer_have(self, peer_addr, chunk_number):
+        """
+        Records that a known peer announced a new chunk.
+        PARAMETERS:
+        peer_addr: The listening address of the peer, None if it did not handshake.
+        chunk_number: The chunk the peer now has.
+        """
+        if peer_addr in self.tracker_peers and chunk_number not in self.tracker_peers[peer_addr]:
+            self.tracker_peers[peer_addr].add(chunk_number)
+            if self.piece_manager:
+                self.piece_manager.update_available_pieces([chunk_number])
+
+    def get_peer_connection(self, peer_addr):
+        """
+        Returns the open connection to a peer, connecting first if there is none yet.
+        """
+        with self.connections_lock:
+            connection = self.peer_connections.get(peer_addr)
+            if connection is None:
+                connection = PeerConnection(peer_addr, f"{self.peer_ip}:{self.peer_port}")
+                self.peer_connections[peer_addr] = connection
+            return connection
+
+    def drop_peer_connection(self, peer_addr):
+        """
+        Closes and forgets the connection to a peer, e.g. after a network error.
+        """
+        with self.connections_lock:
+            connection = self.peer_connections.pop(peer_addr, None)
+        self.pex_sent.pop(peer_addr, None)  # A new connection starts the exchange over
+        self.download_limiter.remove_peer(peer_addr)
+        if connection:
+            connection.close()
+
+    def broadcast_have(self, chunk_number):
+        """
+        Tells every peer we are connected to that we now have a chunk.
+        """
+        with self.connections_lock:
+            connections = list(self.peer_connections.items())
+        for peer_addr, connection in connections:
+            try:
+                connection.send_have(chunk_number)
+            except OSError:
+                self.drop_peer_connection(peer_addr)
+
+    def request_chunks_from_peer(self, peer_addr, chunk_numbers):
+        """
+        Requests several chunks from one peer over its long-lived connection.
+        Up to PIPELINE_DEPTH requests are kept outstanding at the same time.
+        PARAMETERS:
+        peer_addr: The address of the peer to request from.
+        chunk_numbers: The numbers of the chunks to request.
+        RETURNS:
+        A dictionary mapping each chunk number to its data, or None if the peer did not send it.
+        """
+        results = {chunk_number: None for chunk_number in chunk_numbers}
+        to_request = deque(chunk_numbers)
+        waiting = set()
+        chunk_size = self.storage.piece_size if self.storage else CHUNK_SIZE  # Asks for whole chunks
+        proofs = {}  # (chunk number, begin) -> Merkle proof of a block of the next PIECE
+        try:
+            connection = self.get_peer_connection(peer_addr)
+            while to_request or waiting:
+                # Keep the pipeline full
+                while to_request and len(waiting) < PIPELINE_DEPTH:
+                    chunk_number = to_request.popleft()
+                    connection.request(chunk_number, 0, chunk_size)
+                    waiting.add(chunk_number)
+
+                message_id, payload = connection.receive()
+                if message_id == PIECE:
+                    chunk_number, begin, data = decode_piece(payload)
+                    delay = self.download_limiter.reserve(peer_addr, len(data))
+                    if delay:
+                        sleep(delay)
+                    if self.verify_blocks(chunk_number, begin, data, proofs):
+                        results[chunk_number] = data
+                    else:
+                        print(f"Chunk {chunk_number} from {peer_addr} failed verification")
+                elif message_id == REJECT:
+                    chunk_number, begin, length = decode_request(payload)
+                    print(f"Chunk {chunk_number} not found on peer {peer_addr}")
+                elif message_id == PROOF:
+                    chunk_number, begin, hashes = decode_proof(payload)
+                    proofs[(chunk_number, begin)] = hashes
+                    continue
+                elif message_id == HAVE:
+                    self.record_peer_have(peer_addr, decode_have(payload))
+                    continue
+                elif message_id == PEX:
+                    self.apply_pex(peer_addr, payload)
+                    continue
+                else:
+                    continue
+                connection.outstanding.discard((chunk_number, begin, chunk_size))
+                waiting.discard(chunk_number)
+        except Exception as e:
+            print(f"Error requesting chunks {sorted(waiting)} from {peer_addr}: {e}")
+            self.drop_peer_connection(peer_addr)
+        return results
+
+    def request_chunk_from_peer(self, peer_addr, chunk_number):
+        """
+        Requests a specific chunk from another peer.
+        PARAMETERS:
+        peer_addr: The address of the peer to request from.
+        chunk_number: The number of the chunk to request.
+        """
+        chunk_data = self.request_chunks_from_peer(peer_addr, [chunk_number])[chunk_number]
+        if chunk_data is None:
+            return False, f"Chunk {chunk_number} could not be retrieved from peer {peer_addr}"
+        # Return the successfully retrieved chunk data
+        return True, chunk_data
 
 if __name__ == "__main__":
     peer_ip = "127.0.0.1"  # Replace with the actual peer IP
@@ -0,0 +1,323 @@
+import socket
+import select
+import struct
+import threading
+
+# Every message on the peer wire is framed as a 4 byte big-endian length followed by
+# the message body. The body starts with a 1 byte message id and the rest is the payload.
+# A frame with length 0 carries no id at all and is used as a keepalive.
+LENGTH_PREFIX = struct.Struct(">I")
+REQUEST_FORMAT = struct.Struct(">III")  # piece index, offset inside the piece, length
+PIECE_HEADER = struct.Struct(">II")  # piece index, offset inside the piece
+HAVE_FORMAT = struct.Struct(">I")  # piece index
+
+# Message ids (kept close to the BitTorrent numbering where there is an equivalent)
+CHOKE = 0  # the sender will not serve our requests for now, and rejects those it has queued
+UNCHOKE = 1  # the sender serves our requests again
+HAVE = 4
+BITFIELD = 5  # every chunk the sender has, as the bytes of a Bitfield
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+HANDSHAKE = 20  # first message on a connection, carries the listening address of the sender
+REJECT = 21  # the requested range is not available on this peer
+GET_BITFIELD = 22  # asks for a BITFIELD, e.g. by peers found through the DHT that know nothing else about us
+PEX = 23  # peer exchange: peers the sender knows and their chunks, in the line format of the tracker's peer lists
+PROOF = 24  # Merkle proof of the block in the PIECE message that follows, in torrents that only have a Merkle root
+
+KEEPALIVE = None  # read_message returns this id for an empty keepalive frame
+
+MAX_MESSAGE_LENGTH = 2 * 1024 * 1024  # refuse frames bigger than this, protects against garbage lengths
+PIPELINE_DEPTH = 8  # number of requests a downloader keeps outstanding on one connection
+BLOCK_SIZE = 16 * 1024  # bytes asked for by one request, pieces are downloaded in blocks of this size
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the remote side sends something that is not a valid frame.
+    """
+
+
+def recv_exact(sock, length):
+    """
+    Reads exactly `length` bytes from the socket, looping over partial reads.
+    PARAMETERS:
+    sock: The socket to read from.
+    length: Number of bytes to read.
+    RETURNS:
+    The bytes read.
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if count == 0:
+            raise ConnectionError("Connection closed by remote peer")
+        received += count
+    return bytes(buffer)
+
+
+def encode_message(message_id, payload=b""):
+    """
+    Builds a single framed message.
+    PARAMETERS:
+    message_id: One of the message id constants, or KEEPALIVE.
+    payload: The raw payload bytes of the message.
+    RETURNS:
+    The framed message as bytes.
+    """
+    if message_id is KEEPALIVE:
+        return LENGTH_PREFIX.pack(0)
+    return LENGTH_PREFIX.pack(len(payload) + 1) + bytes((message_id,)) + payload
+
+
+def send_message(sock, message_id, payload=b""):
+    """
+    Sends a framed message over the socket, making sure the whole frame goes out.
+    """
+    sock.sendall(encode_message(message_id, payload))
+
+
+def read_message(sock):
+    """
+    Reads one framed message from the socket.
+    RETURNS:
+    A tuple of (message_id, payload). message_id is KEEPALIVE for keepalive frames.
+    """
+    (length,) = LENGTH_PREFIX.unpack(recv_exact(sock, LENGTH_PREFIX.size))
+    if length == 0:
+        return KEEPALIVE, b""
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError(f"Message of {length} bytes exceeds the maximum of {MAX_MESSAGE_LENGTH}")
+    body = recv_exact(sock, length)
+    return body[0], body[1:]
+
+
+def encode_frame(payload):
+    """
+    Builds a length-prefixed frame without a message id, used by the tracker protocol.
+    """
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    """
+    Sends a length-prefixed frame without a message id, used by the tracker protocol.
+    """
+    sock.sendall(encode_frame(payload))
+
+
+def read_frame(sock):
+    """
+    Reads one length-prefixed frame without a message id.
+    RETURNS:
+    The payload bytes.
+    """
+    (length,) = LENGTH_PREFIX.unpack(recv_exact(sock, LENGTH_PREFIX.size))
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the maximum of {MAX_MESSAGE_LENGTH}")
+    return recv_exact(sock, length)
+
+
+async def read_frame_async(reader):
+    """
+    Reads one length-prefixed frame without a message id from an asyncio StreamReader.
+    RETURNS:
+    The payload bytes.
+    """
+    (length,) = LENGTH_PREFIX.unpack(await reader.readexactly(LENGTH_PREFIX.size))
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the maximum of {MAX_MESSAGE_LENGTH}")
+    return await reader.readexactly(length)
+
+
+async def read_message_async(reader):
+    """
+    Reads one framed message from an asyncio StreamReader.
+    RETURNS:
+    A tuple of (message_id, payload). message_id is KEEPALIVE for keepalive frames.
+    """
+    (length,) = LENGTH_PREFIX.unpack(await reader.readexactly(LENGTH_PREFIX.size))
+    if length == 0:
+        return KEEPALIVE, b""
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError(f"Message of {length} bytes exceeds the maximum of {MAX_MESSAGE_LENGTH}")
+    body = await reader.readexactly(length)
+    return body[0], body[1:]
+
+
+def encode_request(piece_index, begin, length):
+    return encode_message(REQUEST, REQUEST_FORMAT.pack(piece_index, begin, length))
+
+
+def encode_cancel(piece_index, begin, length):
+    return encode_message(CANCEL, REQUEST_FORMAT.pack(piece_index, begin, length))
+
+
+def encode_reject(piece_index, begin, length):
+    return encode_message(REJECT, REQUEST_FORMAT.pack(piece_index, begin, length))
+
+
+def decode_request(payload):
+    """
+    Decodes the payload of a REQUEST, CANCEL or REJECT message.
+    RETURNS:
+    A tuple of (piece_index, begin, length).
+    """
+    if len(payload) != REQUEST_FORMAT.size:
+        raise ProtocolError(f"Malformed request payload of {len(payload)} bytes")
+    return REQUEST_FORMAT.unpack(payload)
+
+
+def encode_piece(piece_index, begin, data):
+    return encode_message(PIECE, PIECE_HEADER.pack(piece_index, begin) + bytes(data))
+
+
+def encode_piece_header(piece_index, begin, length):
+    """
+    Builds the frame header of a PIECE message carrying `length` bytes of data, so the
+    data itself can be sent separately without copying it into the frame, e.g. with sendfile.
+    """
+    return (LENGTH_PREFIX.pack(1 + PIECE_HEADER.size + length) + bytes((PIECE,))
+            + PIECE_HEADER.pack(piece_index, begin))
+
+
+def decode_piece(payload):
+    """
+    Decodes the payload of a PIECE message.
+    RETURNS:
+    A tuple of (piece_index, begin, data).
+    """
+    if len(payload) < PIECE_HEADER.size:
+        raise ProtocolError("Malformed piece payload")
+    piece_index, begin = PIECE_HEADER.unpack_from(payload)
+    return piece_index, begin, payload[PIECE_HEADER.size:]
+
+
+def encode_have(piece_index):
+    return encode_message(HAVE, HAVE_FORMAT.pack(piece_index))
+
+
+def decode_have(payload):
+    if len(payload) != HAVE_FORMAT.size:
+        raise ProtocolError("Malformed have payload")
+    return HAVE_FORMAT.unpack(payload)[0]
+
+
+def encode_bitfield(bitfield):
+    return encode_message(BITFIELD, bitfield.to_bytes())
+
+
+def encode_get_bitfield():
+    return encode_message(GET_BITFIELD)
+
+
+def encode_pex(text):
+    return encode_message(PEX, text.encode())
+
+
+def encode_proof(piece_index, begin, hashes):
+    """
+    PARAMETERS:
+    hashes: The sibling hashes from the block's leaf up to the root.
+    """
+    return encode_message(PROOF, PIECE_HEADER.pack(piece_index, begin) + b"".join(hashes))
+
+
+def decode_proof(payload, hash_size=32):
+    """
+    Decodes the payload of a PROOF message.
+    RETURNS:
+    A tuple of (piece_index, begin, hashes).
+    """
+    if len(payload) < PIECE_HEADER.size or (len(payload) - PIECE_HEADER.size) % hash_size:
+        raise ProtocolError("Malformed proof payload")
+    piece_index, begin = PIECE_HEADER.unpack_from(payload)
+    hashes = [payload[offset:offset + hash_size] for offset in range(PIECE_HEADER.size, len(payload), hash_size)]
+    return piece_index, begin, hashes
+
+
+def encode_handshake(listen_addr):
+    """
+    PARAMETERS:
+    listen_addr: The "ip:port" on which the sending peer accepts connections.
+    """
+    return encode_message(HANDSHAKE, listen_addr.encode())
+
+
+def decode_handshake(payload):
+    return payload.decode()
+
+
+class PeerConnection:
+    """
+    A long-lived connection to one remote peer, used by the downloading side.
+    Requests are pipelined: several REQUEST messages can be sent before the first
+    PIECE comes back, so a single connection keeps the link busy.
+    """
+
+    def __init__(self, peer_addr, local_addr, timeout=10):
+        """
+        Opens the connection and sends the handshake.
+        PARAMETERS:
+        peer_addr: "ip:port" of the remote peer.
+        local_addr: "ip:port" on which this peer is listening, sent in the handshake.
+        timeout: Socket timeout in seconds for connect and reads.
+        """
+        self.peer_addr = peer_addr
+        peer_ip, peer_port = peer_addr.split(":")
+        self.sock = socket.create_connection((peer_ip, int(peer_port)), timeout=timeout)
+        self.send_lock = threading.Lock()  # requests, haves and cancels may come from different threads
+        self.outstanding = set()  # (piece_index, begin, length) of requests not answered yet
+        self.send(encode_handshake(local_addr))
+
+    def send(self, frame):
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def request(self, piece_index, begin, length):
+        """
+        Sends a REQUEST without waiting for the answer.
+        """
+        self.outstanding.add((piece_index, begin, length))
+        self.send(encode_request(piece_index, begin, length))
+
+    def cancel(self, piece_index, begin, length):
+        """
+        Withdraws an outstanding request.
+        """
+        self.outstanding.discard((piece_index, begin, length))
+        self.send(encode_cancel(piece_index, begin, length))
+
+    def send_have(self, piece_index):
+        self.send(encode_have(piece_index))
+
+    def receive(self):
+        """
+        Reads the next message from the connection, skipping keepalives.
+        RETURNS:
+        A tuple of (message_id, payload).
+        """
+        while True:
+            message_id, payload = read_message(self.sock)
+            if message_id is not KEEPALIVE:
+                return message_id, payload
+
+    def wait_readable(self, timeout=None):
+        """
+        Waits until data arrives, without reading any of it. Unlike a read that times out,
+        this never leaves part of a frame consumed, so the connection stays usable.
+        PARAMETERS:
+        timeout: Seconds to wait, the socket timeout if None.
+        RETURNS:
+        True if the next receive has data to read.
+        """
+        readable, _, _ = select.select([self.sock], [], [], self.sock.gettimeout() if timeout is None else timeout)
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
@@ -0,0 +1,144 @@
+import os
+import bisect
+
+MIN_PIECE_SIZE = 64 * 1024  # smallest piece, below this the per-piece overhead outweighs finer hashing
+MAX_PIECE_SIZE = 1024 * 1024  # largest piece, a whole piece must still fit in one PIECE message
+MAX_PIECE_COUNT = 2048  # pieces a file is split into before the piece size doubles
+
+
+def choose_piece_size(total_size):
+    """
+    Picks the piece size for a file of the given size. Every piece costs a hash in the
+    metadata, a bit in every bitfield the tracker and the peers exchange, and an entry in
+    the piece manager and the scheduler, so the count must not grow with the file. Every
+    piece is also the unit that is verified, and re-downloaded when corrupt, so pieces
+    must not be needlessly big either. The size doubles from MIN_PIECE_SIZE until the file
+    has at most MAX_PIECE_COUNT pieces, so big files have between MAX_PIECE_COUNT / 2 and
+    MAX_PIECE_COUNT of them. Small files have fewer, and are spread across peers in blocks.
+    PARAMETERS:
+    total_size: Size of the file in bytes.
+    RETURNS:
+    The piece size in bytes, a power of two.
+    """
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and total_size > piece_size * MAX_PIECE_COUNT:
+        piece_size *= 2
+    return piece_size
+
+
+def list_files(directory):
+    """
+    Lists the files of a directory tree in the order they are laid out in a multi-file torrent.
+    RETURNS:
+    A sorted list of (relative path, size) tuples, the paths use "/" on every platform.
+    """
+    files = []
+    for parent, subdirectories, names in os.walk(directory):
+        subdirectories.sort()
+        for name in names:
+            path = os.path.join(parent, name)
+            relative_path = os.path.relpath(path, directory).replace(os.sep, "/")
+            files.append((relative_path, os.path.getsize(path)))
+    return sorted(files)
+
+
+class PieceLayout:
+    """
+    How a file, or the files of a multi-file torrent laid out one after the other, are split
+    into pieces. The metadata, the storage and the hashing all derive the piece boundaries
+    from here, so the piece numbers and hashes always describe the same byte ranges.
+    Pieces are numbered from 1, like everywhere else in the project.
+
+    Pieces ignore file boundaries, a piece may end in one file and go on in the next.
+    The start offsets of the files are kept sorted, so the files a piece touches are
+    found with a binary search.
+    """
+
+    def __init__(self, total_size, piece_size=None, file_lengths=None, file_paths=None):
+        """
+        PARAMETERS:
+        total_size: Size of the file, or of all files together, in bytes.
+        piece_size: Size of every piece except possibly the last one, chosen from total_size if None.
+        file_lengths: Sizes of the files in torrent order, a single file of total_size if None.
+        file_paths: Relative paths of the files in torrent order, to look files up by name.
+        """
+        self.total_size = total_size
+        self.piece_size = piece_size or choose_piece_size(total_size)
+        self.piece_count = (total_size + self.piece_size - 1) // self.piece_size
+        self.file_lengths = list(file_lengths) if file_lengths is not None else [total_size]
+        if sum(self.file_lengths) != total_size:
+            raise ValueError(f"The files add up to {sum(self.file_lengths)} bytes, not {total_size}")
+        self.file_paths = list(file_paths) if file_paths is not None else []
+        self.file_offsets = []  # Offset of the first byte of every file in the concatenated data
+        offset = 0
+        for length in self.file_lengths:
+            self.file_offsets.append(offset)
+            offset += length
+
+    def file_index(self, relative_path):
+        """
+        RETURNS:
+        The index of a file of a multi-file torrent, from its relative path.
+        """
+        if relative_path not in self.file_paths:
+            raise FileNotFoundError(f"{relative_path} is not a file of the torrent")
+        return self.file_paths.index(relative_path)
+
+    def piece_offset(self, piece_number):
+        """
+        RETURNS:
+        Offset of the first byte of a piece in the file.
+        """
+        if not 1 <= piece_number <= self.piece_count:
+            raise IndexError(f"Piece {piece_number} is outside 1..{self.piece_count}")
+        return (piece_number - 1) * self.piece_size
+
+    def piece_length(self, piece_number):
+        """
+        RETURNS:
+        Length of a piece in bytes, the last piece may be shorter than piece_size.
+        """
+        offset = self.piece_offset(piece_number)
+        return min(self.piece_size, self.total_size - offset)
+
+    def piece_range(self, piece_number, begin, length):
+        """
+        RETURNS:
+        The (file offset, byte count) of up to `length` bytes at `begin` inside a piece.
+        """
+        count = max(0, min(length, self.piece_length(piece_number) - begin))
+        return self.piece_offset(piece_number) + begin, count
+
+    def pieces_in_range(self, offset, length):
+        """
+        RETURNS:
+        The range of the piece numbers holding any of `length` bytes at `offset` in the data.
+        """
+        end = min(offset + length, self.total_size)
+        if offset >= end:
+            return range(1, 1)
+        return range(offset // self.piece_size + 1, (end - 1) // self.piece_size + 2)
+
+    def segments(self, piece_number, begin=0, length=None):
+        """
+        Maps a range inside a piece to the files it is stored in.
+        PARAMETERS:
+        piece_number: The piece.
+        begin: Offset inside the piece.
+        length: Maximum number of bytes, the rest of the piece if None.
+        RETURNS:
+        A list of (file index, offset in the file, byte count) in data order, empty files skipped.
+        """
+        offset, remaining = self.piece_range(piece_number, begin, self.piece_size if length is None else length)
+        segments = []
+        # The last file starting at or before the offset, which skips the empty files starting there too
+        file_index = bisect.bisect_right(self.file_offsets, offset) - 1
+        while remaining > 0:
+            file_offset = offset - self.file_offsets[file_index]
+            count = min(remaining, self.file_lengths[file_index] - file_offset)
+            if count > 0:
+                segments.append((file_index, file_offset, count))
+                offset += count
+                remaining -= count
+            file_index += 1
+        return segments
@@ -1,7 +1,74 @@
-from collections import defaultdict
 import random
+import threading
+from bitfield import Bitfield
+
+SKIP = 0  # priority of pieces that are not downloaded at all
+LOW = 1
+NORMAL = 2  # priority of every piece until it is changed
+HIGH = 3
+SCAN_THRESHOLD = 256  # pieces a peer can offer us up to which a linear scan beats walking the buckets
+
+
+class PieceBucket:
+    """
+    A set of pieces that supports O(1) insertion, removal and random access.
+    Pieces are kept in a list, with a dictionary from piece to its position in the list.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.positions = {}
+
+    def add(self, piece):
+        self.positions[piece] = len(self.pieces)
+        self.pieces.append(piece)
+
+    def remove(self, piece):
+        # Move the last piece into the hole left by the removed one
+        position = self.positions.pop(piece)
+        last_piece = self.pieces.pop()
+        if last_piece != piece:
+            self.pieces[position] = last_piece
+            self.positions[last_piece] = position
+
+    def iterate_from_random_start(self):
+        """
+        Yields every piece once, starting at a random position, so that ties between
+        equally rare pieces are broken differently by every peer.
+        """
+        count = len(self.pieces)
+        start = random.randrange(count)
+        for offset in range(count):
+            yield self.pieces[(start + offset) % count]
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __contains__(self, piece):
+        return piece in self.positions
+
 
 class PieceManager:
+    """
+    Keeps track of how many peers have each piece and which pieces are still missing.
+    Missing pieces are indexed in frequency buckets keyed by (-priority, availability), so
+    availability changes are O(1) and the rarest pieces are found without scanning
+    every piece. Walking the keys in order visits the higher priorities first and the
+    rarest pieces first within each priority. Pieces that no peer has, and skipped
+    pieces, are not in any bucket.
+
+    Only the pieces that are not skipped are wanted: the download is complete, and its
+    progress is measured, relative to them. Skipping files or byte ranges of a big
+    torrent therefore downloads only the rest.
+
+    Every method that changes or walks the buckets holds the manager's lock, so the
+    threads of the threaded engine can announce, complete and pick pieces concurrently.
+
+    A streaming reader can set a priority window, a few pieces from its reading position
+    on. Missing pieces in the window are picked in order before any rarest piece, so the
+    data just ahead of the reader arrives first while the rest still spreads rarest first.
+    """
+
     def __init__(self, total_pieces):
         """
         Initializes the PieceManager.
@@ -9,32 +76,170 @@ class PieceManager:
         total_pieces: Total number of pieces in the file.
         """
         self.total_pieces = total_pieces
-        self.available_pieces = defaultdict(int)  # Tracks the number of copies for each piece
-        self.missing_pieces = set(range(1, total_pieces + 1))  # Tracks missing pieces
+        self.available_pieces = [0] * (total_pieces + 1)  # Number of copies of each piece, indexed by piece number
+        self.missing_pieces = Bitfield.full(total_pieces)  # Tracks missing pieces
+        self.buckets = {}  # (-priority, availability count) -> PieceBucket of missing pieces with that key
+        self.priorities = bytearray([NORMAL]) * (total_pieces + 1)  # Priority of each piece, indexed by piece number
+        self.wanted_count = total_pieces  # Pieces that are not skipped
+        self.missing_wanted = total_pieces  # Missing pieces that are not skipped
+        self.priority_window = range(0)  # Pieces ahead of a streaming reader, picked in order before the rarest ones
+        self.lock = threading.Lock()  # Guards the counts and the buckets, updated by upload handlers and download workers
 
     def update_available_pieces(self, peer_chunks):
         """
         Updates the availability of pieces based on a peer's available chunks.
         PARAMETERS:
-        peer_chunks: List of chunk numbers that a peer has.
+        peer_chunks: Bitfield or list of chunk numbers that a peer has.
         """
-        for piece in peer_chunks:
-            self.available_pieces[piece] += 1
+        with self.lock:
+            for piece in peer_chunks:
+                count = self.available_pieces[piece]
+                self.available_pieces[piece] = count + 1
+                if piece in self.missing_pieces:
+                    self._move(piece, count, count + 1)
+
+    def remove_available_pieces(self, peer_chunks):
+        """
+        Lowers the availability of pieces, e.g. when a peer leaves the swarm.
+        PARAMETERS:
+        peer_chunks: Bitfield or list of chunk numbers that the peer had.
+        """
+        with self.lock:
+            for piece in peer_chunks:
+                count = self.available_pieces[piece]
+                if count == 0:
+                    continue
+                self.available_pieces[piece] = count - 1
+                if piece in self.missing_pieces:
+                    self._move(piece, count, count - 1)
+
+    def set_priority(self, pieces, priority):
+        """
+        Changes the priority of pieces, e.g. of the pieces of a file.
+        PARAMETERS:
+        pieces: Iterable of piece numbers.
+        priority: SKIP, LOW, NORMAL or HIGH.
+        """
+        with self.lock:
+            for piece in pieces:
+                old_priority = self.priorities[piece]
+                if old_priority == priority:
+                    continue
+                self.priorities[piece] = priority
+                if (old_priority == SKIP) != (priority == SKIP):
+                    change = 1 if old_priority == SKIP else -1
+                    self.wanted_count += change
+                    if piece in self.missing_pieces:
+                        self.missing_wanted += change
+                if piece in self.missing_pieces:
+                    count = self.available_pieces[piece]
+                    self._move(piece, count, count, old_priority)
+
+    def set_priority_window(self, first_piece, count):
+        """
+        Makes pieces the most urgent, e.g. the ones a streaming reader is about to read.
+        PARAMETERS:
+        first_piece: The first piece of the window.
+        count: Number of pieces in the window, 0 goes back to plain rarest first.
+        """
+        with self.lock:
+            self.priority_window = range(max(first_piece, 1), min(first_piece + count, self.total_pieces + 1))
+
+    def _window_pieces(self, peer_chunks=None, exclude=()):
+        """
+        Yields the missing pieces of the priority window in order, that some peer (or the
+        given peer) has, skipping the excluded ones.
+        """
+        for piece in self.priority_window:
+            if piece in self.missing_pieces and piece not in exclude and self.available_pieces[piece] \
+                    and self.priorities[piece] != SKIP and (peer_chunks is None or piece in peer_chunks):
+                yield piece
 
     def get_rarest_piece(self):
         """
-        Returns the rarest piece that is still missing.
+        Returns the rarest piece that is still missing, picking randomly among equally rare pieces.
+        Pieces of the priority window come first.
         RETURNS:
-        The rarest piece number or None if all pieces are acquired.
+        The rarest piece number or None if no missing piece is available from any peer.
         """
-        rarest_piece = None
-        min_count = float('inf')
+        with self.lock:
+            for piece in self._window_pieces():
+                return piece
+            if not self.buckets:
+                return None
+            return random.choice(self.buckets[min(self.buckets)].pieces)
+
+    def get_rarest_pieces(self, k, exclude=()):
+        """
+        Returns up to k missing pieces, rarest first, with ties broken randomly.
+        Pieces of the priority window come first, in order.
+        PARAMETERS:
+        k: Maximum number of pieces to return.
+        exclude: Pieces to skip.
+        RETURNS:
+        A list of piece numbers.
+        """
+        with self.lock:
+            result = list(self._window_pieces(exclude=exclude))[:k]
+            if len(result) == k:
+                return result
+            if result:
+                exclude = set(exclude).union(result)
+            for key in sorted(self.buckets):
+                for piece in self.buckets[key].iterate_from_random_start():
+                    if piece not in exclude:
+                        result.append(piece)
+                        if len(result) == k:
+                            return result
+            return result
+
+    def get_rarest_piece_from(self, peer_chunks, exclude=()):
+        """
+        Returns the rarest missing piece among the chunks one peer has, or the first
+        piece of the priority window the peer has.
+        PARAMETERS:
+        peer_chunks: Bitfield or set of chunk numbers that the peer has.
+        exclude: Pieces to skip, e.g. the ones already requested from someone else.
+        RETURNS:
+        The rarest piece number or None if the peer has nothing we still need.
+        """
+        with self.lock:
+            for piece in self._window_pieces(peer_chunks, exclude):
+                return piece
+            if isinstance(peer_chunks, Bitfield):
+                # AND with the missing pieces in C first, so we only look at pieces we can use
+                peer_chunks = peer_chunks & self.missing_pieces
+            if len(peer_chunks) <= SCAN_THRESHOLD:
+                # The peer has few pieces we need: scanning them is cheaper than walking the buckets
+                return self._rarest_of(peer_chunks, exclude)
 
-        for piece, count in self.available_pieces.items():
-            if piece in self.missing_pieces and count < min_count:
-                min_count = count
-                rarest_piece = piece
+            for key in sorted(self.buckets):
+                for piece in self.buckets[key].iterate_from_random_start():
+                    if piece in peer_chunks and piece not in exclude:
+                        return piece
+            return None
 
+    def _rarest_of(self, peer_chunks, exclude):
+        """
+        Linear scan over a peer's chunks, choosing uniformly among the rarest ones of the
+        highest priority.
+        """
+        rarest_piece = None
+        min_key = None
+        ties = 0
+        for piece in peer_chunks:
+            if piece not in self.missing_pieces or piece in exclude:
+                continue
+            key = self._bucket_key(self.available_pieces[piece], self.priorities[piece])
+            if key is None:
+                continue  # Consistent with the buckets: pieces nobody announced and skipped pieces are not offered
+            if min_key is None or key < min_key:
+                rarest_piece, min_key, ties = piece, key, 1
+            elif key == min_key:
+                # Reservoir sampling keeps every tied piece equally likely
+                ties += 1
+                if random.randrange(ties) == 0:
+                    rarest_piece = piece
         return rarest_piece
 
     def mark_piece_complete(self, piece_number):
@@ -43,12 +248,69 @@ class PieceManager:
         PARAMETERS:
         piece_number: The piece number that has been completed.
         """
-        self.missing_pieces.discard(piece_number)
+        with self.lock:
+            if piece_number in self.missing_pieces:
+                self.missing_pieces.discard(piece_number)
+                if self.priorities[piece_number] != SKIP:
+                    self.missing_wanted -= 1
+                self._move(piece_number, self.available_pieces[piece_number], 0)
+
+    def mark_piece_missing(self, piece_number):
+        """
+        Puts a piece back into the missing set, e.g. when its data failed verification.
+        PARAMETERS:
+        piece_number: The piece number that has to be downloaded again.
+        """
+        with self.lock:
+            if piece_number not in self.missing_pieces:
+                self.missing_pieces.add(piece_number)
+                if self.priorities[piece_number] != SKIP:
+                    self.missing_wanted += 1
+                self._move(piece_number, 0, self.available_pieces[piece_number])
 
     def is_complete(self):
         """
-        Checks if all pieces have been downloaded.
+        Checks if all wanted pieces have been downloaded.
+        RETURNS:
+        True if every piece that is not skipped is complete, False otherwise.
+        """
+        return self.missing_wanted == 0
+
+    def progress(self):
+        """
         RETURNS:
-        True if all pieces are complete, False otherwise.
+        The fraction of the wanted pieces that are complete, 1.0 when nothing is wanted.
+        """
+        if not self.wanted_count:
+            return 1.0
+        return (self.wanted_count - self.missing_wanted) / self.wanted_count
+
+    @staticmethod
+    def _bucket_key(count, priority):
+        """
+        RETURNS:
+        The key of the bucket for a missing piece, None if it belongs in no bucket.
+        """
+        if count == 0 or priority == SKIP:
+            return None
+        return -priority, count
+
+    def _move(self, piece, old_count, new_count, old_priority=None):
+        """
+        Moves a missing piece from the bucket of old_count to the bucket of new_count.
+        A count of 0 means the piece is not in any bucket.
+        PARAMETERS:
+        old_priority: The priority the piece was bucketed with, when it just changed.
         """
-        return len(self.missing_pieces) == 0
+        priority = self.priorities[piece]
+        old_key = self._bucket_key(old_count, priority if old_priority is None else old_priority)
+        new_key = self._bucket_key(new_count, priority)
+        if old_key is not None:
+            bucket = self.buckets[old_key]
+            bucket.remove(piece)
+            if not bucket:
+                del self.buckets[old_key]
+        if new_key is not None:
+            if new_key not in self.buckets:
+                self.buckets[new_key] = PieceBucket()
+            self.buckets[new_key].add(piece)
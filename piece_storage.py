@@ -0,0 +1,178 @@
+import os
+import mmap
+import stat
+from piece_layout import PieceLayout
+
+
+class PieceStorage:
+    """
+    Stores the pieces of one file, or of the files of a multi-file torrent, directly in the
+    target files on disk. Every file is preallocated to its final size and memory-mapped,
+    each verified piece is written at its offset and uploads are served from the same
+    mappings. A finished download is therefore already the complete file or directory, and
+    memory use does not grow with file size: the operating system pages the mappings in and
+    out as needed. A piece spanning a file boundary is split over the files it covers.
+    Pieces are numbered from 1, like everywhere else in the project.
+
+    Existing files are never resized: a file with another size than expected is most likely
+    not the data of this torrent, and truncating it would destroy it. Files that are only
+    served, like the original a seeder shares, are opened read-only.
+    """
+
+    def __init__(self, path, total_size, piece_size=None, files=None, read_only=False):
+        """
+        Opens (and if needed creates and preallocates) the files.
+        PARAMETERS:
+        path: Path of the target file, or of the target directory of a multi-file torrent.
+        total_size: Size of the complete file, or of all files together, in bytes.
+        piece_size: Size of every piece except possibly the last one, chosen from total_size if None.
+        files: List of (relative path, size) of the files inside the directory `path`, in torrent
+               order. None stores a single file at `path`.
+        read_only: Open existing files for serving only, write_piece then raises.
+        """
+        self.path = path
+        self.read_only = read_only
+        self.total_size = total_size
+        self.layout = PieceLayout(total_size, piece_size, None if files is None else [size for _, size in files],
+                                  None if files is None else [file_path for file_path, _ in files])
+        self.piece_size = self.layout.piece_size
+        self.piece_count = self.layout.piece_count
+        # The piece boundaries come from the layout shared with the metadata and the hashing
+        self.piece_offset = self.layout.piece_offset
+        self.piece_length = self.layout.piece_length
+        self.piece_range = self.layout.piece_range
+
+        if files is None:
+            paths = [path]
+        else:
+            paths = [os.path.join(path, *relative_path.split("/")) for relative_path, _ in files]
+        self.files = []  # Open file objects, in torrent order
+        self.maps = []  # mmap of every file, None for empty files
+        for file_path, size in zip(paths, self.layout.file_lengths):
+            if os.path.exists(file_path):
+                file = open(file_path, 'rb' if read_only else 'r+b')
+                actual_size = os.fstat(file.fileno()).st_size
+                if actual_size != size:
+                    file.close()
+                    self.close()
+                    raise ValueError(f"{file_path} has {actual_size} bytes instead of {size}, refusing to resize it")
+            elif read_only:
+                self.close()
+                raise FileNotFoundError(f"{file_path} does not exist")
+            else:
+                directory = os.path.dirname(file_path)
+                if directory and not os.path.exists(directory):  # covering the edge case of a missing output directory
+                    os.makedirs(directory)
+                file = open(file_path, 'w+b')
+                self.preallocate(file, size)
+            self.files.append(file)
+            # mmap cannot map an empty file, an empty file simply has no data
+            access = mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE
+            self.maps.append(mmap.mmap(file.fileno(), size, access=access) if size else None)
+
+        # sendfile needs regular files, anything else is served from the mappings
+        self.can_sendfile = hasattr(os, "sendfile") and all(
+            stat.S_ISREG(os.fstat(file.fileno()).st_mode) for file in self.files
+        )
+
+    @staticmethod
+    def preallocate(file, size):
+        """
+        Sets a file to its final size, reserving the disk blocks where the platform supports it.
+        """
+        file.truncate(size)
+        if hasattr(os, "posix_fallocate") and size:
+            try:
+                os.posix_fallocate(file.fileno(), 0, size)
+            except OSError:
+                pass  # Some file systems do not support it, the sparse file from truncate still works
+
+    def file_segments(self, piece_number, begin, length):
+        """
+        RETURNS:
+        The (file object, offset in the file, byte count) ranges holding up to `length`
+        bytes at `begin` inside a piece, e.g. to send them with sendfile.
+        """
+        return [(self.files[file_index], file_offset, count)
+                for file_index, file_offset, count in self.layout.segments(piece_number, begin, length)]
+
+    def write_piece(self, piece_number, data, begin=0):
+        """
+        Writes piece data at its position in the files.
+        PARAMETERS:
+        piece_number: The piece the data belongs to.
+        data: The bytes to write.
+        begin: Offset of the data inside the piece.
+        """
+        if self.read_only:
+            raise PermissionError(f"{self.path} is opened read-only")
+        if begin + len(data) > self.piece_length(piece_number):
+            raise ValueError(f"{len(data)} bytes at offset {begin} do not fit in piece {piece_number}")
+        position = 0
+        for file_index, file_offset, count in self.layout.segments(piece_number, begin, len(data)):
+            self.maps[file_index][file_offset:file_offset + count] = data[position:position + count]
+            position += count
+
+    def read_piece(self, piece_number, begin=0, length=None):
+        """
+        Reads piece data, without copying it unless it spans several files.
+        PARAMETERS:
+        piece_number: The piece to read.
+        begin: Offset inside the piece.
+        length: Maximum number of bytes, the rest of the piece if None.
+        RETURNS:
+        A memoryview. It is only valid while the storage is open.
+        """
+        if length is None:
+            length = self.piece_length(piece_number) - begin
+        segments = self.layout.segments(piece_number, begin, length)
+        if len(segments) == 1:
+            file_index, file_offset, count = segments[0]
+            return memoryview(self.maps[file_index])[file_offset:file_offset + count]
+        return memoryview(b"".join(self.maps[file_index][file_offset:file_offset + count]
+                                   for file_index, file_offset, count in segments))
+
+    def send_piece(self, sock, piece_number, begin, length):
+        """
+        Sends piece data to a blocking socket without building intermediate bytes objects.
+        Regular files go through os.sendfile, so the kernel copies straight from the page
+        cache to the socket. Otherwise the data is sent from memoryviews of the mappings.
+        PARAMETERS:
+        sock: The connected socket.
+        piece_number: The piece to send from.
+        begin: Offset inside the piece.
+        length: Number of bytes to send, clamped to the end of the piece.
+        """
+        for file_index, offset, count in self.layout.segments(piece_number, begin, length):
+            if self.can_sendfile:
+                # os.sendfile takes an explicit offset, so concurrent uploads never race on a file position
+                while count > 0:
+                    sent = os.sendfile(sock.fileno(), self.files[file_index].fileno(), offset, count)
+                    if sent == 0:
+                        raise ConnectionError("Connection closed during sendfile")
+                    offset += sent
+                    count -= sent
+            else:
+                with memoryview(self.maps[file_index])[offset:offset + count] as view:
+                    sock.sendall(view)
+
+    def flush(self):
+        """
+        Writes dirty pages of the mappings back to disk.
+        """
+        if self.read_only:
+            return
+        for file_map in self.maps:
+            if file_map is not None:
+                file_map.flush()
+
+    def close(self):
+        self.flush()
+        for file_map in self.maps:
+            if file_map is not None:
+                try:
+                    file_map.close()
+                except BufferError:
+                    pass  # A memoryview handed out by read_piece is still alive, the mapping is freed with it
+        for file in self.files:
+            file.close()
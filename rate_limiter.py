@@ -0,0 +1,105 @@
+import threading
+from time import monotonic
+
+BURST_SECONDS = 0.25  # a bucket holds this many seconds of its rate, short enough to keep the flow smooth
+
+
+class TokenBucket:
+    """
+    Limits a byte rate. Tokens accumulate at `rate` bytes per second up to a capacity of
+    BURST_SECONDS worth of them, and every transfer takes its size in tokens. A transfer
+    bigger than what is left runs the bucket into debt, and the caller waits until the
+    debt is paid off, so blocks go out evenly spaced instead of in bursts followed by stalls.
+    Accounting happens once per block, never per byte.
+    """
+
+    def __init__(self, rate=None, clock=monotonic):
+        """
+        PARAMETERS:
+        rate: Limit in bytes per second, None for no limit.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        """
+        self.clock = clock
+        self.lock = threading.Lock()  # Buckets are shared by the threads of the threaded engine
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = clock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Changes the limit, e.g. at runtime. Tokens earned so far at the old rate are kept.
+        """
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if rate is not None:
+                self.tokens = min(self.tokens, self.capacity())
+
+    def capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def reserve(self, byte_count):
+        """
+        Takes the tokens for a transfer of byte_count bytes.
+        RETURNS:
+        Seconds the caller must wait before the transfer, 0 if it may go now.
+        """
+        with self.lock:
+            if self.rate is None:
+                return 0
+            self._refill()
+            self.tokens -= byte_count
+            return max(0.0, -self.tokens / self.rate)
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    The limits for one direction of transfer: a global TokenBucket shared by all peers,
+    and one TokenBucket per peer. A transfer waits for whichever of the two is slower.
+    """
+
+    def __init__(self, rate=None, peer_rate=None, clock=monotonic):
+        """
+        PARAMETERS:
+        rate: Global limit in bytes per second, None for no limit.
+        peer_rate: Limit for each peer in bytes per second, None for no limit.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        """
+        self.clock = clock
+        self.global_bucket = TokenBucket(rate, clock)
+        self.peer_rate = peer_rate
+        self.peer_buckets = {}  # "ip:port" -> TokenBucket
+        self.lock = threading.Lock()  # Guards peer_buckets
+
+    def set_rate(self, rate):
+        self.global_bucket.set_rate(rate)
+
+    def set_peer_rate(self, peer_rate):
+        with self.lock:
+            self.peer_rate = peer_rate
+            buckets = list(self.peer_buckets.values())
+        for bucket in buckets:
+            bucket.set_rate(peer_rate)
+
+    def reserve(self, peer_addr, byte_count):
+        """
+        Takes the tokens for a transfer of byte_count bytes to or from a peer.
+        RETURNS:
+        Seconds the caller must wait before the transfer, 0 if it may go now.
+        """
+        with self.lock:
+            bucket = self.peer_buckets.get(peer_addr)
+            if bucket is None:
+                bucket = self.peer_buckets[peer_addr] = TokenBucket(self.peer_rate, self.clock)
+        return max(self.global_bucket.reserve(byte_count), bucket.reserve(byte_count))
+
+    def remove_peer(self, peer_addr):
+        with self.lock:
+            self.peer_buckets.pop(peer_addr, None)
@@ -0,0 +1,50 @@
+from collections import deque
+from time import monotonic
+
+RATE_WINDOW = 10  # seconds of history used to compute a transfer rate
+
+
+class RateMeter:
+    """
+    Measures a transfer rate in bytes per second over a sliding time window.
+    Samples are recorded per block or piece, never per byte.
+    """
+
+    def __init__(self, window=RATE_WINDOW, clock=monotonic):
+        """
+        PARAMETERS:
+        window: Length of the sliding window in seconds.
+        clock: Function returning the current time in seconds, replaceable for tests.
+        """
+        self.window = window
+        self.clock = clock
+        self.samples = deque()  # (timestamp, byte count) pairs inside the window
+        self.window_bytes = 0  # Sum of the byte counts in samples
+        self.total_bytes = 0  # Bytes recorded since the meter was created
+        self.started = clock()
+
+    def record(self, byte_count):
+        """
+        Records a transfer of byte_count bytes that just finished.
+        """
+        now = self.clock()
+        self.samples.append((now, byte_count))
+        self.window_bytes += byte_count
+        self.total_bytes += byte_count
+        self._expire(now)
+
+    def rate(self):
+        """
+        RETURNS:
+        The average rate in bytes per second over the window.
+        """
+        now = self.clock()
+        self._expire(now)
+        # A meter younger than the window only averages over the time it has existed
+        elapsed = min(self.window, max(now - self.started, 1e-3))
+        return self.window_bytes / elapsed
+
+    def _expire(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            _, byte_count = self.samples.popleft()
+            self.window_bytes -= byte_count
@@ -0,0 +1,93 @@
+import io
+from piece_manager import SKIP
+
+READAHEAD_PIECES = 8  # pieces from the reading position on that are downloaded before any rarest piece
+
+
+class StreamReader(io.RawIOBase):
+    """
+    Reads the data of a torrent in order while it is still downloading, so a consumer can
+    process a big file from the start instead of waiting for the whole download. A read
+    returns at once when its chunk is on disk and only blocks on a chunk that has not
+    arrived yet.
+
+    Every read moves the priority window of the peer's PieceManager to the chunks from
+    the reading position on, so those are requested before any rarest piece. Only one
+    reader per peer should be open at a time, the last read decides the window.
+    """
+
+    def __init__(self, peer, relative_path=None, readahead=READAHEAD_PIECES, timeout=None):
+        """
+        PARAMETERS:
+        peer: The Peer downloading the data, its storage must be open.
+        relative_path: The file to read in a multi-file torrent, all data laid out in torrent order if None.
+        readahead: Number of chunks from the reading position on that are downloaded first.
+        timeout: Seconds a read waits for a missing chunk before raising TimeoutError, forever if None.
+        """
+        super().__init__()
+        if peer.storage is None:
+            raise ValueError("The peer has no storage to read from, open it first")
+        self.peer = peer
+        self.layout = peer.storage.layout
+        self.readahead = readahead
+        self.timeout = timeout
+        self.start = 0  # Offset of the first byte of the file in the torrent data
+        self.size = self.layout.total_size
+        if relative_path is not None:
+            file_index = self.layout.file_index(relative_path)
+            self.start = self.layout.file_offsets[file_index]
+            self.size = self.layout.file_lengths[file_index]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        """
+        Reads up to len(buffer) bytes from the current position, never past the end of its chunk.
+        RETURNS:
+        The number of bytes read, 0 at the end of the file.
+        """
+        if self.position >= self.size or not len(buffer):
+            return 0
+        offset = self.start + self.position
+        chunk_number = offset // self.layout.piece_size + 1
+        self.wait_for_chunk(chunk_number)
+        begin = offset - self.layout.piece_offset(chunk_number)
+        count = min(len(buffer), self.size - self.position, self.layout.piece_length(chunk_number) - begin)
+        with self.peer.storage.read_piece(chunk_number, begin, count) as view:
+            buffer[:count] = view
+        self.position += count
+        return count
+
+    def wait_for_chunk(self, chunk_number):
+        """
+        Moves the priority window to a chunk and blocks until it is on disk.
+        """
+        if chunk_number not in self.peer.received_chunks and self.peer.piece_manager.priorities[chunk_number] == SKIP:
+            raise ValueError(f"Chunk {chunk_number} is skipped, change its priority to read it")
+        self.peer.piece_manager.set_priority_window(chunk_number, self.readahead)
+        with self.peer.chunk_stored:
+            if not self.peer.chunk_stored.wait_for(lambda: chunk_number in self.peer.received_chunks, self.timeout):
+                raise TimeoutError(f"Chunk {chunk_number} did not arrive within {self.timeout} seconds")
+
+    def close(self):
+        if not self.closed and self.peer.piece_manager is not None:
+            self.peer.piece_manager.set_priority_window(1, 0)  # Back to plain rarest first
+        super().close()
@@ -0,0 +1,146 @@
+import random
+from piece_manager import PieceBucket
+
+NUM_WANT = 50  # peers handed out per announce, whatever the size of the swarm
+
+
+class PeerView:
+    """
+    What the tracker last told one peer: the swarm version of that answer and the
+    addresses it was given.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.peers = set()
+
+
+class SwarmTable:
+    """
+    The peers of a swarm and the Bitfield of chunks each one has.
+
+    Every change gets a new swarm version. For each peer the table remembers which
+    addresses it handed out and at which version, so an announce is answered with only
+    what changed in that peer's view since then, topped up with random peers. Peers are
+    also kept in a PieceBucket, which gives O(1) random picks. An announce therefore
+    costs O(NUM_WANT) however many peers the swarm has, and nothing is pushed to peers
+    that did not ask.
+    """
+
+    def __init__(self, num_want=NUM_WANT):
+        """
+        PARAMETERS:
+        num_want: Maximum number of peers a single peer is told about.
+        """
+        self.num_want = num_want
+        self.peers = {}  # "ip:port" -> Bitfield of the chunks that peer has
+        self.versions = {}  # "ip:port" -> swarm version at which its entry last changed
+        self.addresses = PieceBucket()  # the same addresses, for O(1) random sampling
+        self.views = {}  # "ip:port" -> PeerView of what that peer was last told
+        self.version = 0
+        self.seeders = 0  # peers that have every chunk
+        self.announces = 0  # peer lists handed out
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, peer_addr):
+        return peer_addr in self.peers
+
+    def add_peer(self, peer_addr, chunks):
+        """
+        Adds a peer, or updates the chunks of a peer that is already in the swarm.
+        PARAMETERS:
+        peer_addr: The "ip:port" the peer listens on.
+        chunks: The Bitfield of chunks the peer has.
+        RETURNS:
+        True if the peer is new to the swarm.
+        """
+        is_new = peer_addr not in self.peers
+        if not is_new and self.peers[peer_addr] == chunks:
+            return False  # Nothing changed, the other peers' views stay valid
+        if is_new:
+            self.addresses.add(peer_addr)
+        else:
+            self.seeders -= self.peers[peer_addr].is_complete()
+        self.seeders += chunks.is_complete()
+        self.peers[peer_addr] = chunks
+        self.version += 1
+        self.versions[peer_addr] = self.version
+        return is_new
+
+    def remove_peer(self, peer_addr):
+        """
+        Removes a peer. Peers that were told about it learn it on their next announce.
+        RETURNS:
+        True if the peer was in the swarm.
+        """
+        if peer_addr not in self.peers:
+            return False
+        self.seeders -= self.peers.pop(peer_addr).is_complete()
+        del self.versions[peer_addr]
+        self.addresses.remove(peer_addr)
+        self.views.pop(peer_addr, None)
+        self.version += 1
+        return True
+
+    def announce(self, peer_addr, since=0):
+        """
+        Works out what a peer has to be told about the swarm.
+        PARAMETERS:
+        peer_addr: The "ip:port" of the announcing peer.
+        since: The swarm version of the last answer the peer applied, 0 if it has none.
+        RETURNS:
+        A tuple of (version, full, updated, removed). If full is True the peer must replace
+        what it knows with updated, otherwise apply it on top. updated maps addresses to
+        their Bitfield and removed lists addresses the peer should forget.
+        """
+        self.announces += 1
+        view = self.views.get(peer_addr)
+        full = view is None or since == 0 or since != view.version
+        if full:
+            view = PeerView()  # The peer's state is unknown to us, start a new view
+
+        removed = [addr for addr in view.peers if addr not in self.peers]
+        view.peers.difference_update(removed)
+        updated = {addr: self.peers[addr] for addr in view.peers if self.versions[addr] > view.version}
+        for addr in self.sample(self.num_want - len(view.peers), view.peers | {peer_addr}):
+            view.peers.add(addr)
+            updated[addr] = self.peers[addr]
+
+        view.version = self.version
+        if peer_addr is not None:  # Anonymous requests get a random subset and no view
+            self.views[peer_addr] = view
+        return view.version, full, updated, removed
+
+    def stats(self):
+        """
+        RETURNS:
+        A dictionary with the number of peers, seeders and leechers and the announces served.
+        """
+        return {
+            "peers": len(self.peers),
+            "seeders": self.seeders,
+            "leechers": len(self.peers) - self.seeders,
+            "announces": self.announces,
+        }
+
+    def sample(self, count, exclude):
+        """
+        Picks up to count random peers that are not in exclude.
+        """
+        if count <= 0:
+            return []
+        candidates = self.addresses.pieces
+        if len(candidates) <= count + len(exclude):
+            # Small swarm: a scan is as cheap as sampling
+            eligible = [addr for addr in candidates if addr not in exclude]
+            return eligible if len(eligible) <= count else random.sample(eligible, count)
+        picked = set()
+        attempts = 0
+        while len(picked) < count and attempts < 4 * count:
+            addr = random.choice(candidates)
+            if addr not in exclude:
+                picked.add(addr)
+            attempts += 1
+        return list(picked)
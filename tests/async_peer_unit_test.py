@@ -0,0 +1,154 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from async_peer import AsyncPeer
+from bitfield import Bitfield
+from file_chunker import CHUNK_SIZE
+from hashing import calculate_sha1
+
+
+class TestAsyncPeer(unittest.TestCase):
+    def setUp(self):
+        """
+        A seeding peer with every chunk and a downloading peer with none.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.total_chunks = 30
+        self.content = b''.join(bytes([number]) * CHUNK_SIZE for number in range(1, self.total_chunks + 1))
+
+        self.seeder = AsyncPeer("127.0.0.1")
+        shared_path = os.path.join(directory.name, "shared.bin")
+        with open(shared_path, 'wb') as shared_file:
+            shared_file.write(self.content)
+        self.seeder.open_storage(shared_path, len(self.content))
+        self.seeder.received_chunks = Bitfield.full(self.total_chunks)
+
+        self.leecher = AsyncPeer("127.0.0.1")
+        self.download_path = os.path.join(directory.name, "download.bin")
+        self.leecher.open_storage(self.download_path, len(self.content))
+
+    def run_download(self):
+        async def scenario():
+            server = await asyncio.start_server(self.seeder.handle_connection, '127.0.0.1', 0)
+            seeder_addr = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            chunk_list = Bitfield.full(self.total_chunks)
+            self.leecher.tracker_peers[seeder_addr] = chunk_list
+            self.leecher.piece_manager.update_available_pieces(chunk_list)
+            async with server:
+                await self.leecher.download_chunks_async()
+        asyncio.run(scenario())
+
+    def test_download_all_chunks(self):
+        """
+        Test that all chunks are downloaded over one pipelined connection.
+        """
+        self.run_download()
+        self.assertEqual(set(self.leecher.received_chunks), set(range(1, self.total_chunks + 1)))
+        self.assertTrue(self.leecher.piece_manager.is_complete())
+        self.leecher.storage.flush()
+        with open(self.download_path, 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), self.content)
+        self.assertEqual(self.leecher.scheduler.in_flight, {})
+        self.assertEqual(self.leecher.download_limiter.peer_buckets, {})  # Forgotten with the connection
+
+    def test_verification_error_puts_the_chunk_back(self):
+        """
+        Test that a chunk whose verification raises is downloaded again without blaming the seeder.
+        """
+        verify = self.leecher.verify_received_chunk
+        failures = []
+
+        def failing_verify(chunk_number, chunk_data):
+            if chunk_number == 3 and not failures:
+                failures.append(chunk_number)
+                raise OSError("disk unavailable")
+            return verify(chunk_number, chunk_data)
+
+        self.leecher.verify_received_chunk = failing_verify
+        self.run_download()
+        self.assertEqual(failures, [3])
+        self.assertTrue(self.leecher.piece_manager.is_complete())
+        self.assertEqual(self.leecher.scheduler.bad_pieces, {})
+
+    def test_peers_are_applied_on_the_loop(self):
+        """
+        Test that only the tracker I/O runs on the executor and the peer list is applied on the loop thread.
+        """
+        peer_list = (4, "FULL", {"127.0.0.1:9001": Bitfield.full(self.total_chunks)}, [])
+        threads = {}
+
+        def fetch_peers():
+            threads['fetch'] = threading.get_ident()
+            return peer_list, {}
+
+        def apply_peer_list(announced_peers):
+            threads['apply'] = threading.get_ident()
+            self.leecher.tracker_peers.update(announced_peers)
+
+        with patch.object(self.leecher, 'fetch_peers', fetch_peers), \
+                patch.object(self.leecher, 'apply_peer_list', apply_peer_list):
+            asyncio.run(self.leecher.refresh_peers_async())
+        self.assertNotEqual(threads['fetch'], threading.get_ident())
+        self.assertEqual(threads['apply'], threading.get_ident())
+        self.assertIn("127.0.0.1:9001", self.leecher.tracker_peers)
+        self.assertEqual(self.leecher.tracker_version, 4)
+
+    def test_upload_limit_is_respected(self):
+        """
+        Test that a seeder with an upload limit spreads the transfer over the expected time.
+        """
+        rate = len(self.content) * 4  # A quarter of a second for the whole file
+        self.seeder.set_rate_limits(upload=rate)
+        started = time.monotonic()
+        self.run_download()
+        self.assertEqual(len(self.leecher.received_chunks), self.total_chunks)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_bitfield_is_sent_on_request(self):
+        """
+        Test that a peer found without a tracker can learn the seeder's chunks.
+        """
+        self.seeder.received_chunks.discard(5)
+
+        async def scenario():
+            server = await asyncio.start_server(self.seeder.handle_connection, '127.0.0.1', 0)
+            seeder_addr = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            async with server:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, self.leecher.fetch_peer_bitfield, seeder_addr)
+        self.leecher.peer_port = 6881
+        self.assertEqual(asyncio.run(scenario()), self.seeder.received_chunks)
+
+    def test_rejected_chunks_are_not_requested_again(self):
+        """
+        Test that a chunk rejected by the only peer is not requested from it again.
+        """
+        self.seeder.received_chunks.discard(5)
+        with patch('async_peer.asyncio.sleep', side_effect=asyncio.CancelledError):
+            with self.assertRaises(asyncio.CancelledError):
+                self.run_download()  # The download stops when it would wait for new peers
+        self.assertNotIn(5, self.leecher.received_chunks)
+        self.assertEqual(len(self.leecher.received_chunks), self.total_chunks - 1)
+
+    def test_corrupt_chunk_is_not_stored(self):
+        """
+        Test that a chunk whose data does not match the expected hash is never marked complete.
+        """
+        self.leecher.piece_hashes = [calculate_sha1(self.content[offset:offset + CHUNK_SIZE])
+                                     for offset in range(0, len(self.content), CHUNK_SIZE)]
+        self.leecher.piece_hashes[6] = calculate_sha1(b"something else")
+        with patch('async_peer.asyncio.sleep', side_effect=asyncio.CancelledError):
+            with self.assertRaises(asyncio.CancelledError):
+                self.run_download()
+        self.assertNotIn(7, self.leecher.received_chunks)
+        self.assertIn(7, self.leecher.piece_manager.missing_pieces)
+        self.assertEqual(len(self.leecher.received_chunks), self.total_chunks - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from bitfield import Bitfield
+
+
+class TestBitfield(unittest.TestCase):
+    def test_add_discard_and_count(self):
+        bitfield = Bitfield(20)
+        bitfield.add(1)
+        bitfield.add(20)
+        bitfield.add(20)
+        self.assertEqual(len(bitfield), 2)
+        self.assertIn(1, bitfield)
+        self.assertNotIn(2, bitfield)
+        self.assertNotIn(21, bitfield)  # Out of range is simply not contained
+        bitfield.discard(1)
+        self.assertEqual(list(bitfield), [20])
+
+    def test_wire_encoding(self):
+        """
+        Test that piece 1 is the most significant bit of the first byte and that
+        encoding round-trips through bytes and base64.
+        """
+        bitfield = Bitfield.from_pieces(10, [1, 9, 10])
+        self.assertEqual(bitfield.to_bytes(), b"\x80\xc0")
+        self.assertEqual(Bitfield.from_bytes(bitfield.to_bytes(), 10), bitfield)
+        self.assertEqual(Bitfield.from_base64(bitfield.to_base64(), 10), bitfield)
+
+    def test_spare_bits_are_ignored(self):
+        bitfield = Bitfield(10, b"\xff\xff")
+        self.assertEqual(len(bitfield), 10)
+        self.assertTrue(bitfield.is_complete())
+        self.assertEqual(Bitfield.full(10), bitfield)
+
+    def test_set_operations(self):
+        theirs = Bitfield.from_pieces(100, range(1, 51))
+        mine = Bitfield.from_pieces(100, range(40, 101))
+        self.assertEqual(list(theirs - mine), list(range(1, 40)))
+        self.assertEqual(list(theirs & mine), list(range(40, 51)))
+        self.assertTrue((theirs | mine).is_complete())
+        self.assertEqual(list(theirs - {1, 2}), list(range(3, 51)))
+
+    def test_size_mismatch(self):
+        with self.assertRaises(ValueError):
+            Bitfield(10) - Bitfield(11)
+        with self.assertRaises(IndexError):
+            Bitfield(10).add(11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from choker import Choker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestChoker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.choker = Choker(upload_slots=3, optimistic_interval=30, clock=self.clock)
+        self.peers = [f"127.0.0.1:{9000 + number}" for number in range(6)]
+
+    def test_new_peers_fill_free_slots(self):
+        unchoked = [self.choker.add_peer(peer_addr) for peer_addr in self.peers[:4]]
+        self.assertEqual(unchoked, [True, True, True, False])
+        self.choker.remove_peer(self.peers[0])
+        self.assertTrue(self.choker.add_peer(self.peers[4]))
+
+    def test_best_uploaders_to_us_get_regular_slots(self):
+        for number, peer_addr in enumerate(self.peers):
+            self.choker.add_peer(peer_addr)
+            self.choker.record_download(peer_addr, 1000 * number)
+        self.choker.recalculate()
+        regular = self.choker.unchoked - {self.choker.optimistic_peer}
+        self.assertEqual(regular, {self.peers[5], self.peers[4]})
+        self.assertIn(self.choker.optimistic_peer, self.peers[:4])
+        self.assertEqual(len(self.choker.unchoked), 3)
+
+    def test_seeding_ranks_by_upload_rate(self):
+        for number, peer_addr in enumerate(self.peers):
+            self.choker.add_peer(peer_addr)
+            self.choker.record_download(peer_addr, 1000 * number)
+            self.choker.record_upload(peer_addr, 1000 * (len(self.peers) - number))
+        self.choker.recalculate(seeding=True)
+        self.assertTrue({self.peers[0], self.peers[1]} <= self.choker.unchoked)
+
+    def test_optimistic_unchoke_rotates(self):
+        for peer_addr in self.peers:
+            self.choker.add_peer(peer_addr)
+        self.choker.record_download(self.peers[0], 5000)
+        self.choker.record_download(self.peers[1], 4000)
+        self.choker.recalculate()
+        first = self.choker.optimistic_peer
+
+        self.clock.now = 10
+        self.choker.recalculate()
+        self.assertEqual(self.choker.optimistic_peer, first)  # Not due yet
+
+        seen = {first}
+        for round_number in range(1, 20):
+            self.clock.now = 30 * round_number + 10
+            self.choker.record_download(self.peers[0], 5000)  # Keep reciprocating
+            self.choker.record_download(self.peers[1], 4000)
+            self.choker.recalculate()
+            seen.add(self.choker.optimistic_peer)
+        self.assertGreater(len(seen), 1)
+        self.assertFalse(seen & {self.peers[0], self.peers[1]})  # Those have regular slots
+
+    def test_recalculate_reports_changes(self):
+        for peer_addr in self.peers[:4]:
+            self.choker.add_peer(peer_addr)
+        self.choker.record_download(self.peers[3], 5000)
+        unchoked, choked = self.choker.recalculate()
+        self.assertEqual(unchoked, [self.peers[3]])
+        self.assertEqual(len(self.choker.unchoked), 3)
+        self.assertEqual(len(choked), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+from bitfield import Bitfield
+from dht import DHTNode, DHTError, RoutingTable, ThreadedDHT, distance, random_node_id, K
+from peer import Peer
+from file_chunker import CHUNK_SIZE
+
+NODE_COUNT = 40  # nodes started on the loopback interface for the lookup tests
+
+
+async def start_network(count):
+    """
+    Starts count DHT nodes on localhost, each joining through the first one.
+    """
+    nodes = [DHTNode() for _ in range(count)]
+    for node in nodes:
+        await node.listen('127.0.0.1', 0)
+    await nodes[0].bootstrap([])
+    for node in nodes[1:]:
+        await node.bootstrap([nodes[0].address])
+    return nodes
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_full_bucket_keeps_replacements(self):
+        own_id = "0" * 40
+        table = RoutingTable(own_id, k=2)
+        far_ids = [f"8{number:039x}" for number in range(1, 5)]  # All in the bucket of the highest bit
+        for number, node_id in enumerate(far_ids):
+            table.add(node_id, ('127.0.0.1', 7000 + number))
+        self.assertEqual(len(table), 2)
+        self.assertEqual([node_id for node_id, _ in table.closest(own_id)], far_ids[:2])
+
+        table.remove(far_ids[0])  # Stopped answering, the newest replacement takes its place
+        self.assertEqual(sorted(node_id for node_id, _ in table.closest(own_id)), [far_ids[1], far_ids[3]])
+
+    def test_closest_orders_by_xor_distance(self):
+        table = RoutingTable(random_node_id())
+        node_ids = [random_node_id() for _ in range(50)]
+        for node_id in node_ids:
+            table.add(node_id, ('127.0.0.1', 7000))
+        target = random_node_id()
+        closest = [node_id for node_id, _ in table.closest(target, 5)]
+        self.assertEqual(closest, sorted(closest, key=lambda node_id: distance(node_id, target)))
+        self.assertLessEqual(len(closest), 5)
+
+
+class TestDHTNode(unittest.TestCase):
+    def test_find_node_converges_on_closest_nodes(self):
+        async def scenario():
+            nodes = await start_network(NODE_COUNT)
+            try:
+                target = random_node_id()
+                found = [node_id for node_id, _ in await nodes[-1].find_node(target)]
+                others = sorted((node.node_id for node in nodes[:-1]), key=lambda node_id: distance(node_id, target))
+                self.assertEqual(found, others[:K])
+            finally:
+                for node in nodes:
+                    node.close()
+        asyncio.run(scenario())
+
+    def test_announced_peer_is_found_by_other_nodes(self):
+        async def scenario():
+            nodes = await start_network(NODE_COUNT)
+            try:
+                info_hash = "ab" * 20
+                await nodes[5].announce_peer(info_hash, 6881)
+                self.assertEqual(await nodes[30].get_peers(info_hash), {"127.0.0.1:6881"})
+                self.assertEqual(await nodes[30].get_peers("cd" * 20), set())
+            finally:
+                for node in nodes:
+                    node.close()
+        asyncio.run(scenario())
+
+    def test_announce_with_bad_token_is_refused(self):
+        async def scenario():
+            nodes = await start_network(2)
+            try:
+                info_hash = "ab" * 20
+                result = await nodes[1].query_node(nodes[0].node_id, nodes[0].address, "announce_peer",
+                                                   {"info_hash": info_hash, "port": 6881, "token": "forged"})
+                self.assertIsNone(result)
+                self.assertEqual(nodes[0].peers, {})
+            finally:
+                for node in nodes:
+                    node.close()
+        asyncio.run(scenario())
+
+    def test_malformed_datagrams_are_dropped(self):
+        async def scenario():
+            node = DHTNode()
+            node.transport = MagicMock()
+            sender_id = random_node_id()
+            addr = ('127.0.0.1', 6881)
+            for message in (
+                {"y": "q", "q": "ping", "a": {"id": sender_id}},  # No transaction id
+                {"t": ["unhashable"], "y": "q", "q": "ping", "a": {"id": sender_id}},
+                {"t": ["unhashable"], "y": "r", "r": {"id": sender_id}},
+                {"t": "x" * 100, "y": "q", "q": "ping", "a": {"id": sender_id}},
+            ):
+                node.datagram_received(json.dumps(message).encode(), addr)
+            node.transport.sendto.assert_not_called()
+
+            node.datagram_received(json.dumps({"t": "aa", "y": "q", "q": "ping", "a": {"id": "zz" * 20}}).encode(), addr)
+            self.assertEqual(json.loads(node.transport.sendto.call_args[0][0])["y"], "e")
+            future = asyncio.get_running_loop().create_future()
+            node.pending["bb"] = future
+            node.datagram_received(json.dumps({"t": "bb", "y": "r", "r": {"id": "not hex"}}).encode(), addr)
+            with self.assertRaises(DHTError):
+                future.result()
+            self.assertEqual(len(node.routing), 0)
+        asyncio.run(scenario())
+
+    def test_silent_node_is_dropped(self):
+        async def scenario():
+            node = DHTNode()
+            await node.listen('127.0.0.1', 0)
+            silent = DHTNode()
+            await silent.listen('127.0.0.1', 0)
+            silent.close()  # Queries to it go unanswered
+            node.routing.add(silent.node_id, silent.address)
+            try:
+                with patch('dht.RPC_TIMEOUT', 0.2):
+                    self.assertEqual(await node.find_node(random_node_id()), [])
+                self.assertEqual(len(node.routing), 0)
+            finally:
+                node.close()
+        asyncio.run(scenario())
+
+
+class TestPeerDiscovery(unittest.TestCase):
+    def test_peer_finds_seeder_without_tracker(self):
+        """
+        A peer without a tracker finds a seeder through the DHT and learns its chunks.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        bootstrap = ThreadedDHT('127.0.0.1')
+        self.addCleanup(bootstrap.close)
+        bootstrap.bootstrap([])
+
+        seeder = Peer("127.0.0.1", trackers=[], dht_nodes=[bootstrap.address])
+        threading.Thread(target=seeder.listen_for_requests, daemon=True).start()
+        leecher = Peer("127.0.0.1", trackers=[], dht_nodes=[bootstrap.address])
+        leecher.peer_port = 6881  # Only announced, nothing connects to the leecher
+        while seeder.peer_port is None:
+            threading.Event().wait(0.01)
+        path = os.path.join(directory.name, "shared.bin")
+        with open(path, 'wb') as shared_file:
+            shared_file.write(os.urandom(3 * CHUNK_SIZE))
+        seeder.open_storage(path, 3 * CHUNK_SIZE)
+        for chunk_number in range(1, 4):
+            seeder.received_chunks.add(chunk_number)
+        leecher.init_piece_state(3)
+
+        for peer in (seeder, leecher):
+            peer.start_dht()
+            self.addCleanup(peer.dht.close)
+        seeder.refresh_peers()
+        leecher.refresh_peers()
+
+        self.assertEqual(leecher.tracker_peers, {f"127.0.0.1:{seeder.peer_port}": Bitfield.full(3)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+from download_scheduler import DownloadScheduler, MIN_WINDOW, MAX_BAD_PIECES, ENDGAME_COPIES
+from piece_manager import PieceManager
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDownloadScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.piece_manager = PieceManager(100)
+        self.all_pieces = list(range(1, 101))
+        self.piece_manager.update_available_pieces(self.all_pieces)
+        self.piece_manager.update_available_pieces(self.all_pieces)
+        self.scheduler = DownloadScheduler(self.piece_manager, piece_size=4000, request_timeout=5,
+                                           clock=self.clock, block_size=1000)
+
+    def deliver(self, peer, requests, data=b"x"):
+        """
+        Answers block requests and returns the last result of on_block_received.
+        """
+        result = None
+        for piece, begin, length in requests:
+            result = self.scheduler.on_block_received(peer, piece, begin, data * length)
+        return result
+
+    def test_requests_are_spread_across_peers(self):
+        """
+        Test that two peers with the same pieces are never asked for the same block.
+        """
+        first = self.scheduler.next_requests("peer-a", self.all_pieces)
+        second = self.scheduler.next_requests("peer-b", self.all_pieces)
+        self.assertEqual(len(first), MIN_WINDOW)
+        self.assertEqual(len(second), MIN_WINDOW)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(first[0][1:], (0, 1000))
+
+    def test_started_pieces_are_finished_first(self):
+        """
+        Test that the blocks of a piece another peer started are handed out before new pieces.
+        """
+        self.scheduler.max_in_flight = 2
+        first = self.scheduler.next_requests("peer-a", self.all_pieces)
+        self.scheduler.max_in_flight = 100
+        second = self.scheduler.next_requests("peer-b", self.all_pieces)
+        self.assertEqual({piece for piece, _, _ in second[:2]}, {first[0][0]})
+        self.assertEqual([begin for _, begin, _ in second[:2]], [2000, 3000])
+
+    def test_short_last_piece(self):
+        scheduler = DownloadScheduler(self.piece_manager, piece_size=4000, clock=self.clock, block_size=1000,
+                                      piece_length=lambda piece: 2500)
+        requests = scheduler.next_requests("peer-a", [5])
+        self.assertEqual(requests[:3], [(5, 0, 1000), (5, 1000, 1000), (5, 2000, 500)])
+
+    def test_piece_is_assembled_from_blocks_of_several_peers(self):
+        self.scheduler.max_in_flight = 2
+        first = self.scheduler.next_requests("peer-a", [7])
+        self.scheduler.max_in_flight = 100
+        second = self.scheduler.next_requests("peer-b", [7])
+        self.assertEqual(self.deliver("peer-a", first, b"a"), (None, []))
+        piece_data, duplicates = self.deliver("peer-b", second, b"b")
+        self.assertEqual(piece_data, b"a" * 2000 + b"b" * 2000)
+        self.assertEqual(duplicates, [])
+        self.assertEqual(self.scheduler.on_piece_verified(7), {"peer-a": 2000, "peer-b": 2000})
+
+    def test_wrong_block_length_is_ignored(self):
+        (piece, begin, length), *_ = self.scheduler.next_requests("peer-a", [7])
+        self.assertEqual(self.scheduler.on_block_received("peer-a", piece, begin, b"x" * 10), (None, []))
+        self.assertNotIn((piece, begin), self.scheduler.outstanding("peer-a"))
+        self.assertIn((7, 0, 1000), self.scheduler.next_requests("peer-b", [7]))  # Back in the pool
+
+    def test_window_grows_with_measured_rate(self):
+        """
+        Test that a fast peer gets more requests outstanding.
+        """
+        requests = self.scheduler.next_requests("peer-a", self.all_pieces)
+        self.clock.now = 1.0
+        self.deliver("peer-a", requests * 3)  # Late duplicates still count towards the rate
+        self.assertGreater(len(self.scheduler.next_requests("peer-a", self.all_pieces)), MIN_WINDOW)
+        self.assertGreater(self.scheduler.peer_rates()["peer-a"], 0)
+        self.assertGreater(self.scheduler.download_rate(), 0)
+
+    def test_timed_out_requests_go_to_another_peer(self):
+        """
+        Test that an expired request is released and then requested from a different peer.
+        """
+        self.scheduler.max_in_flight = 1
+        self.assertEqual(self.scheduler.next_requests("slow", [1]), [(1, 0, 1000)])
+        self.assertEqual(self.scheduler.next_requests("fast", [1]), [])  # Global limit reached
+
+        self.clock.now = 6.0
+        self.assertEqual(self.scheduler.expire_requests(), [("slow", (1, 0, 1000))])
+        self.assertEqual(self.scheduler.next_requests("slow", [1]), [])  # Not asked again
+        self.assertEqual(self.scheduler.next_requests("fast", [1]), [(1, 0, 1000)])
+
+    def test_next_expiry(self):
+        self.assertIsNone(self.scheduler.next_expiry())
+        self.scheduler.next_requests("slow", [1])
+        self.clock.now = 2.0
+        self.scheduler.next_requests("fast", [2])
+        self.clock.now = 4.0
+        self.assertEqual(self.scheduler.next_expiry(), 1.0)  # The oldest request of any peer
+        self.clock.now = 6.0
+        self.scheduler.expire_requests()
+        self.assertEqual(self.scheduler.next_expiry(), 1.0)
+
+    def test_global_in_flight_limit(self):
+        """
+        Test that the global limit caps requests across all peers.
+        """
+        self.scheduler.max_in_flight = 3
+        total = 0
+        for peer in ("a", "b", "c"):
+            total += len(self.scheduler.next_requests(peer, self.all_pieces))
+        self.assertEqual(total, 3)
+
+    def test_release_peer_returns_blocks_to_the_pool(self):
+        requests = self.scheduler.next_requests("gone", self.all_pieces)
+        self.assertEqual(sorted(self.scheduler.release_peer("gone")), sorted(requests))
+        self.assertEqual(self.scheduler.in_flight, {})
+        self.assertEqual(sorted(self.scheduler.next_requests("other", self.all_pieces)), sorted(requests))
+
+    def test_endgame_requests_blocks_from_several_peers(self):
+        """
+        Test that once every missing piece is started, idle peers duplicate the blocks in flight,
+        and the other copies are reported for cancelling when one arrives.
+        """
+        piece_manager = PieceManager(1)
+        piece_manager.update_available_pieces([1])
+        scheduler = DownloadScheduler(piece_manager, piece_size=4000, clock=self.clock, block_size=1000)
+        first = scheduler.next_requests("peer-a", [1])
+        self.assertEqual(len(first), 4)
+        second = scheduler.next_requests("peer-b", [1])
+        self.assertEqual(sorted(second), sorted(first))
+        for number in range(ENDGAME_COPIES, 5):
+            scheduler.next_requests(f"peer-{number}", [1])
+        self.assertEqual(len(scheduler.in_flight[(1, 0)]), ENDGAME_COPIES)
+
+        piece_data, duplicates = scheduler.on_block_received("peer-b", 1, 0, b"x" * 1000)
+        self.assertIsNone(piece_data)
+        self.assertEqual(sorted(peer for peer, _ in duplicates), ["peer-3", "peer-a"])
+        self.assertEqual({block for _, block in duplicates}, {(1, 0, 1000)})
+        self.assertNotIn((1, 0), scheduler.outstanding("peer-a"))
+        self.assertEqual(scheduler.on_block_received("peer-a", 1, 0, b"y" * 1000), (None, []))  # Too late
+
+    def test_no_endgame_while_pieces_are_unstarted(self):
+        started = self.scheduler.next_requests("peer-a", [1, 2])[0][0]
+        self.assertEqual(self.scheduler.next_requests("peer-b", [started]), [])
+
+    def test_corrupt_piece_is_requested_from_another_peer(self):
+        """
+        Test that a piece is not re-requested while it is verified, and goes to another peer if it fails.
+        """
+        piece_data, _ = self.deliver("liar", self.scheduler.next_requests("liar", [7]))
+        self.assertEqual(len(piece_data), 4000)
+        self.assertEqual(self.scheduler.next_requests("honest", [7]), [])
+        self.assertEqual(self.scheduler.on_piece_corrupt(7), [])
+        self.assertEqual(self.scheduler.next_requests("liar", [7]), [])
+        self.assertEqual(len(self.scheduler.next_requests("honest", [7])), 4)
+
+    def test_corrupt_piece_from_several_peers_is_retried_from_one(self):
+        """
+        Test that nobody is blamed for a corrupt piece with blocks from several peers,
+        and that the piece is then downloaded from a single peer.
+        """
+        self.scheduler.max_in_flight = 2
+        self.deliver("peer-a", self.scheduler.next_requests("peer-a", [7]))
+        self.scheduler.max_in_flight = 100
+        self.deliver("peer-b", self.scheduler.next_requests("peer-b", [7]))
+        self.assertEqual(self.scheduler.on_piece_corrupt(7), [])
+        self.assertEqual(self.scheduler.bad_pieces, {})
+
+        self.scheduler.max_in_flight = 2
+        self.scheduler.next_requests("peer-a", [7])
+        self.scheduler.max_in_flight = 100
+        self.assertEqual(self.scheduler.next_requests("peer-b", [7]), [])  # peer-a owns the piece now
+        self.scheduler.release_peer("peer-a")
+        self.assertEqual(len(self.scheduler.next_requests("peer-b", [7])), 4)  # Started over
+
+    def test_peer_is_banned_after_repeated_corrupt_pieces(self):
+        for piece in range(1, MAX_BAD_PIECES + 1):
+            self.deliver("liar", self.scheduler.next_requests("liar", [piece]))
+            banned = self.scheduler.on_piece_corrupt(piece)
+        self.assertEqual(banned, ["liar"])
+        self.scheduler.reset_failures()
+        self.assertEqual(self.scheduler.next_requests("liar", self.all_pieces), [])
+        self.assertFalse(self.scheduler.has_wanted_pieces("liar", self.all_pieces))
+
+
+    def test_started_pieces_in_the_priority_window_go_first(self):
+        self.scheduler.max_in_flight = 2
+        self.scheduler.next_requests("peer-a", [3])
+        self.scheduler.max_in_flight = 4
+        self.scheduler.next_requests("peer-b", [8])
+        self.scheduler.max_in_flight = 100
+        self.piece_manager.set_priority_window(8, 2)
+        requests = self.scheduler.next_requests("peer-c", [3, 8])
+        self.assertEqual(requests[:2], [(8, 2000, 1000), (8, 3000, 1000)])
+        self.assertEqual(requests[2:4], [(3, 2000, 1000), (3, 3000, 1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+from expiry_queue import ExpiryQueue
+
+
+class TestExpiryQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = ExpiryQueue()
+
+    def test_keys_expire_in_deadline_order(self):
+        self.queue.touch("b", 20)
+        self.queue.touch("a", 10)
+        self.queue.touch("c", 30)
+        self.assertEqual(self.queue.pop_expired(25), ["a", "b"])
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.next_deadline(), 30)
+
+    def test_refreshed_key_keeps_only_its_new_deadline(self):
+        self.queue.touch("a", 10)
+        self.queue.touch("a", 40)
+        self.assertEqual(self.queue.pop_expired(20), [])
+        self.assertEqual(self.queue.next_deadline(), 40)
+        self.assertEqual(self.queue.pop_expired(40), ["a"])
+
+    def test_discarded_key_never_expires(self):
+        self.queue.touch("a", 10)
+        self.queue.discard("a")
+        self.assertNotIn("a", self.queue)
+        self.assertIsNone(self.queue.next_deadline())
+        self.assertEqual(self.queue.pop_expired(100), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
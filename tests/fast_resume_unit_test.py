@@ -0,0 +1,82 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from bitfield import Bitfield
+from fast_resume import FastResume
+
+
+class TestFastResume(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "data.bin")
+        self.content = b"".join(bytes([number]) * 1000 for number in range(1, 11))
+        with open(self.path, 'wb') as data_file:
+            data_file.write(self.content)
+        self.hashes = [hashlib.sha1(self.content[offset:offset + 1000]).hexdigest()
+                       for offset in range(0, len(self.content), 1000)]
+        self.resume = FastResume(self.path, 1000, 10)
+
+    def test_unchanged_file_is_not_rehashed(self):
+        self.resume.save(Bitfield.from_pieces(10, [1, 2, 3]))
+        with patch('fast_resume.recheck_file') as recheck:
+            verified = FastResume(self.path, 1000, 10).restore(self.hashes)
+        recheck.assert_not_called()
+        self.assertEqual(list(verified), [1, 2, 3])
+
+    def test_every_piece_is_rehashed_after_a_write(self):
+        """
+        Test that a write after the last save makes every piece be re-hashed, so a verified
+        piece that was modified outside the peer is dropped and completed ones are found.
+        """
+        self.resume.save(Bitfield.from_pieces(10, [1, 2, 3]))
+        with open(self.path, 'r+b') as data_file:
+            data_file.seek(1500)
+            data_file.write(b"edited")  # Piece 2 was verified
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))  # Make sure the mtime moved
+        trusted, to_recheck = FastResume(self.path, 1000, 10).load()
+        self.assertEqual(len(trusted), 0)
+        self.assertEqual(to_recheck, list(range(1, 11)))
+        verified = FastResume(self.path, 1000, 10).restore(self.hashes)
+        self.assertEqual(list(verified), [1] + list(range(3, 11)))
+
+    def test_only_pieces_written_since_the_save_are_rehashed(self):
+        """
+        Test that a peer killed after writing pieces past its last save only re-hashes those pieces.
+        """
+        self.resume.save(Bitfield.from_pieces(10, [1, 2, 3]))
+        for piece in (4, 5):
+            self.resume.record_write(piece)
+        with open(self.path, 'r+b') as data_file:
+            data_file.seek(4500)
+            data_file.write(b"torn")  # Piece 5 was only half written when the peer was killed
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        trusted, to_recheck = FastResume(self.path, 1000, 10).load()
+        self.assertEqual(list(trusted), [1, 2, 3])
+        self.assertEqual(to_recheck, [4, 5])
+        verified = FastResume(self.path, 1000, 10).restore(self.hashes)
+        self.assertEqual(list(verified), [1, 2, 3, 4])
+
+        # The next save takes the verified pieces out of the journal
+        self.resume.save(Bitfield.from_pieces(10, [1, 2, 3, 4]))
+        self.assertEqual(self.resume.read_journal(), {5})
+
+    def test_changed_size_or_layout_forces_full_recheck(self):
+        self.resume.save(Bitfield.full(10))
+        self.assertEqual(len(FastResume(self.path, 500, 20).load()[1]), 20)
+        with open(self.path, 'ab') as data_file:
+            data_file.write(b"more")
+        trusted, to_recheck = FastResume(self.path, 1000, 10).load()
+        self.assertEqual(len(trusted), 0)
+        self.assertEqual(len(to_recheck), 10)
+
+    def test_missing_resume_file_without_hashes(self):
+        self.assertEqual(len(self.resume.restore()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from hashing import hash_file_pieces, hash_chunks, verify_chunks, recheck_file, calculate_sha1
+from file_chunker import divide_file_to_chunks
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "data.bin")
+        self.content = os.urandom(10 * 4096 + 123)
+        with open(self.path, 'wb') as data_file:
+            data_file.write(self.content)
+        self.expected = [hashlib.sha1(self.content[offset:offset + 4096]).hexdigest()
+                         for offset in range(0, len(self.content), 4096)]
+
+    def test_hash_file_pieces_keeps_piece_order(self):
+        self.assertEqual(hash_file_pieces(self.path, 4096), self.expected)
+        self.assertEqual(hash_file_pieces(self.path, 4096, [11, 2]), [self.expected[10], self.expected[1]])
+
+    def test_divide_file_to_chunks_hashes_in_order(self):
+        chunks = list(divide_file_to_chunks(self.path, chunk_size=4096))
+        self.assertEqual([chunk_hash for _, chunk_hash, _ in chunks], self.expected)
+        self.assertEqual([number for _, _, number in chunks], list(range(1, 12)))
+        self.assertEqual(b"".join(chunk for chunk, _, _ in chunks), self.content)
+
+    def test_verify_chunks(self):
+        chunks = [b"a" * 5000, b"b" * 5000]
+        self.assertEqual(hash_chunks(chunks), [calculate_sha1(chunk) for chunk in chunks])
+        results = verify_chunks([(chunks[0], calculate_sha1(chunks[0])), (chunks[1], calculate_sha1(chunks[0]))])
+        self.assertEqual(results, [True, False])
+
+    def test_recheck_file(self):
+        """
+        Test that only pieces whose data matches the expected hashes are reported valid.
+        """
+        with open(self.path, 'r+b') as data_file:
+            data_file.seek(4096 * 3)
+            data_file.write(b"corrupted")
+        verified = recheck_file(self.path, 4096, self.expected)
+        self.assertEqual(len(verified), 10)
+        self.assertNotIn(4, verified)
+        self.assertEqual(len(recheck_file(self.path + ".missing", 4096, self.expected)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import hashlib
+import unittest
+from merkle import MerkleTree, leaf_hashes, PADDING_HASH
+from peer_protocol import encode_proof, decode_proof, LENGTH_PREFIX
+
+
+class TestMerkleTree(unittest.TestCase):
+    def setUp(self):
+        self.data = bytes(range(256)) * 20  # 5120 bytes, 5 blocks of 1000 and one of 120
+        self.leaves = leaf_hashes(self.data, block_size=1000)
+        self.tree = MerkleTree.from_leaves(self.leaves)
+
+    def test_leaves_are_padded_to_a_power_of_two(self):
+        self.assertEqual(len(self.leaves), 6)
+        self.assertEqual(self.tree.width, 8)
+        self.assertEqual(self.tree.nodes[8 + 6], PADDING_HASH)
+        self.assertEqual(self.leaves[5], hashlib.sha256(self.data[5000:]).digest())
+
+    def test_block_is_verified_with_its_proof(self):
+        """
+        Test that a peer knowing only the root learns the path of every block it verifies,
+        and can then prove the block to others.
+        """
+        downloader = MerkleTree(6, self.tree.root)
+        self.assertIsNone(downloader.proof(2))
+        proof = self.tree.proof(2)
+        self.assertEqual(len(proof), 3)
+        self.assertTrue(downloader.add_proof(2, self.leaves[2], proof))
+        self.assertEqual(downloader.proof(2), proof)
+        self.assertTrue(downloader.has_leaves(2, [self.leaves[2]]))
+        self.assertTrue(downloader.has_leaves(3, [self.leaves[3]]))  # The sibling is proven along with it
+        self.assertFalse(downloader.has_leaves(2, self.leaves[2:5]))  # Block 4 is not known yet
+
+    def test_bad_block_or_proof_is_refused(self):
+        downloader = MerkleTree(6, self.tree.root)
+        self.assertFalse(downloader.add_proof(2, self.leaves[3], self.tree.proof(2)))
+        self.assertFalse(downloader.add_proof(2, self.leaves[2], self.tree.proof(3)))
+        self.assertFalse(downloader.add_proof(2, self.leaves[2], self.tree.proof(2)[:2]))
+        self.assertFalse(downloader.add_proof(7, PADDING_HASH, self.tree.proof(7)))  # Padding is not data
+        self.assertIsNone(downloader.proof(2))  # Nothing was learned
+
+    def test_single_block(self):
+        tree = MerkleTree.from_leaves(leaf_hashes(b"tiny"))
+        self.assertEqual(tree.root, hashlib.sha256(b"tiny").digest())
+        self.assertTrue(MerkleTree(1, tree.root).add_proof(0, tree.root, []))
+
+    def test_proof_message(self):
+        proof = self.tree.proof(4)
+        frame = encode_proof(3, 16384, proof)
+        self.assertEqual(decode_proof(frame[LENGTH_PREFIX.size + 1:]), (3, 16384, proof))
+
+
+if __name__ == '__main__':
+    unittest.main()
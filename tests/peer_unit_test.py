@@ -1,13 +1,61 @@
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 from peer import Peer
+from bitfield import Bitfield
+from file_chunker import CHUNK_SIZE
+from torrent_metadata import TorrentMetadata
+from merkle import MerkleTree
+from download_scheduler import DownloadScheduler
+from piece_manager import SKIP, LOW, NORMAL, HIGH
+from peer_protocol import (
+    PeerConnection, read_message, send_frame, read_frame, encode_message, encode_handshake, encode_request, encode_cancel, encode_pex, decode_piece, decode_request,
+    PIECE, REJECT, CHOKE, UNCHOKE, PEX
+)
+
+def tcp_socket_pair():
+    """
+    Returns two connected TCP sockets on the loopback interface.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_end = socket.create_connection(listener.getsockname())
+    server_end, _ = listener.accept()
+    listener.close()
+    return server_end, client_end
+
+def share_file(peer, data, directory, name="shared.bin"):
+    """
+    Writes data to a file and lets the peer serve every chunk of it.
+    """
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        with open(path, 'wb') as shared_file:
+            shared_file.write(data)
+    peer.open_storage(path, len(data))
+    for chunk_number in range(1, peer.total_chunks + 1):
+        peer.received_chunks.add(chunk_number)
+
+def numbered_chunks(count):
+    """
+    File content where every byte of chunk n is n.
+    """
+    return b''.join(bytes([number]) * CHUNK_SIZE for number in range(1, count + 1))
 
 class TestPeer(unittest.TestCase):
     def setUp(self):
         """
         Create a Peer instance before every test.
         """
-        self.peer = Peer()
+        self.peer = Peer("127.0.0.1")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
 
     @patch('peer.socket.socket')
     def test_listen_for_requests(self, mock_socket):
@@ -16,95 +64,572 @@ class TestPeer(unittest.TestCase):
         """
         mock_socket_inst = MagicMock()
         mock_socket.return_value = mock_socket_inst
+        mock_socket_inst.getsockname.return_value = ('0.0.0.0', 9090)
+        mock_socket_inst.accept.side_effect = OSError("closed")  # Ends the accept loop
 
-        self.peer.listen_for_requests()
-        mock_socket_inst.bind.assert_called()  # Ensure the socket is bound to a port
+        with self.assertRaises(OSError):
+            self.peer.listen_for_requests()
+        mock_socket_inst.bind.assert_called_with(('0.0.0.0', 0))  # Ensure the socket is bound to a free port
         mock_socket_inst.listen.assert_called_with(5)
+        self.assertEqual(self.peer.peer_port, 9090)
 
-    @patch('peer.socket.socket')
-    def test_request_chunk(self, mock_socket):
+    def serve_in_background(self, peer):
         """
-        Test requesting a chunk from a peer.
+        Starts peer.handle_chunk_request on one end of a socket pair and returns the other end.
         """
-        mock_socket_inst = MagicMock()
-        mock_socket.return_value = mock_socket_inst
-        mock_socket_inst.recv.return_value = b'test_chunk_data'  # Mock received chunk data
+        server_end, client_end = tcp_socket_pair()
+        threading.Thread(target=peer.handle_chunk_request, args=(server_end,), daemon=True).start()
+        return client_end
 
-        chunk = self.peer.request_chunk("127.0.0.1", 1, 9090)
-        self.assertEqual(chunk, b'test_chunk_data')  # Ensure the correct chunk data is returned
-        mock_socket_inst.connect.assert_called_with(("127.0.0.1", 9090))
-        mock_socket_inst.send.assert_called_with(b'1')
+    def test_request_chunk(self):
+        """
+        Test requesting a chunk from a peer over a persistent connection.
+        """
+        remote = Peer("127.0.0.1")
+        share_file(remote, b'test_chunk_data', self.directory)
+        client_end = self.serve_in_background(remote)
 
-    @patch('peer.socket.socket')
-    def test_request_chunk_not_found(self, mock_socket):
+        with patch('peer_protocol.socket.create_connection', return_value=client_end) as mock_connect:
+            success, chunk = self.peer.request_chunk_from_peer("127.0.0.1:9091", 1)
+            self.assertTrue(success)
+            self.assertEqual(chunk, b'test_chunk_data')  # Ensure the correct chunk data is returned
+
+            # The second request reuses the same connection
+            success, chunk = self.peer.request_chunk_from_peer("127.0.0.1:9091", 1)
+            self.assertTrue(success)
+            mock_connect.assert_called_once()
+        client_end.close()
+
+    def test_request_chunks_pipelined(self):
+        """
+        Test that several chunks are requested and received over one connection.
+        """
+        remote = Peer("127.0.0.1")
+        share_file(remote, numbered_chunks(20), self.directory)
+        client_end = self.serve_in_background(remote)
+
+        with patch('peer_protocol.socket.create_connection', return_value=client_end):
+            chunks = self.peer.request_chunks_from_peer("127.0.0.1:9091", list(range(1, 21)))
+        self.assertEqual(len(chunks), 20)
+        for number, data in chunks.items():
+            # Chunks must arrive whole even across many segments
+            self.assertEqual(data, bytes([number]) * CHUNK_SIZE)
+        client_end.close()
+
+    def test_request_chunk_not_found(self):
         """
         Test behavior when requesting a chunk that is not found on the peer.
         """
-        mock_socket_inst = MagicMock()
-        mock_socket.return_value = mock_socket_inst
-        mock_socket_inst.recv.return_value = b'CHUNK_NOT_FOUND'
+        remote = Peer("127.0.0.1")
+        client_end = self.serve_in_background(remote)
 
-        chunk = self.peer.request_chunk("127.0.0.1", 1, 9090)
-        self.assertIsNone(chunk)  # Ensure None is returned for missing chunk
-        mock_socket_inst.connect.assert_called_with(("127.0.0.1", 9090))
+        with patch('peer_protocol.socket.create_connection', return_value=client_end):
+            success, message = self.peer.request_chunk_from_peer("127.0.0.1:9091", 1)
+        self.assertFalse(success)  # Ensure failure is reported for a missing chunk
+        self.assertIn("Chunk 1", message)
+        client_end.close()
 
-    @patch('peer.socket.socket')
-    def test_connect_to_tracker(self, mock_socket):
+    def test_register_with_tracker(self):
         """
-        Test connecting to the tracker and retrieving the list of peers.
+        Test registering with the tracker and retrieving the list of peers over one connection.
         """
-        mock_socket_inst = MagicMock()
-        mock_socket.return_value = mock_socket_inst
-        mock_socket_inst.recv.side_effect = [
-            b'PEER_ADDED',  # First call simulates peer registration
-            b'127.0.0.1:9090\n127.0.0.2:9091'  # Second call simulates peers list
-        ]
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        requests = []
 
-        peers = self.peer.connect_to_tracker()
-        self.assertEqual(peers, ['127.0.0.1:9090', '127.0.0.2:9091'])  # Check if peer list matches
+        def tracker():
+            conn, _ = listener.accept()
+            with conn:
+                requests.append(read_frame(conn).decode())
+                send_frame(conn, b"PEER_ADDED 30 10")  # Registration, with the announce intervals
+                requests.append(read_frame(conn).decode())
+                peers = Bitfield.from_pieces(4, [1, 2]).to_base64()
+                send_frame(conn, f"PEERS 3 FULL\n127.0.0.1:9090: 4 {peers}\n127.0.0.2:9091: 4 {peers}".encode())
+        thread = threading.Thread(target=tracker, daemon=True)
+        thread.start()
 
-    @patch('peer.socket.socket')
-    def test_add_chunk_and_handle_request(self, mock_socket):
+        self.peer.trackers = [listener.getsockname()]
+        self.peer.init_piece_state(4)
+        self.peer.register_with_tracker()
+        thread.join(5)
+        self.peer.close_tracker_connection()
+        self.assertTrue(requests[0].startswith(f"ADD_PEER {self.peer.info_hash} "))
+        self.assertEqual(requests[1], "REQUEST_PEERS 0")
+        self.assertEqual(sorted(self.peer.tracker_peers), ['127.0.0.1:9090', '127.0.0.2:9091'])  # Check if peer list matches
+        self.assertEqual(list(self.peer.tracker_peers['127.0.0.1:9090']), [1, 2])
+        self.assertEqual((self.peer.announce_interval, self.peer.min_announce_interval), (30, 10))
+        self.assertEqual(self.peer.tracker_version, 3)
+
+    def test_add_chunk_and_handle_request(self):
         """
         Test if the peer can correctly handle chunk requests.
         """
         # Prepare a chunk to be served
-        self.peer.peer_chunks = {1: b'test_chunk_data'}
-        
-        client_socket = MagicMock()
-        client_socket.recv.return_value = b'1'
-        
-        self.peer.handle_chunk_request(client_socket)
-        client_socket.send.assert_called_with(b'test_chunk_data')  # Ensure correct chunk is sent
-    
-    @patch('peer.socket.socket')
-    def test_handle_missing_chunk_request(self, mock_socket):
+        share_file(self.peer, b'test_chunk_data', self.directory)
+        client_end = self.serve_in_background(self.peer)
+
+        client_end.sendall(encode_handshake("127.0.0.1:9091") + encode_request(1, 0, 65536))
+        message_id, payload = read_message(client_end)
+        self.assertEqual(message_id, PIECE)
+        self.assertEqual(decode_piece(payload), (1, 0, b'test_chunk_data'))  # Ensure correct chunk is sent
+        client_end.close()
+
+    def test_handle_missing_chunk_request(self):
         """
         Test behavior when a peer requests a chunk that is not available.
         """
-        client_socket = MagicMock()
-        client_socket.recv.return_value = b'99'  # Request a non-existent chunk
-        
-        self.peer.handle_chunk_request(client_socket)
-        client_socket.send.assert_called_with(b'CHUNK_NOT_FOUND')  # Ensure 'CHUNK_NOT_FOUND' is sent
+        client_end = self.serve_in_background(self.peer)
+
+        client_end.sendall(encode_request(99, 0, 65536))  # Request a non-existent chunk
+        message_id, payload = read_message(client_end)
+        self.assertEqual(message_id, REJECT)  # Ensure the request is rejected
+        self.assertEqual(decode_request(payload), (99, 0, 65536))
+        client_end.close()
+
+    def test_cancelled_request_is_not_served(self):
+        """
+        Test that a request cancelled before it is served gets no answer.
+        """
+        share_file(self.peer, b'1' * CHUNK_SIZE + b'two', self.directory)
+        server_end, client_end = tcp_socket_pair()
+        # Queue both messages before the handler starts so the cancel is seen first
+        client_end.sendall(encode_request(1, 0, 65536) + encode_cancel(1, 0, 65536) + encode_request(2, 0, 65536))
+        threading.Thread(target=self.peer.handle_chunk_request, args=(server_end,), daemon=True).start()
+
+        message_id, payload = read_message(client_end)
+        self.assertEqual(decode_piece(payload), (2, 0, b'two'))
+        client_end.close()
+
+    def test_download_chunks_from_several_peers(self):
+        """
+        Test that the threaded engine downloads every chunk from several peers in parallel.
+        """
+        total_chunks = 40
+        for seed in range(3):
+            remote = Peer("127.0.0.1")
+            share_file(remote, numbered_chunks(total_chunks), self.directory)
+            threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+            while remote.peer_port is None:
+                time.sleep(0.01)
+            self.peer.tracker_peers[f"127.0.0.1:{remote.peer_port}"] = Bitfield.full(total_chunks)
+
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download.bin"), total_chunks * CHUNK_SIZE)
+        for chunks in self.peer.tracker_peers.values():
+            self.peer.piece_manager.update_available_pieces(chunks)
+
+        self.peer.download_chunks()
+        self.assertTrue(self.peer.received_chunks.is_complete())
+        with open(os.path.join(self.directory, "download.bin"), 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), numbered_chunks(total_chunks))  # No reassembly step needed
+        self.assertEqual(len(self.peer.scheduler.peer_rates()), 3)
+
+    def test_verification_error_puts_the_chunk_back(self):
+        """
+        Test that a chunk whose verification raises is downloaded again instead of waiting forever.
+        """
+        total_chunks = 6
+        remote = Peer("127.0.0.1")
+        share_file(remote, numbered_chunks(total_chunks), self.directory)
+        threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+        while remote.peer_port is None:
+            time.sleep(0.01)
+
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download.bin"), total_chunks * CHUNK_SIZE)
+        self.peer.set_peer_chunks(f"127.0.0.1:{remote.peer_port}", Bitfield.full(total_chunks))
+        verify = self.peer.verify_received_chunk
+        failures = []
+
+        def failing_verify(chunk_number, chunk_data):
+            if chunk_number == 3 and not failures:
+                failures.append(chunk_number)
+                raise OSError("disk unavailable")
+            return verify(chunk_number, chunk_data)
+
+        self.peer.verify_received_chunk = failing_verify
+        self.peer.download_chunks()
+        self.assertEqual(failures, [3])
+        self.assertTrue(self.peer.received_chunks.is_complete())
+        self.assertEqual(self.peer.scheduler.verifying, {})
+        self.assertEqual(self.peer.scheduler.bad_pieces, {})  # Nobody is blamed for a local error
+
+    def test_multi_file_torrent_is_downloaded(self):
+        """
+        Test that a directory is shared and downloaded as one torrent, with chunks spanning files.
+        """
+        shared = os.path.join(self.directory, "dataset")
+        os.makedirs(shared)
+        contents = {"shard-1.bin": os.urandom(CHUNK_SIZE + 100), "shard-2.bin": os.urandom(2 * CHUNK_SIZE)}
+        for name, content in contents.items():
+            with open(os.path.join(shared, name), 'wb') as shard:
+                shard.write(content)
+        metadata_path = os.path.join(self.directory, "dataset.torrent")
+        TorrentMetadata(shared, "").save_metadata_to_file(metadata_path)
+
+        remote = Peer("127.0.0.1", file_to_share=shared, metadata_file=metadata_path)
+        remote.load_metadata(metadata_path)
+        remote.open_storage(shared, 3 * CHUNK_SIZE + 100)
+        for chunk_number in range(1, remote.total_chunks + 1):
+            remote.received_chunks.add(chunk_number)
+        threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+        while remote.peer_port is None:
+            time.sleep(0.01)
+
+        self.peer.load_metadata(metadata_path)
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download"), self.peer.metadata["total_size"])
+        self.peer.set_peer_chunks(f"127.0.0.1:{remote.peer_port}", Bitfield.full(self.peer.total_chunks))
+        self.peer.download_chunks()
+        for name, content in contents.items():
+            with open(os.path.join(self.directory, "download", name), 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), content)
+
+    def test_skipped_file_is_not_downloaded(self):
+        """
+        Test that skipping a file downloads only the chunks of the other files, boundary chunks included.
+        """
+        shared = os.path.join(self.directory, "dataset")
+        os.makedirs(shared)
+        contents = {"a.bin": os.urandom(CHUNK_SIZE + 100), "b.bin": os.urandom(3 * CHUNK_SIZE),
+                    "c.bin": os.urandom(CHUNK_SIZE)}
+        for name, content in contents.items():
+            with open(os.path.join(shared, name), 'wb') as shard:
+                shard.write(content)
+        metadata_path = os.path.join(self.directory, "dataset.torrent")
+        TorrentMetadata(shared, "").save_metadata_to_file(metadata_path)
+
+        remote = Peer("127.0.0.1")
+        remote.load_metadata(metadata_path)
+        remote.open_storage(shared, 5 * CHUNK_SIZE + 100)
+        for chunk_number in range(1, remote.total_chunks + 1):
+            remote.received_chunks.add(chunk_number)
+        threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+        while remote.peer_port is None:
+            time.sleep(0.01)
+
+        self.peer.load_metadata(metadata_path)
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download"), self.peer.metadata["total_size"])
+        self.peer.set_file_priority("b.bin", SKIP)
+        self.assertEqual(self.peer.piece_manager.wanted_count, 4)  # Chunks 3 and 4 hold nothing but b.bin
+        self.peer.set_peer_chunks(f"127.0.0.1:{remote.peer_port}", Bitfield.full(self.peer.total_chunks))
+        self.peer.download_chunks()
+        self.assertEqual(sorted(self.peer.received_chunks), [1, 2, 5, 6])
+        self.assertEqual(self.peer.piece_manager.progress(), 1.0)
+        for name in ("a.bin", "c.bin"):
+            with open(os.path.join(self.directory, "download", name), 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), contents[name])
+
+    def test_shared_chunk_keeps_the_highest_file_priority(self):
+        """
+        Test that the chunk two files share follows the most wanted of them and a range priority set for it.
+        """
+        files = [("a.bin", CHUNK_SIZE + 100), ("b.bin", 2 * CHUNK_SIZE)]
+        self.peer.open_storage(os.path.join(self.directory, "download"), 3 * CHUNK_SIZE + 100, files)
+        priorities = self.peer.piece_manager.priorities  # Chunk 2 holds the end of a.bin and the start of b.bin
+
+        self.peer.set_file_priority("a.bin", SKIP)
+        self.assertEqual(list(priorities[1:5]), [SKIP, NORMAL, NORMAL, NORMAL])
+        self.peer.set_file_priority("b.bin", LOW)
+        self.assertEqual(list(priorities[1:5]), [SKIP, LOW, LOW, LOW])
+        self.peer.set_file_priority("a.bin", HIGH)
+        self.assertEqual(list(priorities[1:5]), [HIGH, HIGH, LOW, LOW])
+        self.peer.set_file_priority("a.bin", SKIP)
+        self.assertEqual(list(priorities[1:5]), [SKIP, LOW, LOW, LOW])
+        self.peer.set_file_priority("b.bin", SKIP)
+        self.assertEqual(list(priorities[1:5]), [SKIP, SKIP, SKIP, SKIP])
+
+        self.peer.set_range_priority(CHUNK_SIZE + 100, CHUNK_SIZE, HIGH)  # The start of b.bin is needed first
+        self.peer.set_file_priority("a.bin", SKIP)
+        self.assertEqual(list(priorities[1:5]), [SKIP, HIGH, HIGH, SKIP])
+        self.peer.set_file_priority("b.bin", NORMAL)  # Replaces the range where only b.bin is stored
+        self.assertEqual(list(priorities[1:5]), [SKIP, HIGH, NORMAL, NORMAL])
+        self.peer.set_range_priority(CHUNK_SIZE + 100, CHUNK_SIZE, NORMAL)
+        self.assertEqual(list(priorities[1:5]), [SKIP, NORMAL, NORMAL, NORMAL])
+        self.assertEqual(self.peer.piece_manager.wanted_count, 3)
+        self.peer.storage.close()
+
+    def test_corrupt_chunks_are_downloaded_again(self):
+        """
+        Test that chunks failing their hash are fetched again from another peer.
+        """
+        total_chunks = 20
+        content = numbered_chunks(total_chunks)
+        for name, data in (("honest.bin", content), ("liar.bin", bytes(len(content)))):
+            remote = Peer("127.0.0.1")
+            share_file(remote, data, self.directory, name)
+            threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+            while remote.peer_port is None:
+                time.sleep(0.01)
+            self.peer.tracker_peers[f"127.0.0.1:{remote.peer_port}"] = Bitfield.full(total_chunks)
+        liar_addr = f"127.0.0.1:{remote.peer_port}"
+
+        metadata_path = os.path.join(self.directory, "shared.torrent")
+        with open(os.path.join(self.directory, "original.bin"), 'wb') as original:
+            original.write(content)
+        TorrentMetadata(original.name, "").save_metadata_to_file(metadata_path)
+        self.peer.load_metadata(metadata_path)
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download.bin"), len(content))
+        for chunks in self.peer.tracker_peers.values():
+            self.peer.piece_manager.update_available_pieces(chunks)
+
+        self.peer.download_chunks()
+        with open(os.path.join(self.directory, "download.bin"), 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), content)
+        self.assertGreater(self.peer.scheduler.bad_pieces[liar_addr], 0)
+
+    def test_corrupt_blocks_fail_their_merkle_proof(self):
+        """
+        Test that with Merkle metadata bad blocks are caught as they arrive and fetched again.
+        """
+        total_chunks = 12
+        content = numbered_chunks(total_chunks)
+        original_path = os.path.join(self.directory, "original.bin")
+        with open(original_path, 'wb') as original:
+            original.write(content)
+        metadata_path = os.path.join(self.directory, "shared.torrent")
+        TorrentMetadata(original_path, "", merkle=True).save_metadata_to_file(metadata_path)
+        self.assertNotIn("piece_hashes", TorrentMetadata.load_metadata(metadata_path))
+
+        for name, data in (("honest.bin", content), ("liar.bin", bytes(len(content)))):
+            remote = Peer("127.0.0.1")
+            remote.load_metadata(metadata_path)
+            share_file(remote, data, self.directory, name)
+            threading.Thread(target=remote.listen_for_requests, daemon=True).start()
+            while remote.peer_port is None:
+                time.sleep(0.01)
+            self.peer.tracker_peers[f"127.0.0.1:{remote.peer_port}"] = Bitfield.full(total_chunks)
+        self.assertEqual(remote.merkle_tree.proof(0), None)  # Its data does not match the root
+        remote.merkle_tree = MerkleTree.from_file(original_path, CHUNK_SIZE)  # Valid proofs, bad data
+        liar_addr = f"127.0.0.1:{remote.peer_port}"
+
+        self.peer.load_metadata(metadata_path)
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download.bin"), len(content))
+        for chunks in self.peer.tracker_peers.values():
+            self.peer.piece_manager.update_available_pieces(chunks)
+
+        self.peer.download_chunks()
+        with open(os.path.join(self.directory, "download.bin"), 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), content)
+        self.assertGreater(self.peer.scheduler.bad_pieces[liar_addr], 0)
+        self.assertFalse(self.peer.scheduler.single_source)  # No piece was assembled from a bad block
+
+    def test_restart_resumes_from_saved_state(self):
+        """
+        Test that a peer restarted on a partially downloaded file keeps its verified chunks.
+        """
+        path = os.path.join(self.directory, "download.bin")
+        self.peer.open_storage(path, 5 * CHUNK_SIZE)
+        self.peer.storage.write_piece(2, b"2" * CHUNK_SIZE)
+        self.peer.received_chunks.add(2)
+        self.peer.save_resume_data()
+
+        restarted = Peer("127.0.0.1")
+        restarted.open_storage(path, 5 * CHUNK_SIZE)
+        self.assertEqual(list(restarted.received_chunks), [2])
+        self.assertNotIn(2, restarted.piece_manager.missing_pieces)
+        self.assertFalse(restarted.storage.read_only)
+        restarted.storage.close()
 
-    def test_update_top_peers(self):
+    def test_complete_file_is_opened_read_only(self):
         """
-        Test updating the top 4 peers based on upload contribution.
+        Test that a file with every chunk verified, or the original a seeder shares, is never written.
         """
-        # Simulate uploaded chunks for several peers
-        self.peer.uploaded_chunks = {
-            "127.0.0.1": 5,
-            "127.0.0.2": 3,
-            "127.0.0.3": 8,
-            "127.0.0.4": 2,
-            "127.0.0.5": 10
+        path = os.path.join(self.directory, "download.bin")
+        self.peer.open_storage(path, 2 * CHUNK_SIZE)
+        for chunk_number in (1, 2):
+            self.peer.storage.write_piece(chunk_number, bytes([chunk_number]) * CHUNK_SIZE)
+            self.peer.received_chunks.add(chunk_number)
+        self.peer.save_resume_data()
+        self.peer.storage.close()
+
+        restarted = Peer("127.0.0.1")
+        restarted.open_storage(path, 2 * CHUNK_SIZE)
+        self.addCleanup(restarted.storage.close)
+        self.assertTrue(restarted.storage.read_only)
+        self.assertEqual(len(restarted.received_chunks), 2)
+
+        seeder = Peer("127.0.0.1", file_to_share=path)
+        seeder.prepare_file_chunks()
+        self.addCleanup(seeder.storage.close)
+        self.assertTrue(seeder.storage.read_only)
+
+    def test_pex_message_only_carries_changes(self):
+        """
+        Test that each peer exchange message only has what the receiver was not told yet.
+        """
+        self.peer.peer_port = 9000
+        self.peer.init_piece_state(8)
+        self.peer.tracker_peers = {
+            "127.0.0.1:9001": Bitfield.from_pieces(8, [1]),
+            "127.0.0.1:9002": Bitfield.from_pieces(8, [2]),
         }
-        self.peer.peers = ["127.0.0.1", "127.0.0.2", "127.0.0.3", "127.0.0.4", "127.0.0.5"]
+        first = self.peer.build_pex_message("127.0.0.1:9002").split("\n")
+        self.assertEqual(sorted(line.split(":")[1] for line in first), ["9000", "9001"])
+        self.assertIsNone(self.peer.build_pex_message("127.0.0.1:9002"))
+
+        self.peer.tracker_peers["127.0.0.1:9001"].add(3)
+        del self.peer.tracker_peers["127.0.0.1:9002"]
+        self.peer.tracker_peers["127.0.0.1:9003"] = Bitfield(8)
+        update = self.peer.build_pex_message("127.0.0.1:9002").split("\n")
+        self.assertEqual(update, [f"127.0.0.1:9001: 8 {Bitfield.from_pieces(8, [1, 3]).to_base64()}",
+                                  f"127.0.0.1:9003: 8 {Bitfield(8).to_base64()}"])
+
+    def test_apply_pex_adds_peers_and_merges_chunks(self):
+        """
+        Test that gossiped peers update the known peers and the piece availability.
+        """
+        self.peer.peer_port = 9000
+        self.peer.init_piece_state(8)
+        self.peer.set_peer_chunks("127.0.0.1:9001", Bitfield.from_pieces(8, [1]))
+        gossip = "\n".join([
+            f"127.0.0.1:9001: 8 {Bitfield.from_pieces(8, [2]).to_base64()}",
+            f"127.0.0.1:9002: 8 {Bitfield.from_pieces(8, [2, 3]).to_base64()}",
+            f"127.0.0.1:9000: 8 {Bitfield.full(8).to_base64()}",  # Ourselves
+        ])
+        self.peer.apply_pex("127.0.0.1:9005", gossip.encode())
+
+        self.assertEqual(self.peer.tracker_peers, {
+            "127.0.0.1:9001": Bitfield.from_pieces(8, [1, 2]),
+            "127.0.0.1:9002": Bitfield.from_pieces(8, [2, 3]),
+        })
+        self.assertEqual(self.peer.piece_manager.available_pieces[1:4], [1, 2, 1])
+
+        # Too soon after the last message from the same peer
+        self.peer.apply_pex("127.0.0.1:9005", b"REMOVED 127.0.0.1:9002")
+        self.assertIn("127.0.0.1:9002", self.peer.tracker_peers)
+        # A full list from the tracker does not drop peers it never announced
+        self.peer.apply_peer_list({})
+        self.assertEqual(list(self.peer.tracker_peers), ["127.0.0.1:9002"])
+
+    def test_pex_waits_for_the_scheduler_lock(self):
+        """
+        Test that gossip is not applied while a download worker holds the scheduler.
+        """
+        self.peer.init_piece_state(8)
+        gossip = f"127.0.0.1:9002: 8 {Bitfield.from_pieces(8, [2]).to_base64()}".encode()
+        applying = threading.Thread(target=self.peer.apply_pex, args=("127.0.0.1:9005", gossip))
+        with self.peer.scheduler_condition:
+            applying.start()
+            applying.join(0.1)
+            self.assertTrue(applying.is_alive())
+            self.assertEqual(self.peer.tracker_peers, {})
+        applying.join(5)
+        self.assertIn("127.0.0.1:9002", self.peer.tracker_peers)
+        self.assertEqual(self.peer.piece_manager.available_pieces[2], 1)
+
+    def test_pex_is_received_over_peer_connection(self):
+        """
+        Test that a peer learns gossiped peers from an incoming connection.
+        """
+        self.peer.init_piece_state(4)
+        server_end, client_end = tcp_socket_pair()
+        worker = threading.Thread(target=self.peer.handle_chunk_request, args=(server_end,), daemon=True)
+        worker.start()
+        client_end.sendall(encode_handshake("127.0.0.1:9091")
+                           + encode_pex(f"127.0.0.1:9091: 4 {Bitfield.full(4).to_base64()}"))
+        client_end.close()
+        worker.join(timeout=5)
+        self.assertEqual(self.peer.tracker_peers, {"127.0.0.1:9091": Bitfield.full(4)})
+
+    def test_pex_is_sent_over_accepted_connection(self):
+        """
+        Test that a peer that only accepts connections, like a seeder, gossips its peers too.
+        """
+        share_file(self.peer, b'test_chunk_data', self.directory)
+        self.peer.peer_port = 9090
+        self.peer.set_peer_chunks("127.0.0.1:9050", Bitfield.full(1))
+        client_end = self.serve_in_background(self.peer)
+        client_end.sendall(encode_handshake("127.0.0.1:9091"))
+        deadline = time.monotonic() + 5
+        while "127.0.0.1:9091" not in self.peer.upload_connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.peer.exchange_peers()
+        message_id, payload = read_message(client_end)
+        self.assertEqual(message_id, PEX)
+        gossiped = {line.split(":")[0] + ":" + line.split(":")[1] for line in payload.decode().split("\n")}
+        self.assertEqual(gossiped, {"127.0.0.1:9050", "127.0.0.1:9090"})
+        self.peer.exchange_peers()  # Nothing changed, nothing is sent
+        client_end.settimeout(0.2)
+        with self.assertRaises(socket.timeout):
+            read_message(client_end)
+        client_end.close()
+
+    def test_choked_peer_is_told_and_rejected(self):
+        """
+        Test that a peer beyond the upload slots is choked and its requests are rejected.
+        """
+        share_file(self.peer, b'test_chunk_data', self.directory)
+        for number in range(self.peer.choker.upload_slots):
+            self.peer.choker.add_peer(f"127.0.0.1:{9100 + number}")
+        client_end = self.serve_in_background(self.peer)
+
+        client_end.sendall(encode_handshake("127.0.0.1:9091") + encode_request(1, 0, 65536))
+        self.assertEqual(read_message(client_end), (CHOKE, b''))
+        message_id, payload = read_message(client_end)
+        self.assertEqual(message_id, REJECT)
+
+        self.peer.choker.remove_peer("127.0.0.1:9100")  # A slot frees up
+        self.peer.choke_peers()
+        self.assertEqual(read_message(client_end), (UNCHOKE, b''))
+        client_end.sendall(encode_request(1, 0, 65536))
+        message_id, payload = read_message(client_end)
+        self.assertEqual(decode_piece(payload), (1, 0, b'test_chunk_data'))
+        client_end.close()
+
+    def test_stalled_peer_releases_its_requests_on_time(self):
+        """
+        Test that requests to a peer that never answers are expired after the scheduler's
+        request timeout, not after the much longer socket timeout.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)  # Accepts the connection and never answers
+        self.addCleanup(listener.close)
+        stalled_addr = f"127.0.0.1:{listener.getsockname()[1]}"
+
+        self.peer.peer_port = 9999
+        self.peer.open_storage(os.path.join(self.directory, "download.bin"), 4 * CHUNK_SIZE)
+        self.addCleanup(self.peer.storage.close)
+        self.peer.set_peer_chunks(stalled_addr, Bitfield.full(4))
+        self.peer.scheduler = DownloadScheduler(self.peer.piece_manager, self.peer.storage.piece_size,
+                                                request_timeout=0.2)
+        worker = threading.Thread(target=self.peer.download_from_peer, args=(stalled_addr,))
+        started = time.monotonic()
+        worker.start()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.peer.scheduler.in_flight, {})  # Every block is back for other peers
+        self.assertEqual(self.peer.download_limiter.peer_buckets, {})
+
+    def test_waiting_while_choked_keeps_frames_whole(self):
+        """
+        Test that waiting for data on a connection never consumes part of a frame, so a
+        wait that times out in the middle of a message leaves the connection usable.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        connection = PeerConnection(f"127.0.0.1:{listener.getsockname()[1]}", "127.0.0.1:9999", timeout=0.05)
+        self.addCleanup(connection.close)
+        remote, _ = listener.accept()
+        self.addCleanup(remote.close)
 
-        self.peer.update_top_peers()
-        self.assertEqual(self.peer.top_peers, ["127.0.0.5", "127.0.0.3", "127.0.0.1", "127.0.0.2"])
-        self.assertIn(self.peer.optimistic_peer, ["127.0.0.4"])  # Non-top peers
+        self.assertFalse(connection.wait_readable())  # Nothing sent yet
+        frame = encode_message(UNCHOKE)
+        remote.sendall(frame[:2])  # Half of the length prefix
+        self.assertTrue(connection.wait_readable())
+        time.sleep(0.1)
+        remote.sendall(frame[2:])
+        self.assertEqual(connection.receive(), (UNCHOKE, b''))
 
 if __name__ == '__main__':
     unittest.main()
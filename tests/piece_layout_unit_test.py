@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from piece_layout import PieceLayout, choose_piece_size, MIN_PIECE_SIZE, MAX_PIECE_SIZE, MAX_PIECE_COUNT
+from torrent_metadata import TorrentMetadata
+from file_chunker import divide_file_to_chunks
+
+
+class TestPieceLayout(unittest.TestCase):
+    def test_small_files_use_the_minimum_piece_size(self):
+        self.assertEqual(choose_piece_size(0), MIN_PIECE_SIZE)
+        self.assertEqual(choose_piece_size(MIN_PIECE_SIZE * MAX_PIECE_COUNT), MIN_PIECE_SIZE)
+
+    def test_piece_count_stays_in_range(self):
+        for total_size in (10 ** 9, 3 * 10 ** 8 + 7, MIN_PIECE_SIZE * MAX_PIECE_COUNT + 1):
+            layout = PieceLayout(total_size)
+            self.assertLessEqual(layout.piece_count, MAX_PIECE_COUNT)
+            self.assertGreater(layout.piece_count, MAX_PIECE_COUNT // 2)
+
+    def test_piece_size_is_capped(self):
+        layout = PieceLayout(100 * MAX_PIECE_SIZE * MAX_PIECE_COUNT)
+        self.assertEqual(layout.piece_size, MAX_PIECE_SIZE)
+
+    def test_boundaries(self):
+        layout = PieceLayout(2500, 1000)
+        self.assertEqual(layout.piece_count, 3)
+        self.assertEqual(layout.piece_offset(3), 2000)
+        self.assertEqual(layout.piece_length(3), 500)
+        self.assertEqual(layout.piece_range(3, 400, 1000), (2400, 100))
+        with self.assertRaises(IndexError):
+            layout.piece_offset(4)
+
+    def test_pieces_in_range(self):
+        layout = PieceLayout(2500, 1000)
+        self.assertEqual(layout.pieces_in_range(0, 1000), range(1, 2))
+        self.assertEqual(layout.pieces_in_range(999, 2), range(1, 3))
+        self.assertEqual(layout.pieces_in_range(1500, 10000), range(2, 4))
+        self.assertFalse(layout.pieces_in_range(600, 0))
+
+    def test_segments_span_files(self):
+        layout = PieceLayout(2500, 1000, [600, 0, 1500, 400])
+        self.assertEqual(layout.segments(1), [(0, 0, 600), (2, 0, 400)])  # The empty file holds nothing
+        self.assertEqual(layout.segments(2), [(2, 400, 1000)])
+        self.assertEqual(layout.segments(3), [(2, 1400, 100), (3, 0, 400)])
+        self.assertEqual(layout.segments(3, begin=50, length=100), [(2, 1450, 50), (3, 0, 50)])
+        with self.assertRaises(ValueError):
+            PieceLayout(2500, 1000, [600, 1000])
+
+    def test_file_index(self):
+        layout = PieceLayout(2500, 1000, [600, 1900], ["a.bin", "sub/b.bin"])
+        self.assertEqual(layout.file_index("sub/b.bin"), 1)
+        with self.assertRaises(FileNotFoundError):
+            layout.file_index("c.bin")
+        with self.assertRaises(FileNotFoundError):
+            PieceLayout(2500, 1000).file_index("a.bin")  # No names to look up
+
+    def test_metadata_and_chunker_agree(self):
+        """
+        Test that the metadata hashes describe the chunks the file is divided into.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "shared.bin")
+        with open(path, 'wb') as shared_file:
+            shared_file.write(os.urandom(3 * MIN_PIECE_SIZE + 10))
+        metadata = TorrentMetadata(path, "").generate_metadata()
+        chunks = list(divide_file_to_chunks(path))
+        self.assertEqual(metadata["chunk_size"], PieceLayout(metadata["total_size"]).piece_size)
+        self.assertEqual(metadata["piece_hashes"], [chunk_hash for _, chunk_hash, _ in chunks])
+
+    def test_directory_metadata_and_chunker_agree(self):
+        """
+        Test that a directory is hashed as its files laid out one after the other.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = os.path.join(directory.name, "dataset")
+        os.makedirs(os.path.join(shared, "shards"))
+        contents = {"shards/b.bin": os.urandom(MIN_PIECE_SIZE + 5), "a.txt": b"first", "shards/c.bin": b""}
+        for relative_path, content in contents.items():
+            with open(os.path.join(shared, relative_path), 'wb') as shared_file:
+                shared_file.write(content)
+
+        metadata = TorrentMetadata(shared, "").generate_metadata()
+        self.assertEqual(metadata["file_name"], "dataset")
+        self.assertEqual(TorrentMetadata.file_list(metadata),
+                         [("a.txt", 5), ("shards/b.bin", MIN_PIECE_SIZE + 5), ("shards/c.bin", 0)])
+        self.assertEqual(metadata["total_size"], MIN_PIECE_SIZE + 10)
+        chunks = list(divide_file_to_chunks(shared))
+        self.assertEqual(b"".join(chunk for chunk, _, _ in chunks), contents["a.txt"] + contents["shards/b.bin"])
+        self.assertEqual(metadata["piece_hashes"], [chunk_hash for _, chunk_hash, _ in chunks])
+
+
+if __name__ == '__main__':
+    unittest.main()
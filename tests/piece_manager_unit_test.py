@@ -0,0 +1,168 @@
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+from bitfield import Bitfield
+from piece_manager import PieceManager, SKIP, LOW, HIGH, SCAN_THRESHOLD
+
+
+class TestPieceManager(unittest.TestCase):
+    def setUp(self):
+        self.piece_manager = PieceManager(10)
+
+    def test_rarest_piece(self):
+        """
+        Test that the piece with the fewest copies is picked first.
+        """
+        self.piece_manager.update_available_pieces([1, 2, 3])
+        self.piece_manager.update_available_pieces([1, 2])
+        self.piece_manager.update_available_pieces([1])
+        self.assertEqual(self.piece_manager.get_rarest_piece(), 3)
+        self.assertEqual(self.piece_manager.get_rarest_pieces(3), [3, 2, 1])
+
+    def test_completed_and_unavailable_pieces_are_skipped(self):
+        self.assertIsNone(self.piece_manager.get_rarest_piece())  # Nobody has anything yet
+        self.piece_manager.update_available_pieces([4, 5, 5])
+        self.piece_manager.mark_piece_complete(4)
+        self.assertEqual(self.piece_manager.get_rarest_piece(), 5)
+        self.piece_manager.mark_piece_complete(5)
+        self.assertIsNone(self.piece_manager.get_rarest_piece())
+
+    def test_peer_leaving_lowers_availability(self):
+        self.piece_manager.update_available_pieces([1, 2])
+        self.piece_manager.update_available_pieces([2])
+        self.piece_manager.update_available_pieces([1])
+        self.piece_manager.update_available_pieces([1])
+        self.piece_manager.remove_available_pieces([1, 1])
+        self.assertEqual(self.piece_manager.available_pieces[1], 1)
+        self.assertEqual(self.piece_manager.get_rarest_pieces(2), [1, 2])
+        self.piece_manager.remove_available_pieces([1])
+        self.assertEqual(self.piece_manager.get_rarest_pieces(5), [2])
+
+    def test_ties_are_broken_randomly(self):
+        """
+        Test that equally rare pieces are not always returned in the same order.
+        """
+        piece_manager = PieceManager(100)
+        piece_manager.update_available_pieces(range(1, 101))
+        picks = {piece_manager.get_rarest_piece() for _ in range(50)}
+        self.assertGreater(len(picks), 1)
+        picks = {piece_manager.get_rarest_piece_from(set(range(1, 101))) for _ in range(50)}
+        self.assertGreater(len(picks), 1)
+
+    def test_rarest_piece_from_peer(self):
+        """
+        Test that only pieces the peer has are considered, rarest first.
+        """
+        self.piece_manager.update_available_pieces([1, 2, 3])
+        self.piece_manager.update_available_pieces([2, 3])
+        self.assertIn(self.piece_manager.get_rarest_piece_from({2, 3}), {2, 3})
+        self.assertEqual(self.piece_manager.get_rarest_piece_from({1, 2, 3}), 1)
+        self.assertIn(self.piece_manager.get_rarest_piece_from({1, 2, 3}, exclude={1}), {2, 3})
+        self.assertIsNone(self.piece_manager.get_rarest_piece_from({7}))
+
+    def test_failed_piece_can_be_marked_missing_again(self):
+        self.piece_manager.update_available_pieces([6])
+        self.piece_manager.mark_piece_complete(6)
+        self.piece_manager.mark_piece_missing(6)
+        self.assertEqual(self.piece_manager.get_rarest_piece(), 6)
+        self.assertFalse(self.piece_manager.is_complete())
+
+
+    def test_priority_window_comes_before_rarest(self):
+        """
+        Test that the pieces ahead of a streaming reader are picked in order, then rarest first.
+        """
+        self.piece_manager.update_available_pieces(range(1, 11))
+        self.piece_manager.update_available_pieces(range(1, 10))  # Piece 10 is the rarest
+        self.piece_manager.set_priority_window(4, 3)
+        self.piece_manager.mark_piece_complete(4)
+        self.assertEqual(self.piece_manager.get_rarest_piece(), 5)
+        self.assertEqual(self.piece_manager.get_rarest_pieces(3), [5, 6, 10])
+        self.assertEqual(self.piece_manager.get_rarest_piece_from({2, 6, 10}, exclude={5}), 6)
+        self.piece_manager.set_priority_window(1, 0)
+        self.assertEqual(self.piece_manager.get_rarest_piece(), 10)
+
+
+    def test_priorities_come_before_rarity(self):
+        """
+        Test that higher priorities are picked first, rarest first within a priority, and skipped pieces never.
+        """
+        self.piece_manager.update_available_pieces(range(1, 11))
+        self.piece_manager.update_available_pieces(range(1, 10))  # Piece 10 is the rarest
+        self.piece_manager.set_priority([8, 9], HIGH)
+        self.piece_manager.update_available_pieces([9])
+        self.piece_manager.set_priority([10], LOW)
+        self.piece_manager.set_priority(range(1, 8), SKIP)
+        self.assertEqual(self.piece_manager.get_rarest_pieces(5), [8, 9, 10])
+        self.assertEqual(self.piece_manager.get_rarest_piece_from({1, 2, 9, 10}), 9)
+        self.assertIsNone(self.piece_manager.get_rarest_piece_from({1, 2}))
+
+    def test_completion_is_relative_to_wanted_pieces(self):
+        self.piece_manager.set_priority(range(3, 11), SKIP)
+        self.assertEqual(self.piece_manager.wanted_count, 2)
+        self.piece_manager.mark_piece_complete(1)
+        self.assertEqual(self.piece_manager.progress(), 0.5)
+        self.piece_manager.mark_piece_complete(2)
+        self.assertTrue(self.piece_manager.is_complete())
+        self.piece_manager.set_priority([3], LOW)
+        self.assertFalse(self.piece_manager.is_complete())
+
+
+    def test_partial_peers_walk_the_buckets(self):
+        """
+        Test that a peer with many, but not all, missing pieces is served from the buckets
+        rather than by scanning its pieces.
+        """
+        piece_manager = PieceManager(4 * SCAN_THRESHOLD)
+        piece_manager.update_available_pieces(range(1, 4 * SCAN_THRESHOLD + 1))
+        piece_manager.update_available_pieces(range(1, 4 * SCAN_THRESHOLD))  # The last piece is the rarest
+        partial_peer = Bitfield.from_pieces(4 * SCAN_THRESHOLD, range(2 * SCAN_THRESHOLD, 4 * SCAN_THRESHOLD + 1))
+        with patch.object(PieceManager, "_rarest_of", side_effect=AssertionError("linear scan")):
+            self.assertEqual(piece_manager.get_rarest_piece_from(partial_peer), 4 * SCAN_THRESHOLD)
+        small_peer = Bitfield.from_pieces(4 * SCAN_THRESHOLD, range(1, 10))
+        self.assertIn(piece_manager.get_rarest_piece_from(small_peer), range(1, 10))
+
+    def test_concurrent_updates_keep_the_buckets_consistent(self):
+        """
+        Test that peers announcing pieces from several threads while another picks pieces
+        leave every missing piece in the bucket of its availability.
+        """
+        piece_manager = PieceManager(2000)
+        errors = []
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switch threads often, in the middle of bucket updates
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def announce(seed):
+            try:
+                pieces = list(range(1 + seed, 2001, 3))
+                for _ in range(20):
+                    piece_manager.update_available_pieces(pieces)
+                    piece_manager.set_priority(pieces[::7], HIGH if seed else LOW)
+                    piece_manager.remove_available_pieces(pieces)
+            except Exception as e:
+                errors.append(e)
+
+        def pick():
+            try:
+                peer_chunks = Bitfield.from_pieces(2000, range(1, 2001, 2))
+                for _ in range(200):
+                    piece_manager.get_rarest_piece_from(peer_chunks)
+                    piece_manager.get_rarest_pieces(10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=announce, args=(seed,)) for seed in range(3)]
+        threads.append(threading.Thread(target=pick))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(piece_manager.available_pieces, [0] * 2001)
+        self.assertEqual(piece_manager.buckets, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
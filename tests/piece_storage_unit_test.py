@@ -0,0 +1,122 @@
+import os
+import socket
+import tempfile
+import unittest
+from piece_storage import PieceStorage
+
+
+class TestPieceStorage(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "output", "file.bin")
+
+    def test_file_is_preallocated(self):
+        storage = PieceStorage(self.path, 2500, piece_size=1000)
+        self.addCleanup(storage.close)
+        self.assertEqual(os.path.getsize(self.path), 2500)
+        self.assertEqual(storage.piece_count, 3)
+        self.assertEqual(storage.piece_length(3), 500)
+
+    def test_pieces_are_written_in_place(self):
+        """
+        Test that pieces written in any order produce the complete file.
+        """
+        storage = PieceStorage(self.path, 2500, piece_size=1000)
+        storage.write_piece(3, b"c" * 500)
+        storage.write_piece(1, b"a" * 1000)
+        storage.write_piece(2, b"b" * 1000)
+        self.assertEqual(bytes(storage.read_piece(2, begin=10, length=5)), b"bbbbb")
+        storage.close()
+        with open(self.path, 'rb') as written:
+            self.assertEqual(written.read(), b"a" * 1000 + b"b" * 1000 + b"c" * 500)
+
+    def test_existing_file_is_served(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as existing:
+            existing.write(b"0123456789")
+        storage = PieceStorage(self.path, 10, piece_size=4)
+        self.addCleanup(storage.close)
+        self.assertEqual(bytes(storage.read_piece(3)), b"89")
+
+    def test_existing_file_of_another_size_is_not_resized(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as existing:
+            existing.write(b"0123456789")
+        with self.assertRaises(ValueError):
+            PieceStorage(self.path, 20, piece_size=4)
+        with open(self.path, 'rb') as existing:
+            self.assertEqual(existing.read(), b"0123456789")
+
+    def test_read_only_storage_refuses_writes(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as existing:
+            existing.write(b"0123456789")
+        storage = PieceStorage(self.path, 10, piece_size=4, read_only=True)
+        self.addCleanup(storage.close)
+        self.assertEqual(bytes(storage.read_piece(2)), b"4567")
+        with self.assertRaises(PermissionError):
+            storage.write_piece(1, b"xxxx")
+        storage.flush()
+        with open(self.path, 'rb') as existing:
+            self.assertEqual(existing.read(), b"0123456789")
+
+    def test_send_piece(self):
+        """
+        Test that piece data reaches the socket both through sendfile and through the mapping fallback.
+        """
+        storage = PieceStorage(self.path, 2500, piece_size=1000)
+        self.addCleanup(storage.close)
+        storage.write_piece(2, bytes(range(250)) * 4)
+        for can_sendfile in (storage.can_sendfile, False):
+            storage.can_sendfile = can_sendfile
+            sender, receiver = socket.socketpair()
+            storage.send_piece(sender, 2, 100, 5000)  # Clamped to the end of the piece
+            sender.close()
+            received = b""
+            while chunk := receiver.recv(4096):
+                received += chunk
+            receiver.close()
+            self.assertEqual(received, (bytes(range(250)) * 4)[100:])
+
+    def test_oversized_write_is_refused(self):
+        storage = PieceStorage(self.path, 1500, piece_size=1000)
+        self.addCleanup(storage.close)
+        with self.assertRaises(ValueError):
+            storage.write_piece(2, b"x" * 1000)
+        with self.assertRaises(IndexError):
+            storage.read_piece(3)
+
+    def test_pieces_span_files(self):
+        """
+        Test that a multi-file storage splits pieces over the files they span.
+        """
+        directory = os.path.dirname(self.path)
+        files = [("a.bin", 600), ("empty.bin", 0), ("sub/b.bin", 1900)]
+        storage = PieceStorage(directory, 2500, piece_size=1000, files=files)
+        self.addCleanup(storage.close)
+        storage.write_piece(1, b"1" * 1000)
+        storage.write_piece(3, b"3" * 500)
+        storage.write_piece(2, b"2" * 1000)
+        self.assertEqual(bytes(storage.read_piece(1, begin=590, length=20)), b"1" * 20)
+        self.assertEqual(storage.piece_count, 3)
+
+        sender, receiver = socket.socketpair()
+        storage.send_piece(sender, 1, 500, 1000)
+        sender.close()
+        received = b""
+        while chunk := receiver.recv(4096):
+            received += chunk
+        receiver.close()
+        self.assertEqual(received, b"1" * 500)
+
+        storage.flush()
+        with open(os.path.join(directory, "a.bin"), 'rb') as first:
+            self.assertEqual(first.read(), b"1" * 600)
+        self.assertEqual(os.path.getsize(os.path.join(directory, "empty.bin")), 0)
+        with open(os.path.join(directory, "sub", "b.bin"), 'rb') as second:
+            self.assertEqual(second.read(), b"1" * 400 + b"2" * 1000 + b"3" * 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from rate_limiter import TokenBucket, RateLimiter, BURST_SECONDS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_unlimited_bucket_never_waits(self):
+        bucket = TokenBucket(None, self.clock)
+        self.assertEqual(bucket.reserve(10 ** 9), 0)
+
+    def test_blocks_are_spaced_at_the_rate(self):
+        bucket = TokenBucket(1000, self.clock)
+        self.clock.now = 10  # Idle time only fills the bucket up to its capacity
+        burst = 1000 * BURST_SECONDS
+        self.assertEqual(bucket.reserve(burst), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5)
+        self.assertAlmostEqual(bucket.reserve(500), 1.0)  # Queued behind the first block
+        self.clock.now += 1.0
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+
+    def test_rate_can_change_at_runtime(self):
+        bucket = TokenBucket(1000, self.clock)
+        self.assertAlmostEqual(bucket.reserve(1000), 1.0)
+        bucket.set_rate(2000)
+        self.assertAlmostEqual(bucket.reserve(1000), 1.0)  # The debt of 2000 is paid twice as fast
+        bucket.set_rate(None)
+        self.assertEqual(bucket.reserve(1000), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_slower_of_global_and_peer_limit_applies(self):
+        limiter = RateLimiter(rate=10000, peer_rate=1000, clock=self.clock)
+        self.assertAlmostEqual(limiter.reserve("127.0.0.1:9001", 1000), 1.0)  # The peer limit
+        self.assertAlmostEqual(limiter.reserve("127.0.0.1:9002", 1000), 1.0)  # Each peer has its own bucket
+        limiter.set_peer_rate(None)
+        self.assertAlmostEqual(limiter.reserve("127.0.0.1:9001", 6000), 0.8)  # The global limit, after 2000 bytes
+
+    def test_removed_peer_starts_over(self):
+        limiter = RateLimiter(peer_rate=1000, clock=self.clock)
+        limiter.reserve("127.0.0.1:9001", 5000)
+        limiter.remove_peer("127.0.0.1:9001")
+        self.assertAlmostEqual(limiter.reserve("127.0.0.1:9001", 1000), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
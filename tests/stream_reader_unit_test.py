@@ -0,0 +1,70 @@
+import os
+import tempfile
+import threading
+import unittest
+from peer import Peer
+from stream_reader import StreamReader
+
+
+class TestStreamReader(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.content = os.urandom(4 * 64 * 1024 + 100)
+        self.peer = Peer("127.0.0.1")
+        self.peer.open_storage(os.path.join(directory.name, "download.bin"), len(self.content))
+        self.addCleanup(self.peer.storage.close)
+        self.chunk_size = self.peer.storage.piece_size
+
+    def chunk(self, chunk_number):
+        offset = (chunk_number - 1) * self.chunk_size
+        return self.content[offset:offset + self.chunk_size]
+
+    def store(self, chunk_number):
+        self.peer.store_received_chunk(chunk_number, self.chunk(chunk_number), "test")
+
+    def test_reads_chunks_that_are_present(self):
+        self.store(1)
+        with self.peer.open_reader() as reader:
+            self.assertEqual(reader.read(100), self.content[:100])
+            reader.seek(self.chunk_size - 10)
+            self.assertEqual(reader.read(10), self.content[self.chunk_size - 10:self.chunk_size])
+
+    def test_read_blocks_until_the_chunk_arrives(self):
+        """
+        Test that a read waits for a missing chunk and that the chunks ahead of it become the priority.
+        """
+        for chunk_number in (1, 2):
+            self.store(chunk_number)
+        reader = StreamReader(self.peer, readahead=2)
+        reader.seek(self.chunk_size)
+        self.assertEqual(reader.read(self.chunk_size), self.chunk(2))
+
+        result = []
+        thread = threading.Thread(target=lambda: result.append(reader.read(10)))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())  # Chunk 3 is missing
+        self.assertEqual(self.peer.piece_manager.priority_window, range(3, 5))
+        self.store(3)
+        thread.join(5)
+        self.assertEqual(result, [self.chunk(3)[:10]])
+
+        reader.close()
+        self.assertFalse(self.peer.piece_manager.priority_window)
+
+    def test_whole_file_is_read_in_order(self):
+        for chunk_number in range(1, self.peer.total_chunks + 1):
+            self.store(chunk_number)
+        with self.peer.open_reader() as reader:
+            self.assertEqual(reader.read(), self.content)
+            self.assertEqual(reader.read(1), b"")
+
+    def test_timeout(self):
+        reader = StreamReader(self.peer, timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            reader.read(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
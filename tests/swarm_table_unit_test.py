@@ -0,0 +1,54 @@
+import unittest
+from bitfield import Bitfield
+from swarm_table import SwarmTable
+
+
+class TestSwarmTable(unittest.TestCase):
+    def setUp(self):
+        self.swarm = SwarmTable(num_want=5)
+        self.chunks = Bitfield.from_pieces(8, [1])
+        for port in range(8000, 8100):
+            self.swarm.add_peer(f"127.0.0.1:{port}", self.chunks)
+
+    def test_announce_returns_bounded_random_subset(self):
+        version, full, updated, removed = self.swarm.announce("127.0.0.1:8000")
+        self.assertTrue(full)
+        self.assertEqual(len(updated), 5)
+        self.assertNotIn("127.0.0.1:8000", updated)
+        self.assertEqual(removed, [])
+        self.assertEqual(version, self.swarm.version)
+
+    def test_delta_only_contains_changes_in_the_view(self):
+        version, _, first, _ = self.swarm.announce("127.0.0.1:8000")
+        changed, gone = sorted(first)[:2]
+        self.swarm.add_peer(changed, Bitfield.full(8))
+        self.swarm.remove_peer(gone)
+        self.swarm.add_peer("127.0.0.1:9000", self.chunks)  # Not in the view, and the view is refilled randomly
+
+        version, full, updated, removed = self.swarm.announce("127.0.0.1:8000", version)
+        self.assertFalse(full)
+        self.assertEqual(removed, [gone])
+        self.assertEqual(updated[changed], Bitfield.full(8))
+        self.assertEqual(len(updated), 2)  # The changed peer and one replacement for the removed one
+
+    def test_unchanged_swarm_gives_empty_delta(self):
+        version, _, _, _ = self.swarm.announce("127.0.0.1:8000")
+        self.swarm.add_peer("127.0.0.1:8001", self.chunks)  # Same chunks, nothing changes
+        self.assertEqual(self.swarm.announce("127.0.0.1:8000", version), (version, False, {}, []))
+
+    def test_unknown_version_gets_full_list(self):
+        version, _, _, _ = self.swarm.announce("127.0.0.1:8000")
+        _, full, updated, _ = self.swarm.announce("127.0.0.1:8000", version + 1)
+        self.assertTrue(full)
+        self.assertEqual(len(updated), 5)
+
+    def test_stats_count_seeders(self):
+        self.swarm.add_peer("127.0.0.1:8000", Bitfield.full(8))
+        self.swarm.announce("127.0.0.1:8001")
+        self.assertEqual(self.swarm.stats(), {"peers": 100, "seeders": 1, "leechers": 99, "announces": 1})
+        self.swarm.remove_peer("127.0.0.1:8000")
+        self.assertEqual(self.swarm.stats()["seeders"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
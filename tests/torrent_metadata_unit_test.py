@@ -0,0 +1,67 @@
+import os
+import json
+import tempfile
+import unittest
+from torrent_metadata import TorrentMetadata, PieceHashes, METADATA_MAGIC, HASH_LENGTH
+
+
+class TestTorrentMetadata(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.shared_path = os.path.join(self.directory, "shared.bin")
+        with open(self.shared_path, 'wb') as shared_file:
+            shared_file.write(os.urandom(300 * 1024 + 7))
+        self.metadata_path = os.path.join(self.directory, "shared.torrent")
+
+    def test_binary_round_trip(self):
+        """
+        Test that a saved metadata file loads back with the same fields and hashes.
+        """
+        torrent = TorrentMetadata(self.shared_path, "http://tracker/announce")
+        generated = torrent.generate_metadata()
+        torrent.save_metadata_to_file(self.metadata_path)
+        with open(self.metadata_path, 'rb') as metafile:
+            self.assertEqual(metafile.read(len(METADATA_MAGIC)), METADATA_MAGIC)
+
+        loaded = TorrentMetadata.load_metadata(self.metadata_path)
+        self.assertIsInstance(loaded["piece_hashes"], PieceHashes)
+        self.assertEqual(list(loaded["piece_hashes"]), generated["piece_hashes"])
+        self.assertEqual(loaded["piece_hashes"][-1], generated["piece_hashes"][-1])
+        for key in ("file_name", "tracker_url", "chunk_size", "total_size"):
+            self.assertEqual(loaded[key], generated[key])
+        self.assertEqual(TorrentMetadata.info_hash(loaded), TorrentMetadata.info_hash(generated))
+        with self.assertRaises(IndexError):
+            loaded["piece_hashes"][len(generated["piece_hashes"])]
+
+    def test_hashes_are_packed(self):
+        torrent = TorrentMetadata(self.shared_path, "")
+        torrent.save_metadata_to_file(self.metadata_path)
+        hash_count = len(torrent.piece_hashes)
+        self.assertLess(os.path.getsize(self.metadata_path), 200 + hash_count * HASH_LENGTH)
+
+    def test_merkle_metadata_has_no_piece_hashes(self):
+        TorrentMetadata(self.shared_path, "", merkle=True).save_metadata_to_file(self.metadata_path)
+        loaded = TorrentMetadata.load_metadata(self.metadata_path)
+        self.assertNotIn("piece_hashes", loaded)
+        self.assertEqual(len(bytes.fromhex(loaded["merkle_root"])), 32)
+
+    def test_truncated_file_is_rejected(self):
+        TorrentMetadata(self.shared_path, "").save_metadata_to_file(self.metadata_path)
+        with open(self.metadata_path, 'r+b') as metafile:
+            metafile.truncate(os.path.getsize(self.metadata_path) - 1)
+        with self.assertRaises(ValueError):
+            TorrentMetadata.load_metadata(self.metadata_path)
+
+    def test_json_metadata_still_loads(self):
+        generated = TorrentMetadata(self.shared_path, "").generate_metadata()
+        with open(self.metadata_path, 'w') as metafile:
+            json.dump(generated, metafile, indent=4)
+        loaded = TorrentMetadata.load_metadata(self.metadata_path)
+        self.assertEqual(loaded, generated)
+        self.assertEqual(TorrentMetadata.info_hash(loaded), TorrentMetadata.info_hash(generated))
+
+
+if __name__ == '__main__':
+    unittest.main()
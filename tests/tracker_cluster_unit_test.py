@@ -0,0 +1,83 @@
+import socket
+import time
+import unittest
+from bitfield import Bitfield
+from peer import Peer
+from peer_protocol import send_frame, read_frame
+from tracker_cluster import TrackerCluster, rank_endpoints, parse_endpoints, start_local_cluster
+
+ENDPOINTS = [('127.0.0.1', 9090), ('127.0.0.1', 9091), ('127.0.0.1', 9092)]
+
+
+class TestTrackerCluster(unittest.TestCase):
+    def test_rank_is_stable_and_spreads_swarms(self):
+        info_hashes = [f"{number:040x}" for number in range(300)]
+        first_choices = [rank_endpoints(info_hash, ENDPOINTS)[0] for info_hash in info_hashes]
+        self.assertEqual(first_choices, [rank_endpoints(info_hash, ENDPOINTS[::-1])[0] for info_hash in info_hashes])
+        for endpoint in ENDPOINTS:
+            self.assertGreater(first_choices.count(endpoint), 50)  # Every tracker owns a share of the swarms
+
+    def test_replica_targets_exclude_own_endpoint(self):
+        info_hash = "ab" * 20
+        owners = rank_endpoints(info_hash, ENDPOINTS)[:2]
+        cluster = TrackerCluster(ENDPOINTS, owners[0])
+        self.assertEqual(cluster.owners(info_hash), owners)
+        self.assertEqual(cluster.replica_targets(info_hash), [owners[1]])
+
+    def test_parse_endpoints(self):
+        self.assertEqual(parse_endpoints("127.0.0.1:9090, 127.0.0.1:9091"), ENDPOINTS[:2])
+
+
+class TestLocalTrackerCluster(unittest.TestCase):
+    """
+    Runs three tracker processes on localhost and checks that a swarm survives the loss of its tracker.
+    """
+
+    def setUp(self):
+        self.processes, self.endpoints = start_local_cluster(3)
+        for process in self.processes:
+            self.addCleanup(process.wait)
+            self.addCleanup(process.terminate)
+
+    def wait_for_swarm_size(self, endpoint, info_hash, size, timeout=5):
+        """
+        Polls a tracker with SCRAPE until the swarm has the expected number of peers.
+        """
+        deadline = time.monotonic() + timeout
+        with socket.create_connection(endpoint) as tracker_socket:
+            while time.monotonic() < deadline:
+                send_frame(tracker_socket, f"SCRAPE {info_hash}".encode())
+                if read_frame(tracker_socket).decode().split(" ")[0] == str(size):
+                    return
+                time.sleep(0.05)
+        self.fail(f"Swarm on {endpoint} did not reach {size} peers")
+
+    def make_peer(self, port, chunk):
+        peer = Peer("127.0.0.1", trackers=self.endpoints)
+        peer.peer_port = port
+        peer.init_piece_state(8)
+        peer.received_chunks.add(chunk)
+        self.addCleanup(peer.close_tracker_connection)
+        return peer
+
+    def test_peers_fail_over_to_a_replica(self):
+        first, second = self.make_peer(7001, 1), self.make_peer(7002, 2)
+        first.register_with_tracker()
+        second.register_with_tracker()
+        self.assertEqual(list(second.tracker_peers), ["127.0.0.1:7001"])
+
+        primary, replica = first.tracker_endpoints()[:2]
+        self.wait_for_swarm_size(replica, first.info_hash, 2)
+        self.processes[self.endpoints.index(primary)].terminate()
+        self.processes[self.endpoints.index(primary)].wait()
+
+        third = self.make_peer(7003, 3)
+        third.register_with_tracker()  # The primary is gone, the replica already knows the swarm
+        self.assertEqual(sorted(third.tracker_peers), ["127.0.0.1:7001", "127.0.0.1:7002"])
+        self.assertEqual(third.tracker_peers["127.0.0.1:7001"], Bitfield.from_pieces(8, [1]))
+        first.register_with_tracker()
+        self.assertIn("127.0.0.1:7003", first.tracker_peers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,32 +1,119 @@
+import asyncio
 import unittest
-from unittest.mock import patch, MagicMock
-from tracker import Tracker
+from unittest.mock import MagicMock
+from bitfield import Bitfield
+from tracker_server import Tracker, MIN_ANNOUNCE_INTERVAL
+from peer_protocol import encode_frame, read_frame_async
+
+INFO_HASH = "ab" * 20
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def frame(text):
+    return encode_frame(text.encode())
 
 class TestTracker(unittest.TestCase):
 
     def setUp(self):
-        self.tracker = Tracker()
-
-    @patch('tracker.socket.socket')
-    def test_add_peer(self, mock_socket):
-        client_socket = MagicMock()
-        self.tracker.add_peer(client_socket, "ADD_PEER 127.0.0.1:8000")
-        self.assertIn("127.0.0.1:8000", self.tracker.peers)
-        client_socket.send.assert_called_with(b"PEER_ADDED")
-
-    @patch('tracker.socket.socket')
-    def test_add_duplicate_peer(self, mock_socket):
-        client_socket = MagicMock()
-        self.tracker.peers.append("127.0.0.1:8000")  # Simulate already added peer
-        self.tracker.add_peer(client_socket, "ADD_PEER 127.0.0.1:8000")
-        client_socket.send.assert_called_with(b"PEER_ALREADY_EXISTS")
-
-    @patch('tracker.socket.socket')
-    def test_send_peer_list(self, mock_socket):
-        client_socket = MagicMock()
-        self.tracker.peers.append("127.0.0.1:8000")
-        self.tracker.send_peers_list(client_socket, "127.0.0.1")
-        client_socket.send.assert_called_with(b"127.0.0.1:8000")
+        self.clock = FakeClock()
+        self.tracker = Tracker(announce_interval=10, peer_ttl=30, clock=self.clock)
+        self.writer = MagicMock()
+        self.chunks = Bitfield.from_pieces(10, [1, 2])
+        self.swarm = self.tracker.get_swarm(INFO_HASH, create=True)
+
+    def test_add_peer(self):
+        peer_addr = self.tracker.add_peer(self.writer, f"ADD_PEER {INFO_HASH} 127.0.0.1:8000 10 {self.chunks.to_base64()}")
+        self.assertEqual(peer_addr, (INFO_HASH, "127.0.0.1:8000"))
+        self.assertEqual(self.swarm.peers["127.0.0.1:8000"], self.chunks)
+        self.writer.write.assert_called_with(frame(f"PEER_ADDED 10 {MIN_ANNOUNCE_INTERVAL}"))
+
+    def test_add_duplicate_peer(self):
+        self.tracker.add_peer(self.writer, f"ADD_PEER {INFO_HASH} 127.0.0.1:8000 10 {self.chunks.to_base64()}")
+        self.tracker.add_peer(self.writer, f"ADD_PEER {INFO_HASH} 127.0.0.1:8000 10 {Bitfield.full(10).to_base64()}")
+        self.writer.write.assert_called_with(frame(f"PEER_UPDATED 10 {MIN_ANNOUNCE_INTERVAL}"))
+        self.assertTrue(self.swarm.peers["127.0.0.1:8000"].is_complete())
+
+    def test_send_peer_list(self):
+        self.swarm.add_peer("127.0.0.1:8000", self.chunks)
+        self.tracker.send_peers_list(self.writer, "REQUEST_PEERS", INFO_HASH, "127.0.0.1:8001")
+        self.writer.write.assert_called_with(frame(f"PEERS 1 FULL\n127.0.0.1:8000: 10 {self.chunks.to_base64()}"))
+
+    def test_send_peer_list_delta(self):
+        """
+        Test that a second announce only carries what changed since the first one.
+        """
+        self.swarm.add_peer("127.0.0.1:8000", self.chunks)
+        self.swarm.add_peer("127.0.0.1:8002", self.chunks)
+        self.tracker.send_peers_list(self.writer, "REQUEST_PEERS 0", INFO_HASH, "127.0.0.1:8001")
+        self.swarm.remove_peer("127.0.0.1:8000")
+        self.swarm.add_peer("127.0.0.1:8003", self.chunks)
+        self.tracker.send_peers_list(self.writer, "REQUEST_PEERS 2", INFO_HASH, "127.0.0.1:8001")
+        self.writer.write.assert_called_with(
+            frame(f"PEERS 4 DELTA\n127.0.0.1:8003: 10 {self.chunks.to_base64()}\nREMOVED 127.0.0.1:8000")
+        )
+
+    def test_remove_peer_by_address(self):
+        self.swarm.add_peer("127.0.0.1:8000", self.chunks)
+        self.tracker.remove_peer(self.writer, "REMOVE_PEER", INFO_HASH, "127.0.0.1:8000")
+        self.writer.write.assert_called_with(frame("PEER_REMOVED"))
+        self.assertNotIn(INFO_HASH, self.tracker.swarms)  # The swarm is dropped with its last peer
+
+    def test_silent_peers_are_evicted(self):
+        """
+        Test that a peer without heartbeats is evicted after its TTL, while one sending heartbeats stays.
+        """
+        for port in (8000, 8001):
+            self.tracker.add_peer(self.writer, f"ADD_PEER {INFO_HASH} 127.0.0.1:{port} 10 {self.chunks.to_base64()}")
+        self.clock.now = 20
+        self.tracker.heartbeat(self.writer, f"HEARTBEAT {INFO_HASH} 127.0.0.1:8001", None, None)
+        self.writer.write.assert_called_with(frame(f"OK 10 {MIN_ANNOUNCE_INTERVAL}"))
+
+        self.clock.now = 30
+        self.assertEqual(self.tracker.evict_expired_peers(), [(INFO_HASH, "127.0.0.1:8000")])
+        self.assertEqual(list(self.swarm.peers), ["127.0.0.1:8001"])
+        self.tracker.heartbeat(self.writer, f"HEARTBEAT {INFO_HASH} 127.0.0.1:8000", None, None)
+        self.writer.write.assert_called_with(frame("UNKNOWN_PEER"))  # It has to register again
+
+        self.clock.now = 50
+        self.assertEqual(self.tracker.evict_expired_peers(), [(INFO_HASH, "127.0.0.1:8001")])
+        self.assertEqual(self.tracker.swarms, {})
+
+    def test_swarms_are_separate(self):
+        """
+        Test that peers of different torrents never see each other, and that scrape counts per swarm.
+        """
+        other_hash = "cd" * 20
+        self.tracker.add_peer(self.writer, f"ADD_PEER {INFO_HASH} 127.0.0.1:8000 10 {Bitfield.full(10).to_base64()}")
+        self.tracker.add_peer(self.writer, f"ADD_PEER {other_hash} 127.0.0.1:9000 10 {self.chunks.to_base64()}")
+        self.tracker.send_peers_list(self.writer, "REQUEST_PEERS", other_hash, "127.0.0.1:9001")
+        self.writer.write.assert_called_with(frame(f"PEERS 1 FULL\n127.0.0.1:9000: 10 {self.chunks.to_base64()}"))
+        self.tracker.send_swarm_stats(self.writer, f"SCRAPE {INFO_HASH}")
+        self.writer.write.assert_called_with(frame("1 1 0 0"))
+        self.tracker.send_swarm_stats(self.writer, "SCRAPE unknown")
+        self.writer.write.assert_called_with(frame("UNKNOWN_TORRENT"))
+
+    def test_announce_over_tcp(self):
+        """
+        Test a registration and a peer list request against the running asyncio server.
+        """
+        async def scenario():
+            self.swarm.add_peer("127.0.0.1:8000", self.chunks)
+            server = await asyncio.start_server(self.tracker.handle_peer, '127.0.0.1', 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+                writer.write(frame(f"ADD_PEER {INFO_HASH} 127.0.0.1:8001 10 {self.chunks.to_base64()}") + frame("REQUEST_PEERS"))
+                responses = [await read_frame_async(reader), await read_frame_async(reader)]
+                writer.close()
+            return responses
+
+        added, peer_list = asyncio.run(scenario())
+        self.assertEqual(added, f"PEER_ADDED 10 {MIN_ANNOUNCE_INTERVAL}".encode())
+        self.assertEqual(peer_list.decode().split("\n")[1], f"127.0.0.1:8000: 10 {self.chunks.to_base64()}")
 
 if __name__ == '__main__':
     unittest.main()
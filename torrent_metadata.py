@@ -1,63 +1,191 @@
 import os
 import json
+import mmap
+import struct
 import hashlib
+from hashing import hash_file_pieces
+from piece_layout import PieceLayout, list_files
+from merkle import MerkleTree
+from peer_protocol import BLOCK_SIZE
+
+INFO_KEYS = ("file_name", "chunk_size", "total_size", "piece_hashes", "merkle_root", "files")  # the fields the info hash covers
+METADATA_MAGIC = b"P2PMETA1"  # first bytes of a binary metadata file, the last one is the format version
+METADATA_HEADER = struct.Struct(">8sII")  # magic, length of the JSON encoded fields, number of chunk hashes
+HASH_LENGTH = 20  # bytes of a SHA1 digest
+
+
+def pack_hashes(piece_hashes):
+    """
+    RETURNS:
+    The chunk hashes as one bytes-like object of HASH_LENGTH byte digests, in chunk order.
+    """
+    if isinstance(piece_hashes, PieceHashes):
+        return piece_hashes.packed
+    return b"".join(bytes.fromhex(piece_hash) for piece_hash in piece_hashes)
+
+
+class PieceHashes:
+    """
+    The chunk hashes of a loaded metadata file. They stay packed in the memory-mapped file,
+    and looking up a hash slices out and hex-encodes that one digest, so loading a torrent
+    with a million chunks neither parses nor keeps a million strings. Indexed from 0 like
+    the list generate_metadata returns: piece_hashes[n - 1] is the hash of chunk n.
+    """
+
+    def __init__(self, buffer, offset, count):
+        """
+        PARAMETERS:
+        buffer: The memory-mapped metadata file.
+        offset: Offset of the first digest in the buffer.
+        count: Number of digests.
+        """
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(f"Hash {index} is outside 0..{self.count - 1}")
+        start = self.offset + index * HASH_LENGTH
+        return self.buffer[start:start + HASH_LENGTH].hex()
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    @property
+    def packed(self):
+        """
+        All digests, as a view of the mapping rather than a copy.
+        """
+        return memoryview(self.buffer)[self.offset:self.offset + self.count * HASH_LENGTH]
+
 
 class TorrentMetadata:
-    def __init__(self, file_path, tracker_url, chunk_size=256 * 1024):
+    def __init__(self, file_path, tracker_url, chunk_size=None, merkle=False):  # None picks the chunk size from the file size
         self.file_path = file_path
         self.tracker_url = tracker_url
         self.chunk_size = chunk_size
+        self.merkle = merkle  # Store only the root of a Merkle tree over 16 KB blocks instead of every chunk hash
         self.piece_hashes = []  # Stores SHA1 hashes of each chunk
         self.total_size = None
+        self.files = None  # (relative path, size) of every file when file_path is a directory
 
     def generate_metadata(self):
         """
         Generates metadata including piece hashes for each chunk and total file size.
-        This information is stored in a dictionary and can be saved as a .torrent JSON file.
+        This information is stored in a dictionary and can be saved as a .torrent file.
+        A directory becomes a multi-file torrent: its files are laid out one after the other
+        in sorted order, chunks span file boundaries, and the metadata lists every file.
         """
         if not os.path.exists(self.file_path):
             raise FileNotFoundError(f"File {self.file_path} does not exist.")
         
         # Calculate the total file size
-        self.total_size = os.path.getsize(self.file_path)
-        
-        # Calculate hashes for each chunk and add to piece_hashes
-        with open(self.file_path, 'rb') as file:
-            while chunk := file.read(self.chunk_size):
-                chunk_hash = hashlib.sha1(chunk).hexdigest()
-                self.piece_hashes.append(chunk_hash)
+        if os.path.isdir(self.file_path):
+            self.files = list_files(self.file_path)
+            self.total_size = sum(size for _, size in self.files)
+        else:
+            self.total_size = os.path.getsize(self.file_path)
+        # The same layout the peers store and exchange the chunks in, so the hashes cover the same ranges
+        layout = PieceLayout(self.total_size, self.chunk_size)
         
         metadata = {
-            "file_name": os.path.basename(self.file_path),
+            "file_name": os.path.basename(os.path.normpath(self.file_path)),
             "tracker_url": self.tracker_url,
-            "chunk_size": self.chunk_size,
+            "chunk_size": layout.piece_size,
             "total_size": self.total_size,
-            "piece_hashes": self.piece_hashes
         }
+        if self.merkle:
+            # A few bytes whatever the file size, peers prove every block against the root
+            if layout.piece_size % BLOCK_SIZE or not self.total_size:
+                raise ValueError(f"A Merkle tree needs a non-empty file and a chunk size that is a multiple of {BLOCK_SIZE}")
+            metadata["merkle_root"] = MerkleTree.from_file(self.file_path, layout.piece_size, self.files).root.hex()
+        else:
+            # Calculate hashes for each chunk on all cores, the results come back in piece order
+            self.piece_hashes = hash_file_pieces(self.file_path, layout.piece_size, files=self.files)
+            metadata["piece_hashes"] = self.piece_hashes
+        if self.files is not None:
+            metadata["files"] = [{"path": path, "length": size} for path, size in self.files]
         
         return metadata
 
     def save_metadata_to_file(self, output_path):
         """
-        Saves the generated metadata to a JSON file, which acts as the .torrent file.
+        Saves the generated metadata to a binary .torrent file: a fixed header, the fields
+        other than the chunk hashes as compact JSON, then the chunk hashes packed as raw
+        20-byte digests. The hashes are most of the file, packing them halves its size
+        and lets load_metadata look any of them up without parsing the others.
         
         :param output_path: Path where the metadata file will be saved.
         """
         metadata = self.generate_metadata()
-        with open(output_path, 'w') as metafile:
-            json.dump(metadata, metafile, indent=4)
+        piece_hashes = metadata.pop("piece_hashes", [])  # Merkle metadata has none
+        fields = json.dumps(metadata, separators=(",", ":")).encode()
+        with open(output_path, 'wb') as metafile:
+            metafile.write(METADATA_HEADER.pack(METADATA_MAGIC, len(fields), len(piece_hashes)))
+            metafile.write(fields)
+            metafile.write(pack_hashes(piece_hashes))
         print(f"Metadata saved to {output_path}")
 
+    @staticmethod
+    def info_hash(metadata):
+        """
+        Identifies the content a metadata dictionary describes, e.g. to pick its swarm on the tracker.
+        Only the fields that define the content are hashed, so the same file announced
+        through different trackers is still the same torrent.
+
+        :param metadata: Metadata dictionary, as returned by generate_metadata or load_metadata.
+        :return: SHA1 hex digest of the canonical JSON encoding of the content fields, followed
+                 by the packed chunk hashes.
+        """
+        # Single-file metadata has no "files", Merkle metadata no "piece_hashes"
+        info = {key: metadata[key] for key in INFO_KEYS if key in metadata and key != "piece_hashes"}
+        sha1 = hashlib.sha1(json.dumps(info, sort_keys=True, separators=(",", ":")).encode())
+        if "piece_hashes" in metadata:
+            sha1.update(pack_hashes(metadata["piece_hashes"]))  # Hashed as stored, without decoding them
+        return sha1.hexdigest()
+
+    @staticmethod
+    def file_list(metadata):
+        """
+        Lists the files of a multi-file torrent.
+
+        :param metadata: Metadata dictionary.
+        :return: List of (relative path, size) tuples in torrent order, None for a single-file torrent.
+        """
+        if "files" not in metadata:
+            return None
+        return [(entry["path"], entry["length"]) for entry in metadata["files"]]
+
     @staticmethod
     def load_metadata(file_path):
         """
-        Loads metadata from a JSON file.
+        Loads metadata from a .torrent file. The file is memory-mapped and only the header
+        fields are parsed, "piece_hashes" is a PieceHashes that reads each hash from the
+        mapping when it is looked up. Metadata files written as JSON by earlier versions
+        still load, with "piece_hashes" as a list.
         
-        :param file_path: Path to the .torrent JSON file.
+        :param file_path: Path to the .torrent file.
         :return: Metadata dictionary
         """
-        with open(file_path, 'r') as metafile:
-            metadata = json.load(metafile)
+        with open(file_path, 'rb') as metafile:
+            if metafile.read(len(METADATA_MAGIC)) != METADATA_MAGIC:
+                metafile.seek(0)
+                return json.load(metafile)
+            # The mapping stays valid after the file is closed
+            buffer = mmap.mmap(metafile.fileno(), 0, access=mmap.ACCESS_READ)
+        _, fields_length, hash_count = METADATA_HEADER.unpack_from(buffer)
+        hashes_offset = METADATA_HEADER.size + fields_length
+        if len(buffer) != hashes_offset + hash_count * HASH_LENGTH:
+            raise ValueError(f"{file_path} is truncated or not a metadata file")
+        metadata = json.loads(buffer[METADATA_HEADER.size:hashes_offset])
+        if "merkle_root" not in metadata:
+            metadata["piece_hashes"] = PieceHashes(buffer, hashes_offset, hash_count)
         return metadata
 
 # Example usage
@@ -0,0 +1,170 @@
+import os
+import sys
+import socket
+import hashlib
+import asyncio
+import subprocess
+from time import sleep, monotonic
+from peer_protocol import encode_frame
+
+REPLICATION_FACTOR = 2  # trackers that hold the state of every swarm
+REPLICA_QUEUE_SIZE = 10000  # replication messages buffered per tracker while it is slow or down
+RECONNECT_DELAY = 1  # seconds before a replica link tries to connect again
+
+
+def parse_endpoints(text):
+    """
+    Parses "host:port,host:port" into a list of (host, port) tuples.
+    """
+    endpoints = []
+    for endpoint in text.split(","):
+        host, port = endpoint.strip().rsplit(":", 1)
+        endpoints.append((host, int(port)))
+    return endpoints
+
+
+def rank_endpoints(info_hash, endpoints):
+    """
+    Orders the tracker endpoints for a swarm with rendezvous hashing: every endpoint gets a
+    score from hashing it with the info hash, highest first. Peers and trackers agree on the
+    order without talking to each other, and adding or removing a tracker only moves the
+    swarms that it owns.
+    PARAMETERS:
+    info_hash: The info hash of the torrent.
+    endpoints: List of (host, port) tuples.
+    RETURNS:
+    The endpoints, the ones responsible for the swarm first.
+    """
+    def score(endpoint):
+        return hashlib.sha1(f"{info_hash}/{endpoint[0]}:{endpoint[1]}".encode()).digest()
+    return sorted(endpoints, key=score, reverse=True)
+
+
+class TrackerCluster:
+    """
+    The trackers of a cluster, as seen from one of them.
+    Each swarm lives on the first `replicas` trackers of its rendezvous order: the tracker
+    that receives an announce applies it and forwards it to the other trackers of the swarm,
+    so any of them can take over when one goes down.
+    """
+
+    def __init__(self, endpoints, own_endpoint, replicas=REPLICATION_FACTOR):
+        """
+        PARAMETERS:
+        endpoints: List of (host, port) tuples of every tracker in the cluster.
+        own_endpoint: The (host, port) under which the other trackers reach this one.
+        replicas: Number of trackers that hold each swarm.
+        """
+        self.endpoints = list(endpoints)
+        self.own_endpoint = tuple(own_endpoint)
+        self.replicas = min(replicas, len(self.endpoints))
+
+    def owners(self, info_hash):
+        """
+        RETURNS:
+        The endpoints that hold the swarm of a torrent.
+        """
+        return rank_endpoints(info_hash, self.endpoints)[:self.replicas]
+
+    def replica_targets(self, info_hash):
+        """
+        RETURNS:
+        The trackers a change to a swarm has to be forwarded to.
+        """
+        return [endpoint for endpoint in self.owners(info_hash) if endpoint != self.own_endpoint]
+
+
+class ReplicaLink:
+    """
+    A one-way connection to another tracker that carries replication messages.
+    Messages are queued so the announce that caused them is answered without waiting,
+    and the link reconnects on its own. Messages queued while the other tracker is down
+    are dropped: its peers' next heartbeats and announces bring it back up to date.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.queue = asyncio.Queue(REPLICA_QUEUE_SIZE)
+        self.task = None
+
+    def send(self, message):
+        """
+        Queues a message for the other tracker, starting the link on first use.
+        Must be called from the event loop.
+        """
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        try:
+            self.queue.put_nowait(encode_frame(message.encode()))
+        except asyncio.QueueFull:
+            pass  # The other tracker is not keeping up, it catches up from later announces
+
+    async def run(self):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(*self.endpoint)
+            except OSError:
+                await self.discard_queued()
+                continue
+            try:
+                while True:
+                    writer.write(await self.queue.get())
+                    await writer.drain()
+            except (OSError, ConnectionError):
+                writer.close()
+                await self.discard_queued()
+
+    async def discard_queued(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+def free_port():
+    """
+    RETURNS:
+    A TCP port on localhost that nothing is listening on right now.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_local_cluster(count, replicas=REPLICATION_FACTOR, timeout=10):
+    """
+    Starts a cluster of tracker processes on localhost, e.g. for tests.
+    PARAMETERS:
+    count: Number of tracker processes.
+    replicas: Number of trackers that hold each swarm.
+    timeout: Seconds to wait for every tracker to accept connections.
+    RETURNS:
+    A tuple of (processes, endpoints). The caller terminates the processes.
+    """
+    endpoints = [('127.0.0.1', free_port()) for _ in range(count)]
+    cluster = ",".join(f"{host}:{port}" for host, port in endpoints)
+    tracker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tracker_server.py")
+    processes = [
+        subprocess.Popen(
+            [sys.executable, tracker_script, "--host", host, "--port", str(port),
+             "--cluster", cluster, "--replicas", str(replicas)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        for host, port in endpoints
+    ]
+    deadline = monotonic() + timeout
+    for endpoint in endpoints:
+        while True:
+            try:
+                socket.create_connection(endpoint, timeout=1).close()
+                break
+            except OSError:
+                if monotonic() > deadline:
+                    for process in processes:
+                        process.terminate()
+                    raise TimeoutError(f"Tracker {endpoint} did not start")
+                sleep(0.05)
+    return processes, endpoints
@@ -1,180 +1,373 @@
-import socket 
-import threading 
+import asyncio
+import argparse
+from time import monotonic
+from bitfield import Bitfield
+from swarm_table import SwarmTable
+from expiry_queue import ExpiryQueue
+from tracker_cluster import TrackerCluster, ReplicaLink, parse_endpoints, REPLICATION_FACTOR
+from peer_protocol import encode_frame, read_frame_async
+
+LISTEN_BACKLOG = 1024  # pending connections the listening socket accepts when many peers announce at once
+ANNOUNCE_INTERVAL = 30  # seconds between the heartbeats of a peer
+MIN_ANNOUNCE_INTERVAL = 5  # shortest time between two peer list requests, for peers still looking for peers
+PEER_TTL = 3 * ANNOUNCE_INTERVAL  # a peer that missed this many heartbeats is evicted
 
 class Tracker:
-    def __init__(self, host="0.0.0.0", port=9090):
-        
+    def __init__(self, host="0.0.0.0", port=9090, announce_interval=ANNOUNCE_INTERVAL, peer_ttl=PEER_TTL, clock=monotonic,
+                 cluster=None):
+
         """
         Initializes the tracker server with a specified host and port.
         PARAMETERS:
         host: The IP address to which the tracker server binds to. I have set it up at '0.0.0.0'
         port: The port number on which the tracker server will listen for incoming peer connections
+        announce_interval: Seconds between heartbeats, announced to the peers
+        peer_ttl: Seconds without a heartbeat after which a peer is evicted
+        clock: Function returning the current time in seconds, replaceable for tests
+        cluster: TrackerCluster this tracker is part of, None for a standalone tracker
         """
         self.host = host
         self.port = port
-        self.peers = {} ## this is a dictionary to store peer addresses and the chunks they have
-        self.peer_connections = {} ## Keep trackn of peer connections for broadcasting
+        self.announce_interval = announce_interval
+        self.peer_ttl = peer_ttl
+        self.clock = clock
+        self.swarms = {} ## info hash -> SwarmTable with the peers of that torrent and the chunks they have
+        self.expiry = ExpiryQueue() ## (info hash, "ip:port") -> time at which the peer is evicted
+        self.cluster = cluster
+        self.replica_links = {} ## (host, port) -> ReplicaLink to another tracker of the cluster
+
+    def get_swarm(self, info_hash, create=False):
+        """
+        Looks up the swarm of a torrent in O(1), however many torrents the tracker hosts.
+        PARAMETERS:
+        info_hash: The info hash of the torrent.
+        create: Whether to create the swarm if it does not exist yet.
+        RETURNS:
+        The SwarmTable, or None if there is none and create is False.
+        """
+        swarm = self.swarms.get(info_hash)
+        if swarm is None and create:
+            swarm = self.swarms[info_hash] = SwarmTable()
+        return swarm
 
     def start(self):
         """
         Starting the tracker server to manage the peers for a connection.
+        All connections are served by a single asyncio event loop, see run().
+        """
+        asyncio.run(self.run())
+
+    async def run(self):
+        """
         The server is binding to the specified host and port and keeps on listening on that port
-        for peer connections, all peer connections are handled in a separate thread.
+        for peer connections. Every connection is a coroutine on the event loop, and the swarm
+        state is only touched from that loop, so it needs no locks.
         """
-        try:
-            ## creating a socket for the tracker server
-            tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tracker_socket.bind((self.host, self.port)) ## binding the socket to the specified host and port
-            tracker_socket.listen(5) ## listening for incoming connections, with a maximum backlog of 5
-            print(f"Tracker started on {self.host}:{self.port}, waiting for peers....")
+        server = await asyncio.start_server(self.handle_peer, self.host, self.port, backlog=LISTEN_BACKLOG)
+        print(f"Tracker started on {self.host}:{self.port}, waiting for peers....")
+        async with server:
+            eviction = asyncio.create_task(self.evict_expired_peers_periodically())
+            try:
+                await server.serve_forever()
+            finally:
+                eviction.cancel()
+                for link in self.replica_links.values():
+                    link.close()
 
-            while True:
-                client_socket, addr = tracker_socket.accept()
-                print(f"Peer {addr} connected.")
-                ## here i will start a new thread to handle the peer connection.
-                threading.Thread(target=self.handle_peer, args =(client_socket, addr)).start()
-        except Exception as e:
-            print(f"Error in tracker operation: {e}")
-        finally:
-             # Ensuring the tracker socket is closed if an error occurs.
-            tracker_socket.close()
+    async def evict_expired_peers_periodically(self):
+        """
+        Evicts peers whose TTL ran out. Sleeps until the earliest deadline instead of scanning
+        the peers: every new deadline is at least peer_ttl away, so none can come earlier.
+        """
+        while True:
+            next_deadline = self.expiry.next_deadline()
+            delay = self.peer_ttl if next_deadline is None else next_deadline - self.clock()
+            await asyncio.sleep(max(delay, 0))
+            self.evict_expired_peers()
+
+    def evict_expired_peers(self):
+        """
+        Removes every peer that has not announced within its TTL.
+        RETURNS:
+        The (info hash, "ip:port") pairs of the evicted peers.
+        """
+        expired = self.expiry.pop_expired(self.clock())
+        for info_hash, peer_addr in expired:
+            print(f"Peer {peer_addr} timed out, evicting it from swarm {info_hash}.")
+            self.drop_peer(info_hash, peer_addr)
+        return expired
 
-    def handle_peer(self, client_socket, addr):
+    def register_peer(self, info_hash, peer_addr, chunks):
+        """
+        Adds or updates a peer in the swarm of its torrent and restarts its TTL.
+        RETURNS:
+        True if the peer is new to the swarm.
+        """
+        swarm = self.get_swarm(info_hash, create=True)
+        self.expiry.touch((info_hash, peer_addr), self.clock() + self.peer_ttl)
+        return swarm.add_peer(peer_addr, chunks)
+
+    def refresh_peer(self, info_hash, peer_addr):
+        """
+        Restarts the TTL of a known peer.
+        RETURNS:
+        False if the peer is not in the swarm.
+        """
+        if (info_hash, peer_addr) not in self.expiry:
+            return False
+        self.expiry.touch((info_hash, peer_addr), self.clock() + self.peer_ttl)
+        return True
+
+    def drop_peer(self, info_hash, peer_addr):
+        """
+        Removes a peer from its swarm and the expiry queue. Empty swarms are dropped.
+        RETURNS:
+        True if the peer was in the swarm.
+        """
+        self.expiry.discard((info_hash, peer_addr))
+        swarm = self.get_swarm(info_hash)
+        if swarm is None or not swarm.remove_peer(peer_addr):
+            return False
+        if not swarm.peers:
+            del self.swarms[info_hash]
+        return True
+
+    def intervals(self):
+        """
+        The announce intervals sent back on every registration and heartbeat, "<interval> <min interval>".
+        """
+        return f"{self.announce_interval} {MIN_ANNOUNCE_INTERVAL}"
+
+    async def handle_peer(self, reader, writer):
         """
         This is one of the crucial function of our system.
         Manages communication with the peer.
         This method handles a request from a peer, such as requesting the peer list,
-        adding or removing a peer and broadcasting updates to all peers.
+        adding or removing a peer. Nothing is broadcast: every peer asks for the
+        changes it has not seen yet when it announces.
         It keeps on listening to the peer connection until it is closed
         PARAMETERS:
-        client_socket: This socket is used for communicating with the connected peer.
-        addr: Address of the connected peer(It's host and port)
+        reader, writer: The asyncio streams of the connected peer.
         """
+        addr = writer.get_extra_info('peername')
+        connection = {'info_hash': None, 'peer_addr': None}  ## the swarm and "ip:port" the peer registered with
         try:
             while True:
-                data= client_socket.recv(1024).decode()
-                ## If not receiving any data , breaking the loop to exit the connection
-                if not data:
+                try:
+                    ## every request is one length-prefixed frame, so large bitfields arrive whole
+                    data = (await read_frame_async(reader)).decode()
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    ## If the peer closed the connection, breaking the loop to exit
                     break
 
                 ## Handling different types of requests from the peer
-                if data == "REQUEST_PEERS":
-                    ## sending the list, if the peer requests the list of other peers
-                    self.send_peers_list(client_socket, addr)
+                if data.startswith("REQUEST_PEERS"):
+                    ## sending the changes since the peer's last announce
+                    self.send_peers_list(writer, data, connection['info_hash'], connection['peer_addr'])
                 elif data.startswith("ADD_PEER"):
-                    ## if the peer wants to be added to the tracker, we update the list and broadcast to others
-                    self.add_peer(client_socket, data)
-                    self.broadcast_peer_list()
+                    ## if the peer wants to be added to the tracker, we update the swarm table of its torrent
+                    registered = self.add_peer(writer, data)
+                    if registered:
+                        connection['info_hash'], connection['peer_addr'] = registered
+                elif data.startswith("HEARTBEAT"):
+                    ## the peer is still alive, extending its TTL
+                    self.heartbeat(writer, data, connection['info_hash'], connection['peer_addr'])
                 elif data.startswith("REMOVE_PEER"):
-                    ## if the peers is removing itself, we update the list and broadcast to the others
-                    self.remove_peer(client_socket, addr)
-                    self.broadcast_peer_list()
+                    ## if the peers is removing itself, we update the swarm table
+                    self.remove_peer(writer, data, connection['info_hash'], connection['peer_addr'])
+                elif data.startswith("REPLICATE "):
+                    ## a change another tracker of the cluster applied, nothing is sent back
+                    self.apply_replicated(data[len("REPLICATE "):])
+                elif data.startswith("SCRAPE"):
+                    ## statistics of one swarm
+                    self.send_swarm_stats(writer, data)
                 else:
                     # Handle any unrecognized requests.
                     print(f"Unknown request from {addr}: {data}")
-        
+                    writer.write(encode_frame("ERROR".encode()))
+                await writer.drain()
+
         except Exception as e:
             print(f"Error handling peer {addr}: {e}")
-        
+
         finally:
-            # Close the socket connection with the peer.
-            client_socket.close()
-            # Removing the peer from the tracker, for ensuring it's no longer in the list.
-            self.remove_peer(None, addr)
+            # Close the connection with the peer. Peers announce on short-lived connections,
+            # so closing one does not mean the peer left the swarm.
+            writer.close()
 
-    def send_peers_list(self, client_socket, addr):
+    def send_peers_list(self, writer, data, info_hash, peer_addr):
         """
-        Sends the list of known peers and their chunks to the connected peers.
+        Sends a bounded random subset of the swarm to the peer, or only what changed in it
+        since the peer's last announce.
+        The format is a "PEERS <version> FULL|DELTA" line, then one "ip:port: <piece count> <base64 bitfield>"
+        line per new or updated peer and one "REMOVED ip:port" line per peer that left.
         PARAMETERS:
-        client_socket: The socket used to communicate with the connected peer.
-        addr: The address of the connected peer.
-
+        writer: The stream writer of the connected peer.
+        data: The request, "REQUEST_PEERS [<version of the last list the peer applied>]".
+        info_hash: The torrent the peer registered for, None if it did not register.
+        peer_addr: The "ip:port" the peer registered with, None if it did not register.
         """
-        try:
-            if self.peers:
-                # Formatting the  peer list with the chunks the peers have
-                peer_list = "\n".join([f"{peer}: {','.join(map(str, chunks))}" for peer, chunks in self.peers.items()])
-            else:
-                peer_list = "NO_PEERS"  # If no peers are available, inform the peer
-            print(f"Sending peer list to {addr}: {peer_list}")
-            client_socket.send(peer_list.encode())
-        except Exception as e:
-            print(f"Error sending peer list to {addr}: {e}")
+        swarm = self.get_swarm(info_hash)
+        if swarm is None:
+            writer.write(encode_frame("UNKNOWN_TORRENT".encode()))
+            return
+        parts = data.split(" ")
+        since = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        version, full, updated, removed = swarm.announce(peer_addr, since)
+        print(f"Sending {'full' if full else 'delta'} peer list of {len(updated)} peers to {peer_addr}")
+        response = "\n".join([f"PEERS {version} {'FULL' if full else 'DELTA'}", self.format_peer_list(updated)]
+                             + [f"REMOVED {removed_addr}" for removed_addr in removed])
+        writer.write(encode_frame(response.encode()))
 
-    def add_peer(self, client_socket, data):
+    def add_peer(self, writer, data):
         """
-        Adds a peer to the peer list and registers the chunks they have.
+        Adds a peer to the swarm of its torrent and registers the chunks they have.
         PARAMETERS:
-        client_socket: The socket used to communicate with the connected peer.
-        data: The info sent by the peer. (The peer's IP and the chunk which they possess.)
+        writer: The stream writer of the connected peer.
+        data: The info sent by the peer. (The torrent, the peer's IP and the chunk which they possess.)
+        RETURNS:
+        A tuple of (info hash, "ip:port") of the peer, None if the request was invalid.
         """
         try:
-            ## Here i am splitting the data to extract the peer IP and the chunk list.
-            parts = data.split(" ")
-            peer_ip = parts[1]
-            chunks = list(map(int, parts[2:]))  # List of chunk numbers the peer has as integers.
-
-            if peer_ip not in self.peers:
-                # Adding new peer along with the chunk it has.
-                self.peers[peer_ip] = chunks
-                self.peer_connections[peer_ip] = client_socket
-                ## Informing the peer that it has been added.
-                print(f"Peer {peer_ip} with chunks {chunks} added.")
-                client_socket.send("PEER_ADDED".encode())
+            info_hash, peer_ip, chunks = self.parse_registration(data)
+            is_new = self.register_peer(info_hash, peer_ip, chunks)
+            self.replicate(info_hash, data)
+            if is_new:
+                ## Informing the peer that it has been added, and how often it has to announce.
+                print(f"Peer {peer_ip} with chunks {chunks} added, {len(self.swarms[info_hash])} peers in swarm {info_hash}.")
+                writer.write(encode_frame(f"PEER_ADDED {self.intervals()}".encode()))
             else:
-                # Updating peer's chunk list if they're already registered
-                self.peers[peer_ip] = chunks
                 ## Informing the peer that it's information has been updated.
-                client_socket.send("PEER_UPDATED".encode())
-            print(f"Current list of peers: {self.peers}")
+                writer.write(encode_frame(f"PEER_UPDATED {self.intervals()}".encode()))
+            return info_hash, peer_ip
         except Exception as e:
             print(f"Error adding peer: {e}")
-            client_socket.send("ERROR".encode())
+            writer.write(encode_frame("ERROR".encode()))
+            return None
 
-    def remove_peer(self, client_socket, addr):
+    @staticmethod
+    def parse_registration(data):
+        """
+        Splits an ADD_PEER request into the torrent, the peer IP and the chunk bitfield.
+        The format is "ADD_PEER <info hash> ip:port <piece count> <base64 bitfield>"
+        RETURNS:
+        A tuple of (info hash, "ip:port", Bitfield).
         """
-        Removes a peer from the list when they disconnect or request removal.
+        parts = data.split(" ")
+        info_hash = parts[1]
+        peer_ip = parts[2]
+        piece_count = int(parts[3]) if len(parts) > 3 else 0
+        encoded = parts[4] if len(parts) > 4 else ""
+        return info_hash, peer_ip, Bitfield.from_base64(encoded, piece_count)
+
+    def heartbeat(self, writer, data, info_hash, peer_addr):
+        """
+        Extends the TTL of a peer without touching its chunks, so keeping a peer alive
+        costs a short frame and a heap push.
         PARAMETERS:
-        client_socket: The socket used to communicate with the connected peer.
-        addr: The address of the peer to be removed
+        writer: The stream writer of the connected peer.
+        data: The request, "HEARTBEAT [<info hash> ip:port]".
+        info_hash, peer_addr: The torrent and "ip:port" the peer registered with on this connection,
+        used if data names none.
+        """
+        parts = data.split(" ")
+        if len(parts) > 2:
+            info_hash, peer_addr = parts[1], parts[2]
+        if self.refresh_peer(info_hash, peer_addr):
+            self.replicate(info_hash, f"HEARTBEAT {info_hash} {peer_addr}")
+            writer.write(encode_frame(f"OK {self.intervals()}".encode()))
+        else:
+            ## The peer was evicted or never registered, it has to send ADD_PEER again
+            writer.write(encode_frame("UNKNOWN_PEER".encode()))
+
+    def remove_peer(self, writer, data, info_hash, peer_addr):
+        """
+        Removes a peer from the swarm when they request removal. Empty swarms are dropped.
+        PARAMETERS:
+        writer: The stream writer of the connected peer.
+        data: The request, "REMOVE_PEER [<info hash> ip:port]".
+        info_hash, peer_addr: The torrent and "ip:port" the peer registered with on this connection,
+        used if data names none.
+        """
+        parts = data.split(" ")
+        if len(parts) > 2:
+            info_hash, peer_addr = parts[1], parts[2]
+        if self.drop_peer(info_hash, peer_addr):
+            print(f"Peer {peer_addr} removed from swarm {info_hash}.")
+            self.replicate(info_hash, f"REMOVE_PEER {info_hash} {peer_addr}")
+            ## Informing that the client has been removed from the swarm.
+            writer.write(encode_frame("PEER_REMOVED".encode()))
+        else:
+            ## Edge case for handling if the peer is not found
+            writer.write(encode_frame("PEER_NOT_FOUND".encode()))
+
+    def replicate(self, info_hash, request):
+        """
+        Forwards a change of a swarm to the other trackers that hold it, if we are in a cluster.
+        PARAMETERS:
+        info_hash: The torrent whose swarm changed.
+        request: The request that caused the change, in its explicit "<info hash> ip:port" form.
+        """
+        if self.cluster is None:
+            return
+        for endpoint in self.cluster.replica_targets(info_hash):
+            if endpoint not in self.replica_links:
+                self.replica_links[endpoint] = ReplicaLink(endpoint)
+            self.replica_links[endpoint].send(f"REPLICATE {request}")
+
+    def apply_replicated(self, request):
+        """
+        Applies a change forwarded by another tracker, without answering or forwarding it again.
+        PARAMETERS:
+        request: An ADD_PEER, HEARTBEAT or REMOVE_PEER request naming the torrent and the peer.
         """
         try:
-            # Extract the Ip address of the peer.
-            peer_ip = addr[0]
-            if peer_ip in self.peers:
-                ## Removing the Ip address of the peer from both the dictionaries.
-                del self.peers[peer_ip]
-                if peer_ip in self.peer_connections:
-                    del self.peer_connections[peer_ip]
-                print(f"Peer {peer_ip} removed.")
-                ## Informing that the client has been removed from the dictionaries.
-                if client_socket:
-                    client_socket.send("PEER_REMOVED".encode())
-            else:
-                ## Edge case for handling if the peer is not found
-                if client_socket:
-                    client_socket.send("PEER_NOT_FOUND".encode())
+            parts = request.split(" ")
+            if request.startswith("ADD_PEER"):
+                self.register_peer(*self.parse_registration(request))
+            elif request.startswith("HEARTBEAT"):
+                self.refresh_peer(parts[1], parts[2])
+            elif request.startswith("REMOVE_PEER"):
+                self.drop_peer(parts[1], parts[2])
         except Exception as e:
-            print(f"Error removing peer {addr}: {e}")
+            print(f"Error applying replicated request {request}: {e}")
 
-    def broadcast_peer_list(self):
+    def send_swarm_stats(self, writer, data):
+        """
+        Sends the statistics of one swarm, "<peers> <seeders> <leechers> <announces>".
+        PARAMETERS:
+        writer: The stream writer of the connected peer.
+        data: The request, "SCRAPE <info hash>".
         """
-        Broadcasts the updated peer list and their 
-        chunks to all connected peers.
+        parts = data.split(" ")
+        swarm = self.get_swarm(parts[1]) if len(parts) > 1 else None
+        if swarm is None:
+            writer.write(encode_frame("UNKNOWN_TORRENT".encode()))
+            return
+        stats = swarm.stats()
+        response = f"{stats['peers']} {stats['seeders']} {stats['leechers']} {stats['announces']}"
+        writer.write(encode_frame(response.encode()))
 
+    @staticmethod
+    def format_peer_list(peers):
         """
-        # Create a formatted string of all peers and their chunks.
-        peer_list = "\n".join([f"{peer}: {','.join(map(str, chunks))}" for peer, chunks in self.peers.items()])
-        for peer, connection in self.peer_connections.items():
-            try:
-                # Send the updated peer list to each connected peer.
-                print(f"Broadcasting updated peer list to {peer}: {peer_list}")
-                connection.send(peer_list.encode())
-            except Exception as e:
-                # Handle any errors that occur during broadcasting.
-                print(f"Error broadcasting to {peer}: {e}")
+        Formats peers, one "ip:port: <piece count> <base64 bitfield>" line per peer.
+        PARAMETERS:
+        peers: Dictionary of peer addresses and their Bitfield.
+        """
+        return "\n".join([f"{peer}: {chunks.size} {chunks.to_base64()}" for peer, chunks in peers.items()])
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tracker server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--cluster", help="host:port of every tracker of the cluster, comma separated, this one included")
+    parser.add_argument("--replicas", type=int, default=REPLICATION_FACTOR, help="trackers that hold each swarm")
+    arguments = parser.parse_args()
+
+    cluster = None
+    if arguments.cluster:
+        cluster = TrackerCluster(parse_endpoints(arguments.cluster), (arguments.host, arguments.port), arguments.replicas)
     ## Started an instance of the tracker class
-    tracker = Tracker()
+    tracker = Tracker(arguments.host, arguments.port, cluster=cluster)
     tracker.start()